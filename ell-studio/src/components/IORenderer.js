@@ -1,4 +1,8 @@
 import React from 'react';
+import { getImageUrl } from '../hooks/useBackend';
+
+// Images may be stored inline as data urls or as references to content-addressed image blobs.
+const imageSource = (data) => data.__image_id__ ? getImageUrl(data.__image_id__) : data.content;
 
 const typeMatchers = {
   ToolResult: (data) => data && typeof data === 'object' && 'tool_call_id' in data && 'result' in data,
@@ -107,7 +111,7 @@ const renderInline = (data, customRenderers) => {
 
     if (isImage) {
       return (
-         <img src={data.content} alt="PIL.Image" style={{display: 'inline-block', verticalAlign: 'middle', maxHeight: '1.5em'}} />
+         <img src={imageSource(data)} alt="PIL.Image" style={{display: 'inline-block', verticalAlign: 'middle', maxHeight: '1.5em'}} />
         
       );
     }
@@ -197,7 +201,7 @@ const renderNonInline = (data, customRenderers, level = 0, isArrayItem = false,
     if (isImage) 
       return (
         <Indent level={level + 1}>
-          <img src={data.content} alt="Embedded Image" />
+          <img src={imageSource(data)} alt="Embedded Image" />
         </Indent>
       );
 
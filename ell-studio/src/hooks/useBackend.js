@@ -5,6 +5,8 @@ import { useEffect, useState } from "react";
 const API_BASE_URL = "http://localhost:8080";
 const WS_URL = "ws://localhost:8080/ws";
 
+export const getImageUrl = (imageId) => `${API_BASE_URL}/api/image/${imageId}`;
+
 export const useWebSocketConnection = () => {
   const queryClient = useQueryClient();
   const [isConnected, setIsConnected] = useState(false);
@@ -7,6 +7,8 @@ and intuitive interface for working with large language models.
 from ell.lmp.simple import simple
 from ell.lmp.tool import tool
 from ell.lmp.complex import complex
+from ell.lmp._track import wait_for_versioning
+from ell.util.watcher import watch_lmps
 from ell.types.message import system, user, assistant, Message, ContentBlock
 from ell.__version__ import __version__
 
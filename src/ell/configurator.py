@@ -1,7 +1,8 @@
 from functools import wraps
-from typing import Dict, Any, Optional, Union
+from typing import Dict, Any, Literal, Optional, Tuple, Union
 import openai
 import logging
+import os
 from contextlib import contextmanager
 import threading
 from pydantic import BaseModel, ConfigDict, Field
@@ -18,18 +19,30 @@ class Config(BaseModel):
     _store: Optional[Store] = None
     autocommit: bool = False
     lazy_versioning: bool = True
+    background_versioning: bool = False
+    source_hash_mode: Literal["black", "ast"] = "black"
+    capture_logprobs: bool = False
+    closure_cache_dir: Optional[str] = Field(default_factory=lambda: os.environ.get("ELL_CLOSURE_CACHE_DIR"))
     default_lm_params: Dict[str, Any] = Field(default_factory=dict)
     default_system_prompt: str = "You are a helpful AI assistant."
     _default_openai_client: Optional[openai.Client] = None
+    image_format: str = "PNG"
+    image_quality: Optional[int] = None
+    max_image_resolutions: Dict[str, Tuple[int, int]] = Field(default_factory=dict)
+    max_n: Dict[str, int] = Field(default_factory=dict)
 
     def __init__(self, **data):
         super().__init__(**data)
         self._lock = threading.Lock()
         self._local = threading.local()
 
-    def register_model(self, model_name: str, client: openai.Client) -> None:
+    def register_model(self, model_name: str, client: openai.Client, max_image_resolution: Optional[Tuple[int, int]] = None, max_n: Optional[int] = None) -> None:
         with self._lock:
             self.registry[model_name] = client
+            if max_image_resolution is not None:
+                self.max_image_resolutions[model_name] = max_image_resolution
+            if max_n is not None:
+                self.max_n[model_name] = max_n
 
     @property 
     def has_store(self) -> bool:
@@ -66,6 +79,18 @@ class Config(BaseModel):
             fallback = True
         return client, fallback
 
+    def get_image_params_for(self, model_name: Optional[str]) -> Dict[str, Any]:
+        """Parameters used to preprocess and encode images sent to the given model."""
+        return dict(
+            format=self.image_format,
+            quality=self.image_quality,
+            max_resolution=self.max_image_resolutions.get(model_name),
+        )
+
+    def get_max_n_for(self, model_name: Optional[str]) -> int:
+        """The most choices a single request to the given model can generate. Models not known to support n get 1."""
+        return self.max_n.get(model_name, 1)
+
     def reset(self) -> None:
         with self._lock:
             self.__init__()
@@ -92,6 +117,12 @@ class Config(BaseModel):
     def set_default_client(self, client: openai.Client) -> None:
         self.default_client = client
 
+    def set_image_params(self, format: Optional[str] = None, quality: Optional[int] = None) -> None:
+        if format is not None:
+            self.image_format = format
+        if quality is not None:
+            self.image_quality = quality
+
 
 # Singleton instance
 config = Config()
@@ -101,6 +132,10 @@ def init(
     verbose: bool = False,
     autocommit: bool = True,
     lazy_versioning: bool = True,
+    background_versioning: bool = False,
+    source_hash_mode: Optional[Literal["black", "ast"]] = None,
+    capture_logprobs: bool = False,
+    closure_cache_dir: Optional[str] = None,
     default_lm_params: Optional[Dict[str, Any]] = None,
     default_system_prompt: Optional[str] = None,
     default_openai_client: Optional[openai.Client] = None
@@ -113,12 +148,27 @@ def init(
         store (Union[Store, str], optional): Set the store for ELL. Can be a Store instance or a string path for SQLiteStore.
         autocommit (bool): Set autocommit for the store operations.
         lazy_versioning (bool): Enable or disable lazy versioning.
+        background_versioning (bool): Version LMPs on a background thread as soon as they are decorated. Takes precedence over lazy_versioning.
+            Use ell.wait_for_versioning() to block until all LMPs are versioned.
+        source_hash_mode (str, optional): How LMP source is normalized before hashing. "black" (the default) formats it with Black;
+            "ast" hashes a parsed and unparsed rendering, skipping Black at decoration time. The modes produce different hashes.
+        capture_logprobs (bool): Request token logprobs from the model and attach them to the generated text as numpy arrays,
+            available as the logits of its _lstrs.
+        closure_cache_dir (str, optional): Directory in which computed LMP closures are cached across processes.
         default_lm_params (Dict[str, Any], optional): Set default parameters for language models.
         default_system_prompt (str, optional): Set the default system prompt.
         default_openai_client (openai.Client, optional): Set the default OpenAI client.
     """
     config.verbose = verbose
     config.lazy_versioning = lazy_versioning
+    config.background_versioning = background_versioning
+    config.capture_logprobs = capture_logprobs
+
+    if source_hash_mode is not None:
+        config.source_hash_mode = source_hash_mode
+
+    if closure_cache_dir is not None:
+        config.closure_cache_dir = closure_cache_dir
 
     if store is not None:
         config.set_store(store, autocommit)
@@ -149,4 +199,8 @@ def set_default_lm_params(*args, **kwargs) -> None:
 def set_default_system_prompt(*args, **kwargs) -> None:
     return config.set_default_system_prompt(*args, **kwargs)
 
+@wraps(config.set_image_params)
+def set_image_params(*args, **kwargs) -> None:
+    return config.set_image_params(*args, **kwargs)
+
 # You can add more helper functions here if needed
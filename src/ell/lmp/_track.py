@@ -1,5 +1,9 @@
 import logging
+import queue
+import sys
 import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from ell.types import SerializedLMP, Invocation, InvocationTrace, InvocationContents
 from ell.types.studio import LMPType, utc_now
 import ell.util.closure
@@ -7,22 +11,30 @@ from ell.configurator import config
 from ell.types._lstr import _lstr
 
 import inspect
+import json
 
 import secrets
 import time
 from datetime import datetime
 from functools import wraps
-from typing import Any, Callable, Dict, Iterable, Optional, OrderedDict, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, OrderedDict, Set, Tuple
 
 from ell.util.serialization import get_immutable_vars
 from ell.util.serialization import compute_state_cache_key
 from ell.util.serialization import prepare_invocation_params
+from ell.util.serialization import externalize_images
 
 logger = logging.getLogger(__name__)
 
 # Thread-local storage for the invocation stack
 _invocation_stack = threading.local()
 
+# Every tracked LMP and the forced dependencies its closure is computed with, used to re-version LMPs on source changes.
+_tracked_lmps: "weakref.WeakKeyDictionary[Callable, Optional[Dict[str, Any]]]" = weakref.WeakKeyDictionary()
+
+def get_tracked_lmps() -> Dict[Callable, Optional[Dict[str, Any]]]:
+    return dict(_tracked_lmps)
+
 def get_current_invocation() -> Optional[str]:
     if not hasattr(_invocation_stack, 'stack'):
         _invocation_stack.stack = []
@@ -46,20 +58,26 @@ def _track(func_to_track: Callable, *, forced_dependencies: Optional[Dict[str, A
     # see if it exists
     if not hasattr(func_to_track, "_has_serialized_lmp"):
         func_to_track._has_serialized_lmp = False
+    _tracked_lmps[func_to_track] = forced_dependencies
 
-    if not hasattr(func_to_track, "__ell_hash__") and not config.lazy_versioning:
-        ell.util.closure.lexically_closured_source(func_to_track, forced_dependencies)
+    if not hasattr(func_to_track, "__ell_hash__"):
+        if config.background_versioning:
+            _version_in_background(func_to_track, forced_dependencies)
+        elif not config.lazy_versioning:
+            ell.util.closure.lexically_closured_source(func_to_track, forced_dependencies)
 
 
     @wraps(func_to_track)
-    def tracked_func(*fn_args, _get_invocation_id=False, **fn_kwargs) -> str:
+    def tracked_func(*fn_args, _get_invocation_id=False, _sample: Optional[Tuple[str, List[str]]] = None, **fn_kwargs) -> str:
         # XXX: Cache keys and global variable binding is not thread safe.
         # Compute the invocation id and hash the inputs for serialization.
-        invocation_id = "invocation-" + secrets.token_hex(16)
+        # A batch of samples, given as its sample group and an invocation id per sample, traces each sample to its own id.
+        invocation_id = _sample[1][0] if _sample else "invocation-" + secrets.token_hex(16)
+        invocation_origin = _sample[1] if _sample else invocation_id
 
         state_cache_key : str = None
         if not config._store:
-            return func_to_track(*fn_args, **fn_kwargs, _invocation_origin=invocation_id)[0]
+            return func_to_track(*fn_args, **fn_kwargs, _invocation_origin=invocation_origin)[0]
 
         parent_invocation_id = get_current_invocation()
         try:
@@ -81,8 +99,7 @@ def _track(func_to_track: Callable, *, forced_dependencies: Optional[Dict[str, A
 
             if  try_use_cache:
                 # Todo: add nice logging if verbose for when using a cahced invocaiton. IN a different color with thar args..
-                if not hasattr(func_to_track, "__ell_hash__")  and config.lazy_versioning:
-                    fn_closure, _ = ell.util.closure.lexically_closured_source(func_to_track)
+                _ensure_versioned(func_to_track, forced_dependencies)
                 
                 # compute the state cachekey
                 state_cache_key = compute_state_cache_key(ipstr, func_to_track.__ell_closure__)
@@ -113,7 +130,7 @@ def _track(func_to_track: Callable, *, forced_dependencies: Optional[Dict[str, A
             (result, invocation_api_params, metadata) = (
                 (func_to_track(*fn_args, **fn_kwargs), {}, {})
                 if lmp_type == LMPType.OTHER
-                else func_to_track(*fn_args, _invocation_origin=invocation_id, **fn_kwargs, )
+                else func_to_track(*fn_args, _invocation_origin=invocation_origin, **fn_kwargs, )
                 )
             latency_ms = (utc_now() - _start_time).total_seconds() * 1000
             usage = metadata.get("usage", {})
@@ -125,15 +142,18 @@ def _track(func_to_track: Callable, *, forced_dependencies: Optional[Dict[str, A
             #XXX: This will allow all objects to be traced automatically irrespective origin rather than relying on the API to do it, it will of vourse be expensive but unify track.
             #XXX: No other code will need to consider tracking after this point.
 
-            if not hasattr(func_to_track, "__ell_hash__") and config.lazy_versioning:
-                ell.util.closure.lexically_closured_source(func_to_track, forced_dependencies)
+            _ensure_versioned(func_to_track, forced_dependencies)
             _serialize_lmp(func_to_track)
 
             if not state_cache_key:
                 state_cache_key = compute_state_cache_key(ipstr, func_to_track.__ell_closure__)
 
-            _write_invocation(func_to_track, invocation_id, latency_ms, prompt_tokens, completion_tokens, 
-                            state_cache_key, invocation_api_params, cleaned_invocation_params, consumes, result, parent_invocation_id)
+            if _sample:
+                _write_samples(func_to_track, _sample[1], latency_ms, prompt_tokens, completion_tokens, state_cache_key,
+                               invocation_api_params, cleaned_invocation_params, consumes, result, parent_invocation_id, _sample[0])
+            else:
+                _write_invocation(func_to_track, invocation_id, latency_ms, prompt_tokens, completion_tokens, 
+                                state_cache_key, invocation_api_params, cleaned_invocation_params, consumes, result, parent_invocation_id)
 
             if _get_invocation_id:
                 return result, invocation_id
@@ -153,6 +173,121 @@ def _track(func_to_track: Callable, *, forced_dependencies: Optional[Dict[str, A
 
     return tracked_func
 
+###########################
+## Background versioning ##
+###########################
+# With config.background_versioning, closures are computed on a worker thread as soon as an LMP is decorated rather
+# than on its first call. A single worker is used: closure computation is bound by the GIL, and LMPs are versioned in
+# definition order so that the LMPs they use are usually already versioned.
+
+# Pending background versioning, and the LMP and forced dependencies each future versions.
+_versioning_futures: Dict[Future, Tuple[Callable, Optional[Dict[str, Any]]]] = {}
+_versioning_queue: "queue.Queue[Future]" = queue.Queue()
+_versioning_worker: Optional[threading.Thread] = None
+_versioning_lock = threading.Lock()
+# How often LMPs set aside while their module imports are looked at again.
+VERSIONING_RETRY_INTERVAL = 0.01
+
+def _version_in_background(func, forced_dependencies: Optional[Dict[str, Any]]) -> None:
+    global _versioning_worker
+    if func.__module__ == "__main__":
+        # Scripts never finish initializing before their LMPs run, so they are versioned lazily.
+        return
+    future = Future()
+    with _versioning_lock:
+        if _versioning_worker is None:
+            _versioning_worker = threading.Thread(target=_versioning_loop, name="ell-versioning", daemon=True)
+            _versioning_worker.start()
+        _versioning_futures[future] = (func, forced_dependencies)
+    future.add_done_callback(_versioning_done)
+    func.__ell_versioning__ = future
+    _versioning_queue.put(future)
+
+def _versioning_done(future: Future) -> None:
+    with _versioning_lock:
+        _versioning_futures.pop(future, None)
+    if not future.cancelled() and future.exception() is not None:
+        logger.debug(f"Background versioning failed, it will be retried on first call: {future.exception()}")
+
+def _versioning_loop() -> None:
+    # LMPs whose module is still importing are set aside and queued again once the queue runs dry, rather than waited
+    # for, so that a slow import does not hold up the LMPs of other modules.
+    deferred: List[Future] = []
+    while True:
+        try:
+            future = _versioning_queue.get(timeout=VERSIONING_RETRY_INTERVAL if deferred else None)
+        except queue.Empty:
+            for future in deferred:
+                _versioning_queue.put(future)
+            deferred = []
+            continue
+        with _versioning_lock:
+            pending = _versioning_futures.get(future)
+        if pending is None:
+            # Cancelled while queued.
+            continue
+        func, forced_dependencies = pending
+        if _module_initializing(func):
+            deferred.append(future)
+            continue
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            _version(func, forced_dependencies)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+def _module_initializing(func) -> bool:
+    # Globals defined below the LMP are only bound once its module, and the packages containing it, finish importing.
+    module_name = func.__module__
+    while module_name:
+        spec = getattr(sys.modules.get(module_name), "__spec__", None)
+        if getattr(spec, "_initializing", False):
+            return True
+        module_name = module_name.rpartition(".")[0]
+    return False
+
+def _version(func, forced_dependencies: Optional[Dict[str, Any]]) -> None:
+    if not hasattr(func, "__ell_hash__"):
+        ell.util.closure.lexically_closured_source(func, forced_dependencies)
+
+def _ensure_versioned(func, forced_dependencies: Optional[Dict[str, Any]]) -> None:
+    future = getattr(func, "__ell_versioning__", None)
+    # An LMP called while its module is still importing cannot wait on the worker, which only versions it once the
+    # import finishes.
+    if future is not None and not future.cancel() and not _module_initializing(func):
+        wait([future])
+    if not hasattr(func, "__ell_hash__"):
+        ell.util.closure.lexically_closured_source(func, forced_dependencies)
+
+def wait_for_versioning(timeout: Optional[float] = None) -> bool:
+    """
+    Block until every LMP scheduled for background versioning has been versioned, e.g. before a server takes traffic.
+
+    LMPs whose module, or a package containing it, is still importing cannot be versioned by the worker until the import
+    finishes, so when this is called during that import, e.g. at the bottom of the module, they are versioned inline on
+    the calling thread instead.
+
+    Args:
+        timeout (float, optional): Maximum number of seconds to wait.
+
+    Returns:
+        bool: True if all pending LMPs were versioned within the timeout.
+    """
+    with _versioning_lock:
+        pending = dict(_versioning_futures)
+    for future, (func, forced_dependencies) in list(pending.items()):
+        if _module_initializing(func):
+            # The worker only versions it once the import, which waits for us, finishes.
+            future.cancel()
+            if not hasattr(func, "__ell_hash__"):
+                ell.util.closure.lexically_closured_source(func, forced_dependencies)
+            del pending[future]
+    _, not_done = wait(list(pending), timeout=timeout)
+    return not not_done
+
 def _serialize_lmp(func):
     # Serialize deptjh first all fo the used lmps.
     for f in func.__ell_uses__:
@@ -166,38 +301,60 @@ def _serialize_lmp(func):
     name = func.__qualname__
     api_params = getattr(func, "__ell_api_params__", None)
 
-    lmps = config._store.get_versions_by_fqn(fqn=name)
-    version = 0
-    already_in_store = any(lmp.lmp_id == func.__ell_hash__ for lmp in lmps)
-    
-    if not already_in_store:
-        if lmps:
-            latest_lmp = max(lmps, key=lambda x: x.created_at)
-            version = latest_lmp.version_number + 1
-            if config.autocommit:
-                from ell.util.differ import write_commit_message_for_diff
-                commit = str(write_commit_message_for_diff(
-                    f"{latest_lmp.dependencies}\n\n{latest_lmp.source}", 
-                    f"{fn_closure[1]}\n\n{fn_closure[0]}")[0])
-        else:
-            commit = None
+    store = config._store
+    if not store.lmp_exists(func.__ell_hash__):
+        # The store takes the next version number if another process writes this one first.
+        latest_version = store.get_latest_version_number(name)
+        version = 0 if latest_version is None else latest_version + 1
 
+        # The commit message is backfilled once it has been generated.
         serialized_lmp = SerializedLMP(
             lmp_id=func.__ell_hash__,
             name=name,
             created_at=utc_now(),
             source=fn_closure[0],
             dependencies=fn_closure[1],
-            commit_message=commit,
+            commit_message=None,
             initial_global_vars=get_immutable_vars(fn_closure[2]),
             initial_free_vars=get_immutable_vars(fn_closure[3]),
             lmp_type=lmp_type,
             api_params=api_params if api_params else None,
             version_number=version,
         )
-        config._store.write_lmp(serialized_lmp, [f.__ell_hash__ for f in func.__ell_uses__])
+        store.write_lmp(serialized_lmp, [f.__ell_hash__ for f in func.__ell_uses__])
+        if latest_version is not None and config.autocommit:
+            _write_commit_message_in_background(store, func.__ell_hash__, name, f"{fn_closure[1]}\n\n{fn_closure[0]}")
     func._has_serialized_lmp = True
 
+##########################
+## Commit message worker ##
+##########################
+# Commit messages are written by a language model. They are generated off the invocation path with bounded
+# concurrency and backfilled into the already written SerializedLMP.
+
+COMMIT_MESSAGE_WORKERS = 2
+
+_commit_message_executor: Optional[ThreadPoolExecutor] = None
+
+def _write_commit_message_in_background(store, lmp_id: str, name: str, source: str) -> Future:
+    global _commit_message_executor
+    with _versioning_lock:
+        if _commit_message_executor is None:
+            _commit_message_executor = ThreadPoolExecutor(max_workers=COMMIT_MESSAGE_WORKERS, thread_name_prefix="ell-commit-message")
+    return _commit_message_executor.submit(_write_commit_message, store, lmp_id, name, source)
+
+def _write_commit_message(store, lmp_id: str, name: str, source: str) -> None:
+    from ell.util.differ import write_commit_message_for_diff
+    try:
+        previous_lmps = [lmp for lmp in store.get_versions_by_fqn(fqn=name) if lmp.lmp_id != lmp_id]
+        if not previous_lmps:
+            return
+        latest_lmp = max(previous_lmps, key=lambda x: x.created_at)
+        commit = str(write_commit_message_for_diff(f"{latest_lmp.dependencies}\n\n{latest_lmp.source}", source)[0])
+        store.update_commit_message(lmp_id, commit)
+    except Exception as e:
+        logger.warning(f"Failed to write a commit message for {lmp_id}: {e}")
+
 def _write_invocation(func, invocation_id, latency_ms, prompt_tokens, completion_tokens, 
                      state_cache_key, invocation_api_params, cleaned_invocation_params, consumes, result, parent_invocation_id):
     
@@ -213,9 +370,10 @@ def _write_invocation(func, invocation_id, latency_ms, prompt_tokens, completion
     if invocation_contents.should_externalize and config._store.has_blob_storage:
         invocation_contents.is_external = True
         
-        # Write to the blob store
+        # Write to the blob store, keeping images as shared content-addressed blobs.
+        contents_json = externalize_images(json.loads(invocation_contents.model_dump_json()), config._store.blob_store)
         blob_id = config._store.blob_store.store_blob(
-            invocation_contents.model_dump_json().encode('utf-8'),
+            json.dumps(contents_json).encode('utf-8'),
             metadata={'invocation_id': invocation_id}
         )
         invocation_contents = InvocationContents(
@@ -237,3 +395,19 @@ def _write_invocation(func, invocation_id, latency_ms, prompt_tokens, completion
 
     config._store.write_invocation(invocation, consumes)
 
+def _write_samples(func, invocation_ids, latency_ms, prompt_tokens, completion_tokens, state_cache_key,
+                   invocation_api_params, cleaned_invocation_params, consumes, result, parent_invocation_id, sample_group):
+    # Each choice of a batch of samples is recorded as its own invocation, under the id its strings trace to, and
+    # linked to the others by the sample group.
+    # The prompt was processed once for the batch, so its tokens are counted on the first sample, and the completion
+    # tokens, which are only reported for the batch, are split evenly.
+    samples = result if isinstance(result, list) else [result]
+    per_sample, remainder = divmod(completion_tokens, len(samples)) if completion_tokens is not None else (None, None)
+    for index, sample in enumerate(samples):
+        _write_invocation(
+            func, invocation_ids[index], latency_ms,
+            prompt_tokens if index == 0 else 0,
+            per_sample + remainder if index == 0 and per_sample is not None else per_sample,
+            state_cache_key, {**(invocation_api_params or {}), "sample": dict(group=sample_group, batch=invocation_ids[0], index=index)},
+            cleaned_invocation_params, consumes, sample, parent_invocation_id,
+        )
@@ -1,20 +1,27 @@
 from ell.configurator import config
-from ell.lmp._track import _track
+from ell.lmp._track import _track, get_current_invocation, pop_invocation, push_invocation
 from ell.types._lstr import _lstr
 from ell.types import Message, ContentBlock
 from ell.types.message import LMP, InvocableLM, LMPParams, MessageOrDict, _lstr_generic
 from ell.types.studio import LMPType
 from ell.util._warnings import _warnings
-from ell.util.api import  call
+from ell.util.api import RequestTemplate, call
+from ell.util.early_stop import StopCondition
 from ell.util.verbosity import compute_color, model_usage_logger_pre
 
 
 import openai
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+import secrets
 from typing import Any, Dict, Optional, List, Callable, Union
 
-def complex(model: str, client: Optional[openai.Client] = None, exempt_from_tracking=False, tools: Optional[List[Callable]] = None, post_callback: Optional[Callable] = None, **api_params):
+# The most requests of a call to sample that run at once.
+SAMPLE_WORKERS = 16
+
+
+def complex(model: str, client: Optional[openai.Client] = None, exempt_from_tracking=False, tools: Optional[List[Callable]] = None, post_callback: Optional[Callable] = None, stream_tool_calls: bool = False, speculative_tool_execution: bool = False, on_partial: Optional[Callable[[Any], None]] = None, stop_when: Optional[Union[StopCondition, List[StopCondition]]] = None, **api_params):
     """
     A sophisticated language model programming decorator for complex LLM interactions.
 
@@ -28,6 +35,14 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
     :type client: Optional[openai.Client]
     :param tools: A list of tool functions that can be used by the LLM. Only available for certain models.
     :type tools: Optional[List[Callable]]
+    :param stream_tool_calls: If True, responses with tool calls are streamed and each tool call is assembled as soon as its arguments are complete.
+    :type stream_tool_calls: bool
+    :param speculative_tool_execution: If True, each tool call starts executing as soon as its arguments are complete, while the model is still generating later calls. call_tools_and_collect_as_message collects the results. Implies stream_tool_calls.
+    :type speculative_tool_execution: bool
+    :param on_partial: Requires a response_format. Stream the structured output and call this with a validated partial object each time one of its fields is complete.
+    :type on_partial: Optional[Callable[[Any], None]]
+    :param stop_when: Stop a streamed text response early once its text matches: a regex, "json" for the first complete and valid JSON object, a maximum length in characters, a callable taking the text so far, or a list of these. The request is cancelled, the text is truncated where the condition was met, and the stop reason is recorded with the invocation.
+    :type stop_when: Optional[Union[StopCondition, List[StopCondition]]]
     :param response_format: The response format for the LLM. Only available for certain models.
     :type response_format: Optional[Dict[str, Any]]
     :param n: The number of responses to generate for the LLM. Only available for certain models.
@@ -198,6 +213,7 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
     - response.tool_results: Access the list of tool results in the message.
     - response.structured: Access structured data outputs.
     - response.call_tools_and_collect_as_message(): Execute tool calls and collect results.
+    - lmp.sample(k, *args, **kwargs): Generate k samples of the LMP for the same arguments, batched into requests with n.
     - Message(role="user", content=[...]).to_openai_message(): Convert to OpenAI API format.
 
     Notes:
@@ -215,6 +231,8 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
     - ell.studio: For visualizing and analyzing LMP executions.
     """
     default_client_from_decorator = client
+    if on_partial is not None and not api_params.get("response_format"):
+        raise ValueError("on_partial requires a response_format: partial objects are only parsed from structured outputs.")
 
 
     def parameterized_lm_decorator(
@@ -222,12 +240,13 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
     ) -> Callable[..., Union[List[Message], Message]]:
         color = compute_color(prompt)
         _warnings(model, prompt, default_client_from_decorator)
+        request_template = RequestTemplate(api_params)
 
             
         @wraps(prompt)
         def model_call(
             *fn_args,
-            _invocation_origin : str = None,
+            _invocation_origin : Union[str, List[str]] = None,
             client: Optional[openai.Client] = None,
             lm_params: Optional[LMPParams] = {},
             invocation_api_params=False,
@@ -240,11 +259,12 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
 
             if config.verbose and not exempt_from_tracking: model_usage_logger_pre(prompt, fn_args, fn_kwargs, "notimplemented", messages, color)
 
-            (result, _api_params, metadata) = call(model=model, messages=messages, api_params={**config.default_lm_params, **api_params, **lm_params}, client=client or default_client_from_decorator, _invocation_origin=_invocation_origin, _exempt_from_tracking=exempt_from_tracking, _logging_color=color, _name=prompt.__name__, tools=tools)
+            (result, _api_params, metadata) = call(model=model, messages=messages, api_params=request_template.params(lm_params), client=client or default_client_from_decorator, _invocation_origin=_invocation_origin, _exempt_from_tracking=exempt_from_tracking, _logging_color=color, _name=prompt.__name__, tools=tools, stream_tool_calls=stream_tool_calls, speculative_tool_execution=speculative_tool_execution, on_partial=on_partial, stop_when=stop_when)
         
             result = post_callback(result) if post_callback else result
             
-
+            if "stop_reason" in metadata:
+                return result, {**api_params, "stop_reason": metadata["stop_reason"]}, metadata
             return result, api_params, metadata
 
 
@@ -257,10 +277,51 @@ def complex(model: str, client: Optional[openai.Client] = None, exempt_from_trac
         # model_call.__ell_uses__ = prompt.__ell_uses__
         # model_call.__ell_hash__ = prompt.__ell_hash__
 
-        if exempt_from_tracking:
-            return model_call
-        else:
-            return _track(model_call, forced_dependencies=dict(tools=tools))
+        lmp = model_call if exempt_from_tracking else _track(model_call, forced_dependencies=dict(tools=tools))
+
+        def sample(k: int, *fn_args, lm_params: Optional[LMPParams] = None, max_n: Optional[int] = None, **fn_kwargs) -> List[Any]:
+            """
+            Generates k samples of the LMP for the same arguments, e.g. for best-of-k or self-consistency.
+
+            The samples are batched into as few requests as possible using n, capped at the most choices the model
+            supports (see config.register_model), so that the prompt is processed once per batch rather than once per
+            sample. Models that do not support n get one request per sample. The requests run concurrently. Each sample
+            is recorded as its own invocation, which its strings trace to, linked to the others by the sample group in
+            its api params.
+
+            :param k: The number of samples.
+            :param lm_params: Per-call API parameters, as when calling the LMP.
+            :param max_n: Overrides the most choices per request.
+            :return: The k samples, as the LMP would return each of them.
+            """
+            batch_size = max(1, max_n or config.get_max_n_for(model))
+            batches = [min(batch_size, k - start) for start in range(0, k, batch_size)]
+            sample_group = "sample-" + secrets.token_hex(16)
+            parent_invocation_id = get_current_invocation()
+
+            def run_batch(n: int) -> List[Any]:
+                batch_params = {**(lm_params or {}), "n": n}
+                if exempt_from_tracking:
+                    result = lmp(*fn_args, lm_params=batch_params, **fn_kwargs)[0]
+                else:
+                    # Batches run on other threads, which need the invocation that is sampling to link to it.
+                    if parent_invocation_id:
+                        push_invocation(parent_invocation_id)
+                    try:
+                        invocation_ids = ["invocation-" + secrets.token_hex(16) for _ in range(n)]
+                        result = lmp(*fn_args, lm_params=batch_params, _sample=(sample_group, invocation_ids), **fn_kwargs)
+                    finally:
+                        if parent_invocation_id:
+                            pop_invocation()
+                return result if isinstance(result, list) else [result]
+
+            if len(batches) <= 1:
+                return [s for n in batches for s in run_batch(n)]
+            with ThreadPoolExecutor(max_workers=min(len(batches), SAMPLE_WORKERS), thread_name_prefix="ell-sample") as executor:
+                return [s for samples in executor.map(run_batch, batches) for s in samples]
+
+        lmp.sample = sample
+        return lmp
     return parameterized_lm_decorator
 
 def _get_messages(prompt_ret: Union[str, list[MessageOrDict]], prompt: LMP) -> list[Message]:
@@ -269,8 +330,8 @@ def _get_messages(prompt_ret: Union[str, list[MessageOrDict]], prompt: LMP) -> l
     """
     if isinstance(prompt_ret, str):
         return [
-            Message(role="system", content=[ContentBlock(text=_lstr(prompt.__doc__) or config.default_system_prompt)]),
-            Message(role="user", content=[ContentBlock(text=prompt_ret)]),
+            Message._construct(role="system", content=[ContentBlock._construct(text=_lstr(prompt.__doc__ or config.default_system_prompt))]),
+            Message._construct(role="user", content=[ContentBlock._construct(text=prompt_ret if isinstance(prompt_ret, _lstr) else _lstr(prompt_ret))]),
         ]
     else:
         assert isinstance(
@@ -1,10 +1,10 @@
 from functools import wraps
 import json
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, Union
 
-from pydantic import Field, create_model
+from pydantic import Field, ValidationError, create_model
 from pydantic.fields import FieldInfo
-from ell.lmp._track import _track
+from ell.lmp._track import _ensure_versioned, _track
 # from ell.types import ToolFunction, InvocableTool, ToolParams
 # from ell.util.verbosity import compute_color, tool_usage_logger_pre
 from ell.configurator import config
@@ -13,10 +13,12 @@ from ell.types.studio import LMPType
 import inspect
 
 from ell.types.message import ContentBlock, InvocableTool, ToolResult, coerce_content_list
+from ell.util.tool_cache import ToolCache, get_tool_cache, tool_cache_key
+from ell.util.tool_execution import ConcurrencyLimit, run_coroutine
 
 
 
-def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
+def tool(*, exempt_from_tracking: bool = False, timeout: Optional[float] = None, max_concurrency: Optional[int] = None, cache: Union[bool, str, ToolCache, None] = None, **tool_kwargs):
     """
     Defines a tool for use in language model programs (LMPs) that support tool use.
 
@@ -26,6 +28,14 @@ def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
 
     :param exempt_from_tracking: If True, the tool usage won't be tracked. Default is False.
     :type exempt_from_tracking: bool
+    :param timeout: Seconds a call of the tool requested by a language model may take before it is reported as failed.
+    :type timeout: Optional[float]
+    :param max_concurrency: The most calls of the tool to run at once when executing tool calls in parallel.
+    :type max_concurrency: Optional[int]
+    :param cache: Cache the results of a deterministic tool by its params: True or "memory" for an in-process LRU cache,
+        "store" to cache them in the ell store, or a ToolCache such as MemoryToolCache(max_size=..., ttl=...).
+        Cache hits are recorded in the tool's invocation api params.
+    :type cache: Union[bool, str, ToolCache, None]
     :param tool_kwargs: Additional keyword arguments for tool configuration.
     :return: A wrapped version of the original function, usable as a tool by LMs.
     :rtype: Callable
@@ -130,9 +140,26 @@ def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
     - Tools are integrated into LMP calls via the 'tools' parameter in @ell.complex.
     - LMs receive structured tool information, enabling understanding and usage within the conversation context.
     """
+    tool_cache = get_tool_cache(cache)
+
     def tool_decorator(fn: Callable[..., Any]) -> InvocableTool:
         # color = compute_color(fn)
         _under_fn = fn
+        tool_name = f"{fn.__module__}.{fn.__qualname__}"
+
+        def cache_key(fn_args, fn_kwargs) -> Optional[str]:
+            try:
+                bound = inspect.signature(fn).bind(*fn_args, **fn_kwargs)
+                params = wrapper.__ell_params_model__(**bound.arguments)
+            except (TypeError, ValidationError):
+                return None
+            if any(param.kind in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD) and bound.arguments.get(name)
+                   for name, param in bound.signature.parameters.items()):
+                # Variadic arguments are not part of the params model.
+                return None
+            # Re-versioning the tool, e.g. by the watcher, invalidates its results.
+            _ensure_versioned(wrapper, None)
+            return tool_cache_key(tool_name, json.dumps(params.model_dump(mode="json"), sort_keys=True), wrapper.__ell_hash__)
 
         @wraps(fn)
         def wrapper(
@@ -152,9 +179,18 @@ def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
                 pass
                 # tool_usage_logger_pre(fn, fn_args, fn_kwargs, name, color)
 
-            result = fn(*fn_args, **fn_kwargs)
+            key = cache_key(fn_args, fn_kwargs) if tool_cache is not None else None
+            hit, result = tool_cache.get(key) if key is not None else (False, None)
+            if not hit:
+                result = fn(*fn_args, **fn_kwargs)
+                if inspect.isawaitable(result):
+                    result = run_coroutine(result, timeout)
+                if key is not None:
+                    tool_cache.set(key, tool_name, result)
 
             _invocation_api_params = dict(tool_kwargs=tool_kwargs)
+            if tool_cache is not None:
+                _invocation_api_params["tool_cache"] = dict(hit=hit, key=key)
             
             # Here you might want to add logic for tracking the tool usage
             # Similar to how it's done in the lm decorator # Use _invocation_origin
@@ -168,7 +204,7 @@ def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
                     content_results = coerce_content_list(result)
                 except ValueError as e:
                     # XXX: TODO: MOVE TRACKING CODE TO _TRACK AND OUT OF HERE AND API.
-                    content_results = [ContentBlock(text=_lstr(json.dumps(result), _origin_trace=_invocation_origin))]
+                    content_results = [ContentBlock._construct(text=_lstr(json.dumps(result), _origin_trace=_invocation_origin))]
                 
                 # TODO: poolymorphic validation here is important (cant have tool_call or formatted_response in the result)
                 # XXX: Should we put this coercion here or in the tool call/result area.
@@ -191,6 +227,8 @@ def tool(*, exempt_from_tracking: bool = False, **tool_kwargs):
         wrapper.__ell_func__ = _under_fn
         wrapper.__ell_type__ = LMPType.TOOL
         wrapper.__ell_exempt_from_tracking = exempt_from_tracking
+        wrapper.__ell_tool_timeout__ = timeout
+        wrapper.__ell_tool_limit__ = ConcurrencyLimit(max_concurrency) if max_concurrency else None
 
         # Construct the pydantic mdoel for the _under_fn's function signature parameters.
         # 1. Get the function signature.
@@ -30,6 +30,16 @@ import colorama
 
 logger = logging.getLogger(__name__)
 
+# OpenAI scales images to fit within 2048x2048 and then to 768px on the short side,
+# so sending anything larger only costs upload time.
+OPENAI_MAX_IMAGE_RESOLUTION = (2048, 768)
+OPENAI_VISION_MODELS = {
+    'gpt-4o', 'gpt-4o-2024-05-13', 'gpt-4o-2024-08-06', 'gpt-4o-mini', 'gpt-4o-mini-2024-07-18',
+    'gpt-4-turbo', 'gpt-4-turbo-2024-04-09',
+}
+# The most choices a chat completion can generate with n.
+OPENAI_MAX_N = 128
+
 def register(client: openai.Client):
     """
     Register OpenAI models with the provided client.
@@ -76,7 +86,7 @@ def register(client: openai.Client):
         ('gpt-4-0314', 'openai')
     ]
     for model_id, owned_by in model_data:
-        config.register_model(model_id, client)
+        config.register_model(model_id, client, max_image_resolution=OPENAI_MAX_IMAGE_RESOLUTION if model_id in OPENAI_VISION_MODELS else None, max_n=OPENAI_MAX_N)
 
 default_client = None
 try:
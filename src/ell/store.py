@@ -3,13 +3,13 @@ from contextlib import contextmanager
 from datetime import datetime
 from typing import Any, Optional, Dict, List, Set, Union
 from ell.types._lstr import _lstr
-from ell.types import SerializedLMP, Invocation
+from ell.types import CachedToolResult, SerializedLMP, Invocation
 from ell.types.message import InvocableLM
 
 class BlobStore(ABC):
     @abstractmethod
-    def store_blob(self, blob: bytes, metadata: Optional[Dict[str, Any]] = None) -> str:
-        """Store a blob and return its identifier."""
+    def store_blob(self, blob: bytes, metadata: Optional[Dict[str, Any]] = None, blob_id: Optional[str] = None) -> str:
+        """Store a blob and return its identifier. If blob_id is given the blob is content-addressed under that id."""
         pass
 
     @abstractmethod
@@ -17,6 +17,14 @@ class BlobStore(ABC):
         """Retrieve a blob by its identifier."""
         pass
 
+    def has_blob(self, blob_id: str) -> bool:
+        """Check whether a blob with the given identifier has already been stored."""
+        try:
+            self.retrieve_blob(blob_id)
+            return True
+        except FileNotFoundError:
+            return False
+
 class Store(ABC):
     """
     Abstract base class for serializers. Defines the interface for serializing and deserializing LMPs and invocations.
@@ -52,6 +60,27 @@ class Store(ABC):
         """
         pass
 
+    @abstractmethod
+    def lmp_exists(self, lmp_id: str) -> bool:
+        """
+        Check whether an LMP version with the given id has been written.
+        """
+        pass
+
+    @abstractmethod
+    def get_latest_version_number(self, name: str) -> Optional[int]:
+        """
+        Get the highest version number written for an LMP name, or None if no version exists.
+        """
+        pass
+
+    @abstractmethod
+    def update_commit_message(self, lmp_id: str, commit_message: str) -> None:
+        """
+        Set the commit message of an already written LMP. Commit messages are generated after the LMP is written.
+        """
+        pass
+
     @abstractmethod
     def get_cached_invocations(self, lmp_id :str, state_cache_key :str) -> List[Invocation]:
         """
@@ -59,6 +88,21 @@ class Store(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_cached_tool_result(self, cache_key: str, newer_than: Optional[datetime] = None) -> Optional[CachedToolResult]:
+        """
+        Get a tool result cached under the given key, if it was cached after newer_than.
+        """
+        pass
+
+    @abstractmethod
+    def write_cached_tool_result(self, entry: CachedToolResult, max_entries: Optional[int] = None) -> None:
+        """
+        Cache a tool result, replacing any result cached under the same key. If max_entries is given, only that many
+        of the most recent results of the tool are kept.
+        """
+        pass
+
     @abstractmethod
     def get_versions_by_fqn(self, fqn :str) -> List[SerializedLMP]:
         """
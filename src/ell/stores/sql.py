@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 import json
+import logging
 import os
 from typing import Any, Optional, Dict, List, Set, Union
 from pydantic import BaseModel
@@ -8,43 +9,93 @@ import ell.store
 import cattrs
 import numpy as np
 from sqlalchemy.sql import text
-from ell.types import InvocationTrace, SerializedLMP, Invocation, InvocationContents
+from ell.types import CachedToolResult, InvocationTrace, SerializedLMP, SerializedLMPDependency, Invocation, InvocationContents, SharedContent
 from ell.types._lstr import _lstr
-from sqlalchemy import or_, func, and_, extract, FromClause
+from sqlalchemy import or_, func, and_, delete, extract, update, FromClause
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.types import TypeDecorator, VARCHAR
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm.attributes import set_committed_value
 from ell.types.studio import SerializedLMPUses, utc_now
-from ell.util.serialization import pydantic_ltype_aware_cattr
+from ell.util.serialization import MIN_SHARED_TEXT_LENGTH, collect_content_refs, compute_content_hash, externalize_images, extract_shared_content, pydantic_ltype_aware_cattr, resolve_shared_content, split_source_blocks
 import gzip
 import json
 
+logger = logging.getLogger(__name__)
+
+SHARED_CONTENT_FIELDS = ("params", "results", "invocation_api_params")
+VERSION_NUMBER_ATTEMPTS = 5
+
 class SQLStore(ell.store.Store):
     def __init__(self, db_uri: str, blob_store: Optional[ell.store.BlobStore] = None):
-        self.engine = create_engine(db_uri,
-                                    json_serializer=lambda obj: json.dumps(pydantic_ltype_aware_cattr.unstructure(obj), 
-                                     sort_keys=True, default=repr))
+        self.engine = create_engine(db_uri, json_serializer=self._serialize_json)
         
         SQLModel.metadata.create_all(self.engine)
+        self._create_version_index()
         self.open_files: Dict[str, Dict[str, Any]] = {}
         super().__init__(blob_store)
 
+    def _serialize_json(self, obj: Any) -> str:
+        unstructured = pydantic_ltype_aware_cattr.unstructure(obj)
+        if getattr(self, "blob_store", None) is not None:
+            # Images are stored once as content-addressed blobs and referenced from the JSON.
+            unstructured = externalize_images(unstructured, self.blob_store)
+        return json.dumps(unstructured, sort_keys=True, default=repr)
+
+    def _create_version_index(self) -> None:
+        """create_all only creates the indexes of new tables, so databases written by older versions get the index here."""
+        index = next(index for index in SerializedLMP.__table__.indexes if index.name == "ix_serializedlmp_name_version_number")
+        try:
+            index.create(self.engine, checkfirst=True)
+        except Exception as e:
+            # Databases with duplicate version numbers cannot be indexed; version numbers then aren't assigned atomically.
+            logger.warning(f"Could not create a unique index on LMP version numbers: {e}")
+
+    def lmp_exists(self, lmp_id: str) -> bool:
+        with Session(self.engine) as session:
+            return session.exec(select(SerializedLMP.lmp_id).where(SerializedLMP.lmp_id == lmp_id)).first() is not None
+
+    def get_latest_version_number(self, name: str) -> Optional[int]:
+        with Session(self.engine) as session:
+            return session.exec(select(func.max(SerializedLMP.version_number)).where(SerializedLMP.name == name)).one()
+
     def write_lmp(self, serialized_lmp: SerializedLMP, uses: Dict[str, Any]) -> Optional[Any]:
+        dependencies = serialized_lmp.dependencies
+        for attempt in range(VERSION_NUMBER_ATTEMPTS):
+            with Session(self.engine) as session:
+                # Bind the serialized_lmp to the session
+                lmp = session.exec(select(SerializedLMP).filter(SerializedLMP.lmp_id == serialized_lmp.lmp_id)).first()
+                
+                if lmp:
+                    # Already added to the DB.
+                    return lmp
+                else:
+                    serialized_lmp.dependencies = dependencies
+                    self._share_dependencies(session, serialized_lmp)
+                    session.add(serialized_lmp)
+                
+                serialized_lmp.uses = []
+                for use_id in uses:
+                    used_lmp = session.exec(select(SerializedLMP).where(SerializedLMP.lmp_id == use_id)).first()
+                    if used_lmp:
+                        serialized_lmp.uses.append(used_lmp)
+                
+                try:
+                    session.commit()
+                    return None
+                except IntegrityError:
+                    # Another process wrote this version number (or this LMP) first; take the next free version.
+                    session.rollback()
+                    if attempt == VERSION_NUMBER_ATTEMPTS - 1:
+                        raise
+            latest_version = self.get_latest_version_number(serialized_lmp.name)
+            serialized_lmp.version_number = 0 if latest_version is None else latest_version + 1
+
+    def update_commit_message(self, lmp_id: str, commit_message: str) -> None:
         with Session(self.engine) as session:
-            # Bind the serialized_lmp to the session
-            lmp = session.exec(select(SerializedLMP).filter(SerializedLMP.lmp_id == serialized_lmp.lmp_id)).first()
-            
-            if lmp:
-                # Already added to the DB.
-                return lmp
-            else:
-                session.add(serialized_lmp)
-            
-            for use_id in uses:
-                used_lmp = session.exec(select(SerializedLMP).where(SerializedLMP.lmp_id == use_id)).first()
-                if used_lmp:
-                    serialized_lmp.uses.append(used_lmp)
-            
+            session.execute(update(SerializedLMP).where(SerializedLMP.lmp_id == lmp_id).values(commit_message=commit_message))
             session.commit()
-        return None
 
     def write_invocation(self, invocation: Invocation, consumes: Set[str]) -> Optional[Any]:
         with Session(self.engine) as session:
@@ -57,7 +108,8 @@ class SQLStore(ell.store.Store):
             else:
                 lmp.num_invocations += 1
 
-            # Add the invocation contents
+            # Add the invocation contents, storing messages and long text shared with other invocations only once.
+            self._share_contents(session, invocation.contents)
             session.add(invocation.contents)
             
             # Add the invocation
@@ -73,13 +125,162 @@ class SQLStore(ell.store.Store):
             session.commit()
             return None
         
+    def _share_dependencies(self, session: Session, serialized_lmp: SerializedLMP) -> None:
+        """
+        Stores large dependency closures as blocks in the shared content table, so that a closure shared by
+        many LMPs (or many versions of one LMP) is only stored once.
+        """
+        if len(serialized_lmp.dependencies or "") < MIN_SHARED_TEXT_LENGTH:
+            return
+        shared: Dict[str, Any] = {}
+        for position, block in enumerate(split_source_blocks(serialized_lmp.dependencies)):
+            content_hash = compute_content_hash(block)
+            shared[content_hash] = block
+            session.add(SerializedLMPDependency(lmp_id=serialized_lmp.lmp_id, position=position, content_hash=content_hash))
+        self._insert_shared_content(session, shared)
+        serialized_lmp.dependencies = ""
+
+    def _reconstruct_dependencies(self, session: Session, lmps: List[SerializedLMP]) -> None:
+        """Reassembles dependency closures that were split into shared blocks by _share_dependencies."""
+        lmps = [lmp for lmp in lmps if not lmp.dependencies]
+        if not lmps:
+            return
+        rows = session.exec(
+            select(SerializedLMPDependency.lmp_id, SharedContent.value)
+            .join(SharedContent, SharedContent.content_hash == SerializedLMPDependency.content_hash)
+            .where(SerializedLMPDependency.lmp_id.in_([lmp.lmp_id for lmp in lmps]))
+            .order_by(SerializedLMPDependency.lmp_id, SerializedLMPDependency.position)
+        ).all()
+        blocks: Dict[str, List[str]] = {}
+        for lmp_id, block in rows:
+            blocks.setdefault(lmp_id, []).append(block)
+        for lmp in lmps:
+            if lmp.lmp_id in blocks:
+                set_committed_value(lmp, "dependencies", "".join(blocks[lmp.lmp_id]))
+
+    def _share_contents(self, session: Session, contents: InvocationContents) -> None:
+        shared: Dict[str, Any] = {}
+        for field in SHARED_CONTENT_FIELDS:
+            value = getattr(contents, field)
+            if value is not None:
+                setattr(contents, field, extract_shared_content(pydantic_ltype_aware_cattr.unstructure(value), shared))
+        self._insert_shared_content(session, shared)
+
+    def _insert_shared_content(self, session: Session, shared: Dict[str, Any]) -> None:
+        if not shared:
+            return
+        existing = set(session.exec(select(SharedContent.content_hash).where(SharedContent.content_hash.in_(list(shared)))).all())
+        new_rows = [dict(content_hash=h, value=v) for h, v in shared.items() if h not in existing]
+        if not new_rows:
+            return
+        dialect_insert = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}.get(self.engine.dialect.name)
+        if dialect_insert is not None:
+            # Another process may write the same content concurrently.
+            session.execute(dialect_insert(SharedContent).values(new_rows).on_conflict_do_nothing(index_elements=["content_hash"]))
+        else:
+            for row in new_rows:
+                session.add(SharedContent(**row))
+
+    def _rehydrate_contents(self, session: Session, invocations: List[Invocation]) -> None:
+        """Replaces shared content references in the contents of invocations (and the invocations studio nests in them)."""
+        # The nested invocations are loaded a level at a time, with one query per relationship for the whole level
+        # rather than one per invocation, and attached to their relationships so serializing them loads nothing more.
+        visited = set()
+        visited_invocations: Dict[str, Invocation] = {}
+        level = [(invocation, True) for invocation in invocations]
+        while level:
+            level = {(invocation.id, with_consumes): invocation for invocation, with_consumes in level if (invocation.id, with_consumes) not in visited}
+            visited.update(level)
+            expand_uses = {invocation.id: invocation for invocation in level.values() if invocation.id not in visited_invocations}
+            expand_traces = {invocation_id: invocation for (invocation_id, with_consumes), invocation in level.items() if with_consumes}
+            visited_invocations.update(expand_uses)
+
+            uses: Dict[str, List[Invocation]] = {invocation_id: [] for invocation_id in expand_uses}
+            if expand_uses:
+                for used in session.exec(select(Invocation).where(Invocation.used_by_id.in_(list(expand_uses)))).all():
+                    uses[used.used_by_id].append(used)
+                for invocation_id, invocation in expand_uses.items():
+                    set_committed_value(invocation, "uses", uses[invocation_id])
+            next_level = [(used, True) for invocation in level.values() for used in invocation.uses]
+
+            if expand_traces:
+                traces = session.exec(select(InvocationTrace).where(or_(
+                    InvocationTrace.invocation_consumer_id.in_(list(expand_traces)),
+                    InvocationTrace.invocation_consuming_id.in_(list(expand_traces)),
+                ))).all()
+                related_ids = {trace.invocation_consumer_id for trace in traces} | {trace.invocation_consuming_id for trace in traces}
+                related = {invocation.id: invocation for invocation in session.exec(select(Invocation).where(Invocation.id.in_(list(related_ids)))).all()} if related_ids else {}
+                for invocation_id, invocation in expand_traces.items():
+                    consumes = [related[trace.invocation_consumer_id] for trace in traces if trace.invocation_consuming_id == invocation_id]
+                    consumed_by = [related[trace.invocation_consuming_id] for trace in traces if trace.invocation_consumer_id == invocation_id]
+                    set_committed_value(invocation, "consumes", consumes)
+                    set_committed_value(invocation, "consumed_by", consumed_by)
+                    next_level.extend((other, False) for other in consumes + consumed_by)
+            level = next_level
+
+        contents_list = []
+        if visited_invocations:
+            loaded_contents = {contents.invocation_id: contents for contents in session.exec(select(InvocationContents).where(InvocationContents.invocation_id.in_(list(visited_invocations)))).all()}
+            for invocation_id, invocation in visited_invocations.items():
+                contents = loaded_contents.get(invocation_id)
+                set_committed_value(invocation, "contents", contents)
+                if contents is not None:
+                    contents_list.append(contents)
+            lmp_ids = list({invocation.lmp_id for invocation in visited_invocations.values()})
+            # Loaded into the session so each invocation.lmp below is found without a query.
+            session.exec(select(SerializedLMP).where(SerializedLMP.lmp_id.in_(lmp_ids))).all()
+
+        shared: Dict[str, Any] = {}
+        pending = set()
+        for contents in contents_list:
+            for field in SHARED_CONTENT_FIELDS:
+                collect_content_refs(getattr(contents, field), pending)
+        while pending:
+            rows = session.exec(select(SharedContent).where(SharedContent.content_hash.in_(list(pending)))).all()
+            pending = set()
+            for row in rows:
+                shared[row.content_hash] = row.value
+                collect_content_refs(row.value, pending)
+            pending -= shared.keys()
+        self._reconstruct_dependencies(session, list({invocation.lmp_id: invocation.lmp for invocation in visited_invocations.values()}.values()))
+        if not shared:
+            return
+
+        for contents in contents_list:
+            for field in SHARED_CONTENT_FIELDS:
+                value = getattr(contents, field)
+                if value is not None:
+                    # Don't mark the row dirty; the rehydrated value must never be flushed back.
+                    set_committed_value(contents, field, resolve_shared_content(value, shared))
+
     def get_cached_invocations(self, lmp_id :str, state_cache_key :str) -> List[Invocation]:
         with Session(self.engine) as session:
             return self.get_invocations(session, lmp_filters={"lmp_id": lmp_id}, filters={"state_cache_key": state_cache_key})
         
+    def get_cached_tool_result(self, cache_key: str, newer_than: Optional[datetime] = None) -> Optional[CachedToolResult]:
+        with Session(self.engine) as session:
+            query = select(CachedToolResult).where(CachedToolResult.cache_key == cache_key)
+            if newer_than is not None:
+                query = query.where(CachedToolResult.created_at > newer_than)
+            return session.exec(query).first()
+
+    def write_cached_tool_result(self, entry: CachedToolResult, max_entries: Optional[int] = None) -> None:
+        with Session(self.engine) as session:
+            session.merge(entry)
+            if max_entries is not None:
+                session.flush()
+                kept = (select(CachedToolResult.cache_key)
+                        .where(CachedToolResult.tool_name == entry.tool_name)
+                        .order_by(CachedToolResult.created_at.desc())
+                        .limit(max_entries))
+                session.execute(delete(CachedToolResult)
+                                .where(CachedToolResult.tool_name == entry.tool_name)
+                                .where(CachedToolResult.cache_key.not_in(kept)))
+            session.commit()
+
     def get_versions_by_fqn(self, fqn :str) -> List[SerializedLMP]:
         with Session(self.engine) as session:
-            return self.get_lmps(session, name=fqn)
+            return self.get_lmps(session, name=fqn, limit=None)
         
     ## HELPER METHODS FOR ELL STUDIO! :) 
     def get_latest_lmps(self, session: Session, skip: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
@@ -117,6 +318,7 @@ class SQLStore(ell.store.Store):
         query = query.order_by(SerializedLMP.created_at.desc())  # Sort by created_at in descending order
         query = query.offset(skip).limit(limit)
         results = session.exec(query).all()
+        self._reconstruct_dependencies(session, list(results) + [used for lmp in results for used in lmp.uses])
         
         return results
 
@@ -137,6 +339,7 @@ class SQLStore(ell.store.Store):
         query = query.order_by(Invocation.created_at.desc()).offset(skip).limit(limit)
 
         invocations = session.exec(query).all()
+        self._rehydrate_contents(session, invocations)
         return invocations
 
 
@@ -186,7 +389,7 @@ class SQLStore(ell.store.Store):
 
         # Calculate aggregate metrics
         total_invocations = len(data)
-        total_tokens = sum(row.prompt_tokens + row.completion_tokens for row in data)
+        total_tokens = sum((row.prompt_tokens or 0) + (row.completion_tokens or 0) for row in data)
         avg_latency = sum(row.latency_ms for row in data) / total_invocations if total_invocations > 0 else 0
         unique_lmps = len(set(row.lmp_id for row in data))
 
@@ -196,7 +399,7 @@ class SQLStore(ell.store.Store):
             graph_data.append({
                 "date": row.created_at,
                 "avg_latency": row.latency_ms,
-                "tokens": row.prompt_tokens + row.completion_tokens,
+                "tokens": (row.prompt_tokens or 0) + (row.completion_tokens or 0),
                 "count": 1
             })
 
@@ -230,14 +433,23 @@ class SQLBlobStore(ell.store.BlobStore):
     def __init__(self, db_dir: str):
         self.db_dir = db_dir
 
-    def store_blob(self, blob: bytes, metadata: Optional[Dict[str, Any]] = None) -> str:
-        blob_id = f"blob-{utc_now().isoformat()}"
+    def store_blob(self, blob: bytes, metadata: Optional[Dict[str, Any]] = None, blob_id: Optional[str] = None) -> str:
+        blob_id = blob_id or f"blob-{utc_now().isoformat()}"
         file_path = self._get_blob_path(blob_id)
+        if os.path.exists(file_path):
+            # Content-addressed blobs are immutable, so there is nothing to rewrite.
+            return blob_id
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with gzip.open(file_path, "wb") as f:
+        # Write then rename so concurrent writers of the same blob never expose a partial file.
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wb") as f:
             f.write(blob)
+        os.replace(tmp_path, file_path)
         return blob_id
 
+    def has_blob(self, blob_id: str) -> bool:
+        return os.path.exists(self._get_blob_path(blob_id))
+
     def retrieve_blob(self, blob_id: str) -> bytes:
         file_path = self._get_blob_path(blob_id)
         with gzip.open(file_path, "rb") as f:
@@ -1,5 +1,11 @@
+from functools import lru_cache
+from io import BytesIO
+import re
 from typing import Optional, Dict, Any
 
+from PIL import Image as PILImage
+
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlmodel import Session
 from ell.stores.sql import PostgresStore, SQLiteStore
 from ell import __version__
@@ -12,12 +18,15 @@ from ell.studio.connection_manager import ConnectionManager
 from ell.studio.datamodels import InvocationPublicWithConsumes, SerializedLMPWithUses
 
 from ell.types import SerializedLMP
+from ell.util.closure import format_source_for_display
 from datetime import datetime, timedelta
 from sqlmodel import select
 
 
 logger = logging.getLogger(__name__)
 
+IMAGE_ID_PATTERN = re.compile(r"image-[0-9a-f]{64}")
+
 
 from ell.studio.datamodels import InvocationsAggregate
 
@@ -32,6 +41,16 @@ def get_serializer(config: Config):
 
 
 
+def format_lmps_for_display(lmps):
+    """LMPs versioned with source_hash_mode="ast" are stored unformatted, so their source is formatted when served."""
+    for lmp in lmps:
+        for displayed in (lmp, *lmp.uses):
+            # Set without marking the rows dirty so the formatted source is never written back.
+            set_committed_value(displayed, "source", format_source_for_display(displayed.source))
+            set_committed_value(displayed, "dependencies", format_source_for_display(displayed.dependencies))
+    return lmps
+
+
 def create_app(config:Config):
     serializer = get_serializer(config)
 
@@ -73,13 +92,13 @@ def create_app(config:Config):
             session,
             skip=skip, limit=limit,
             )
-        return lmps
+        return format_lmps_for_display(lmps)
 
     # TOOD: Create a get endpoint to efficient get on the index with /api/lmp/<lmp_id>
     @app.get("/api/lmp/{lmp_id}")
     def get_lmp_by_id(lmp_id: str, session: Session = Depends(get_session)):
         lmp = serializer.get_lmps(session, lmp_id=lmp_id)[0]
-        return lmp
+        return format_lmps_for_display([lmp])[0]
 
 
 
@@ -104,7 +123,7 @@ def create_app(config:Config):
             raise HTTPException(status_code=404, detail="LMP not found")
         
         print(lmps[0])
-        return lmps
+        return format_lmps_for_display(lmps)
 
 
 
@@ -172,6 +191,31 @@ def create_app(config:Config):
             logger.error(f"Error retrieving blob: {str(e)}")
             raise HTTPException(status_code=500, detail="Internal server error")
 
+    @lru_cache(maxsize=256)
+    def load_image(image_id: str):
+        image_data = serializer.blob_store.retrieve_blob(image_id)
+        image_format = PILImage.open(BytesIO(image_data)).format
+        return image_data, PILImage.MIME.get(image_format, "application/octet-stream")
+
+    @app.get("/api/image/{image_id}", response_class=Response)
+    def get_image(image_id: str):
+        if serializer.blob_store is None:
+            raise HTTPException(status_code=400, detail="Blob storage is not configured")
+        if not IMAGE_ID_PATTERN.fullmatch(image_id):
+            raise HTTPException(status_code=400, detail="Invalid image id")
+        try:
+            image_data, media_type = load_image(image_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Image not found")
+        except Exception as e:
+            logger.error(f"Error retrieving image: {str(e)}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        # Images are content-addressed so a given id never changes.
+        return Response(content=image_data, media_type=media_type, headers={
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{image_id}"',
+        })
+
     @app.get("/api/lmp-history")
     def get_lmp_history(
         days: int = Query(365, ge=1, le=3650),  # Default to 1 year, max 10 years
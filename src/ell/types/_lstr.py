@@ -1,6 +1,7 @@
 """
 LM string that supports logits and keeps track of it's _origin_trace even after mutation.
 """
+import base64
 import numpy as np
 from typing import (
     Optional,
@@ -20,6 +21,78 @@ from pydantic_core import CoreSchema
 
 from pydantic_core import CoreSchema, core_schema
 
+##################
+## Origin traces ##
+##################
+# Origin traces are interned: every lstr with the same trace shares one frozenset, so fragments of a document (split
+# parts, slices, lines) cost a pointer rather than a copy of the trace. Unions of interned traces are cached, making
+# repeated concatenation and joining of strings from the same invocations a dictionary lookup.
+
+ORIGIN_TRACE_CACHE_SIZE = 4096
+
+_EMPTY_TRACE: FrozenSet[str] = frozenset()
+_interned_traces: dict = {}
+_trace_unions: dict = {}
+
+
+def _intern_trace(trace: Union[str, FrozenSet[str]]) -> FrozenSet[str]:
+    """Returns the shared frozenset for a trace, given as a frozenset or a single invocation id."""
+    interned = _interned_traces.get(trace)
+    if interned is None:
+        if not trace:
+            return _EMPTY_TRACE
+        if len(_interned_traces) >= ORIGIN_TRACE_CACHE_SIZE:
+            # Dropping the table only costs sharing, never correctness.
+            _interned_traces.clear()
+        trace_set = frozenset({trace}) if isinstance(trace, str) else trace
+        interned = _interned_traces.setdefault(trace_set, trace_set)
+        if isinstance(trace, str):
+            _interned_traces[trace] = interned
+    return interned
+
+
+def _union_traces(a: FrozenSet[str], b: FrozenSet[str]) -> FrozenSet[str]:
+    if a is b or not b:
+        return a
+    if not a:
+        return b
+    key = (a, b)
+    union = _trace_unions.get(key)
+    if union is None:
+        union = a if b <= a else _intern_trace(a | b)
+        if len(_trace_unions) >= ORIGIN_TRACE_CACHE_SIZE:
+            _trace_unions.clear()
+        _trace_unions[key] = union
+    return union
+
+
+############
+## Logits ##
+############
+# Logits are the log probabilities of the tokens a string was generated from, held in numpy arrays alongside the
+# character offset at which each token starts. Fragments of a string (slices, split parts, lines) carry views of the
+# arrays covering the tokens that lie entirely within them, and a base to subtract from the shared offsets, so
+# taking them apart never copies the logits.
+
+LOGITS_KEY = "__logits__"
+_LOGITS_ATTRS = ("_logits", "_token_offsets", "_token_base")
+
+
+def _encode_logits(instance: "_lstr") -> dict:
+    """The binary form of an lstr's logits: little-endian float32 logits and int32 token offsets, base64 encoded."""
+    payload = {"logits": base64.b64encode(np.ascontiguousarray(instance._logits, dtype="<f4").tobytes()).decode()}
+    if instance._token_offsets is not None:
+        offsets = np.asarray(instance._token_offsets - instance._token_base, dtype="<i4")
+        payload["token_offsets"] = base64.b64encode(offsets.tobytes()).decode()
+    return payload
+
+
+def _decode_logits(payload: dict) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    logits = np.frombuffer(base64.b64decode(payload["logits"]), dtype="<f4")
+    offsets = payload.get("token_offsets")
+    return logits, (np.frombuffer(base64.b64decode(offsets), dtype="<i4") if offsets is not None else None)
+
+
 class _lstr(str):
     """
     A string class that supports logits and keeps track of its _origin_trace even after mutation.
@@ -73,7 +146,8 @@ class _lstr(str):
         __mul__: Perform a multiplication operation between this lstr instance and an integer or another lstr.
         __rmul__: Perform a right multiplication operation between an integer or another lstr and this lstr instance.
         __getitem__: Get a slice or index of this lstr instance.
-        __getattr__: Get an attribute from this lstr instance.
+        Other str methods returning strings (upper, strip, replace, format, ...) are wrapped once, when the class is
+        created, to return lstr instances carrying the _origin_trace(s) of the string and any lstr arguments.
         join: Join a sequence of strings or lstr instances into a single lstr instance.
         split: Split this lstr instance into a list of lstr instances based on a separator.
         rsplit: Split this lstr instance into a list of lstr instances based on a separator, starting from the right.
@@ -87,6 +161,8 @@ class _lstr(str):
         content: str,
         logits: Optional[np.ndarray] = None,
         _origin_trace: Optional[Union[str, FrozenSet[str]]] = None,
+        _token_offsets: Optional[np.ndarray] = None,
+        _token_base: int = 0,
     ):
         """
         Create a new instance of lstr. The `logits` should be a numpy array and `_origin_trace` should be a frozen set of strings or a single string.
@@ -95,18 +171,27 @@ class _lstr(str):
         content (str): The string content of the lstr.
         logits (np.ndarray, optional): The logits associated with this string. Defaults to None.
         _origin_trace (Union[str, FrozenSet[str]], optional): The _origin_trace(s) of this string. Defaults to None.
+        _token_offsets (np.ndarray, optional): The character offset at which the token of each logit starts, plus _token_base.
+            Without them the logits are dropped by slicing and splitting. Defaults to None.
+        _token_base (int, optional): Subtracted from _token_offsets, letting fragments share their parent's offsets. Defaults to 0.
         """
         instance = super(_lstr, cls).__new__(cls, content)
-        # instance._logits = logits
-        if isinstance(_origin_trace, str):
-            instance.__origin_trace__ = frozenset({_origin_trace})
+        if logits is not None:
+            instance._logits = logits
+            instance._token_offsets = _token_offsets
+            instance._token_base = _token_base
+        if _origin_trace is None:
+            instance.__origin_trace__ = _EMPTY_TRACE
+        elif isinstance(_origin_trace, (str, frozenset)):
+            instance.__origin_trace__ = _intern_trace(_origin_trace)
         else:
-            instance.__origin_trace__ = (
-                frozenset(_origin_trace) if _origin_trace is not None else frozenset()
-            )
+            instance.__origin_trace__ = _intern_trace(frozenset(_origin_trace))
         return instance
 
-    # _logits: Optional[np.ndarray]
+    # Set on the instance only when the string has logits.
+    _logits: Optional[np.ndarray] = None
+    _token_offsets: Optional[np.ndarray] = None
+    _token_base: int = 0
     __origin_trace__: FrozenSet[str]
 
     @classmethod
@@ -116,7 +201,10 @@ class _lstr(str):
         def validate_lstr(value):
             if isinstance(value, dict) and value.get('__lstr', False):
                 content = value['content']
-                _origin_trace = value['__origin_trace__'].split(',')
+                _origin_trace = [trace for trace in value['__origin_trace__'].split(',') if trace]
+                if value.get(LOGITS_KEY):
+                    logits, token_offsets = _decode_logits(value[LOGITS_KEY])
+                    return cls(content, logits, _origin_trace, _token_offsets=token_offsets)
                 return cls(content, _origin_trace=_origin_trace)
             elif isinstance(value, str):
                 return cls(value)
@@ -130,6 +218,9 @@ class _lstr(str):
                 'content': core_schema.typed_dict_field(core_schema.str_schema()),
                 '__origin_trace__': core_schema.typed_dict_field(core_schema.str_schema()),
                 '__lstr': core_schema.typed_dict_field(core_schema.bool_schema()),
+                LOGITS_KEY: core_schema.typed_dict_field(
+                    core_schema.dict_schema(core_schema.str_schema(), core_schema.str_schema()), required=False
+                ),
             }),
             python_schema=core_schema.union_schema([
                 core_schema.is_instance_schema(cls),
@@ -139,7 +230,8 @@ class _lstr(str):
                 lambda instance:  {
                     "content": str(instance),
                     "__origin_trace__": (instance.__origin_trace__),
-                    "__lstr": True
+                    "__lstr": True,
+                    **({LOGITS_KEY: _encode_logits(instance)} if instance._logits is not None else {}),
                 }
             )
         )
@@ -155,6 +247,52 @@ class _lstr(str):
         """
         return self.__origin_trace__
 
+    @property
+    def logits(self) -> Optional[np.ndarray]:
+        """
+        Get the logits of the tokens this lstr instance was generated from.
+
+        Returns:
+            Optional[np.ndarray]: The log probability of each token, or None if the string has no logits.
+        """
+        return self._logits
+
+    @property
+    def token_offsets(self) -> Optional[np.ndarray]:
+        """
+        Get the character offset at which the token of each logit starts.
+
+        Returns:
+            Optional[np.ndarray]: The offsets, aligned with the logits, or None if they are unknown.
+        """
+        if self._token_offsets is None:
+            return None
+        return self._token_offsets - self._token_base
+
+    def _logits_between(self, start: int, stop: int) -> dict:
+        """
+        The logits of the tokens lying entirely within self[start:stop], as views of this instance's arrays.
+
+        Returns:
+            dict: The logits, _token_offsets and _token_base arguments for an lstr holding self[start:stop].
+        """
+        offsets = self._token_offsets
+        if offsets is None:
+            return {}
+        base = self._token_base
+        first = int(np.searchsorted(offsets, base + start, side="left"))
+        # Each token ends where the next one starts, and the last one at the end of the string.
+        last = len(offsets) if stop >= len(self) else int(np.searchsorted(offsets[1:], base + stop, side="right"))
+        last = max(first, last)
+        return dict(logits=self._logits[first:last], _token_offsets=offsets[first:last], _token_base=base + start)
+
+    def _logit_parts(self, parts: Iterable[str], starts: Iterable[int], _origin_trace: FrozenSet[str]) -> List["_lstr"]:
+        """Fragments of this lstr starting at the given offsets, carrying the logits of the tokens within them."""
+        return [
+            _lstr(part, _origin_trace=_origin_trace, **self._logits_between(start, start + len(part)))
+            for part, start in zip(parts, starts)
+        ]
+
     ########################
     ## Overriding methods ##
     ########################
@@ -178,15 +316,7 @@ class _lstr(str):
             lstr: A new lstr instance containing the concatenated content, with the _origin_trace(s) updated accordingly.
         """
         new_content = super(_lstr, self).__add__(other)
-        self_origin = self.__origin_trace__
-        
-        if isinstance(other, _lstr):
-            new_origin = set(self_origin)
-            new_origin.update(other.__origin_trace__)
-            new_origin = frozenset(new_origin)
-        else:
-            new_origin = self_origin
-        
+        new_origin = _union_traces(self.__origin_trace__, other.__origin_trace__) if isinstance(other, _lstr) else self.__origin_trace__
         return _lstr(new_content, None, new_origin)
 
     def __mod__(
@@ -205,15 +335,14 @@ class _lstr(str):
         # If 'other' is a tuple, we need to handle each element
         if isinstance(other, tuple):
             result_content = super(_lstr, self).__mod__(tuple(str(o) for o in other))
-            new__origin_trace__s = set(self.__origin_trace__)
+            new__origin_trace__ = self.__origin_trace__
             for item in other:
                 if isinstance(item, _lstr):
-                    new__origin_trace__s.update(item.__origin_trace__)
-            new__origin_trace__ = frozenset(new__origin_trace__s)
+                    new__origin_trace__ = _union_traces(new__origin_trace__, item.__origin_trace__)
         else:
             result_content = super(_lstr, self).__mod__(other)
             if isinstance(other, _lstr):
-                new__origin_trace__ = self.__origin_trace__.union(other.__origin_trace__)
+                new__origin_trace__ = _union_traces(self.__origin_trace__, other.__origin_trace__)
             else:
                 new__origin_trace__ = self.__origin_trace__
 
@@ -262,55 +391,12 @@ class _lstr(str):
             lstr: A new lstr instance containing the sliced or indexed content, with the _origin_trace(s) preserved.
         """
         result = super(_lstr, self).__getitem__(key)
-        # This is a matter of opinon. I believe that when you Index into a language model output, you or divorcing the lodges of the indexed result from their contacts which produce them. Therefore, it is only reasonable to directly index into the lodges without changing the original context, and so any mutation on the string should invalidate the logits.
-        # try:
-        #     logit_subset = self._logits[key] if self._logits else None
-        # except:
-        #   logit_subset = None
-        logit_subset = None
-        return _lstr(result, logit_subset, self.__origin_trace__)
-
-    def __getattribute__(self, name: str) -> Union[Callable, Any]:
-        """
-        Get an attribute from this lstr instance.
-
-        Args:
-            name (str): The name of the attribute to retrieve.
-
-        Returns:
-            Union[Callable, Any]: The requested attribute, which may be a method or a value.
-        """
-        # Get the attribute from the superclass (str)
-        # First, try to get the attribute from the current class instance
-
-        # Get the attribute using the superclass method
-        attr = super().__getattribute__(name)
-
-        # Check if the attribute is a callable and not defined in lstr class itself
-
-        if name == "__class__":
-            return type(self)
-
-        if callable(attr) and name not in _lstr.__dict__:
-
-            def wrapped(*args: Any, **kwargs: Any) -> Any:
-                result = attr(*args, **kwargs)
-                # If the result is a string, return an lstr instance
-                if isinstance(result, str):
-                    _origin_traces = self.__origin_trace__
-                    for arg in args:
-                        if isinstance(arg, _lstr):
-                            _origin_traces = _origin_traces.union(arg.__origin_trace__)
-                    for key, value in kwargs.items():
-                        if isinstance(value, _lstr):
-                            _origin_traces = _origin_traces.union(value.__origin_trace__)
-                    return _lstr(result, None, _origin_traces)
-
-                return result
-
-            return wrapped
-
-        return attr
+        # Contiguous slices keep the logits of the tokens they fully contain. Any other indexing divorces the result
+        # from the tokens that produced it, and so invalidates the logits.
+        if self._token_offsets is not None and isinstance(key, slice) and key.step in (None, 1):
+            start, stop, _ = key.indices(len(self))
+            return _lstr(result, _origin_trace=self.__origin_trace__, **self._logits_between(start, max(start, stop)))
+        return _lstr(result, None, self.__origin_trace__)
 
     @override
     def join(self, iterable: Iterable[Union[str, "_lstr"]]) -> "_lstr":
@@ -323,12 +409,12 @@ class _lstr(str):
         Returns:
             lstr: A new lstr instance containing the joined content, with the _origin_trace(s) updated accordingly.
         """
-        parts = [str(item) for item in iterable]
-        new_content = super(_lstr, self).join(parts)
+        items = list(iterable)
+        new_content = super(_lstr, self).join([str(item) for item in items])
         new__origin_trace__ = self.__origin_trace__
-        for item in iterable:
+        for item in items:
             if isinstance(item, _lstr):
-                new__origin_trace__ = new__origin_trace__.union(item.__origin_trace__)
+                new__origin_trace__ = _union_traces(new__origin_trace__, item.__origin_trace__)
         return _lstr(new_content, None, new__origin_trace__)
 
     @override
@@ -374,10 +460,15 @@ class _lstr(str):
         Returns:
             List["lstr"]: A list of lstr instances containing the split content, with the _origin_trace(s) preserved.
         """
-        return [
-            _lstr(p, None, self.__origin_trace__)
-            for p in super(_lstr, self).splitlines(keepends=keepends)
-        ]
+        parts = super(_lstr, self).splitlines(keepends=keepends)
+        if self._token_offsets is not None:
+            lines = parts if keepends else super(_lstr, self).splitlines(keepends=True)
+            starts, position = [], 0
+            for line in lines:
+                starts.append(position)
+                position += len(line)
+            return self._logit_parts(parts, starts, self.__origin_trace__)
+        return [_lstr(p, None, self.__origin_trace__) for p in parts]
 
     @override
     def partition(self, sep: Union[str, "_lstr"]) -> Tuple["_lstr", "_lstr", "_lstr"]:
@@ -420,10 +511,14 @@ class _lstr(str):
         """
         part1, part2, part3 = method(sep)
         new__origin_trace__ = (
-            self.__origin_trace__ | sep.__origin_trace__
+            _union_traces(self.__origin_trace__, sep.__origin_trace__)
             if isinstance(sep, _lstr)
             else self.__origin_trace__
         )
+        if self._token_offsets is not None:
+            return tuple(self._logit_parts(
+                (part1, part2, part3), (0, len(part1), len(part1) + len(part2)), new__origin_trace__
+            ))
         return (
             _lstr(part1, None, new__origin_trace__),
             _lstr(part2, None, new__origin_trace__),
@@ -448,14 +543,56 @@ class _lstr(str):
             List["lstr"]: A list of lstr instances containing the split content, with the _origin_trace(s) preserved.
         """
         _origin_traces = (
-            self.__origin_trace__ | sep.__origin_trace__
+            _union_traces(self.__origin_trace__, sep.__origin_trace__)
             if isinstance(sep, _lstr)
             else self.__origin_trace__
         )
         parts = method(sep, maxsplit)
+        if self._token_offsets is not None:
+            starts, position = [], 0
+            for part in parts:
+                # Parts are separated by exactly sep, or by runs of whitespace, which no part starts with.
+                start = position if sep is not None else self.find(part, position)
+                starts.append(start)
+                position = start + len(part) + (len(sep) if sep is not None else 0)
+            return self._logit_parts(parts, starts, _origin_traces)
         return [_lstr(part, None, _origin_traces) for part in parts]
 
 
+# Methods of str that return a new string. Methods returning other types (find, count, startswith, encode, ...) are
+# inherited from str unchanged, and those returning several strings are overridden above.
+_STR_RETURNING_METHODS = (
+    "capitalize", "casefold", "center", "expandtabs", "format", "format_map", "ljust", "lower", "lstrip",
+    "removeprefix", "removesuffix", "replace", "rjust", "rstrip", "strip", "swapcase", "title", "translate",
+    "upper", "zfill",
+)
+
+
+def _wrap_str_method(name: str) -> Callable:
+    method = getattr(str, name)
+
+    def wrapped(self, *args: Any, **kwargs: Any) -> "_lstr":
+        _origin_traces = self.__origin_trace__
+        for arg in args:
+            if isinstance(arg, _lstr):
+                _origin_traces = _union_traces(_origin_traces, arg.__origin_trace__)
+        for value in kwargs.values():
+            if isinstance(value, _lstr):
+                _origin_traces = _union_traces(_origin_traces, value.__origin_trace__)
+        return _lstr(method(self, *args, **kwargs), None, _origin_traces)
+
+    wrapped.__name__ = name
+    wrapped.__qualname__ = f"_lstr.{name}"
+    wrapped.__doc__ = method.__doc__
+    return wrapped
+
+
+for _name in _STR_RETURNING_METHODS:
+    if hasattr(str, _name) and _name not in _lstr.__dict__:
+        setattr(_lstr, _name, _wrap_str_method(_name))
+del _name
+
+
 if __name__ == "__main__":
     import timeit
     import random
@@ -500,11 +637,27 @@ if __name__ == "__main__":
         
         print(f"Joining: lstr: {lstr_time:.6f}s, str: {str_time:.6f}s")
 
+    def test_methods():
+        s = "  " + generate_random_string(1000) + "  "
+        ls = _lstr(s, None, "origin1")
+
+        for name, call in [
+            ("strip", lambda x: x.strip()),
+            ("lower", lambda x: x.lower()),
+            ("replace", lambda x: x.replace("a", "b")),
+            ("startswith", lambda x: x.startswith("  ")),
+            ("len", lambda x: len(x)),
+        ]:
+            lstr_time = timeit.timeit(lambda: call(ls), number=100000)
+            str_time = timeit.timeit(lambda: call(s), number=100000)
+            print(f"{name}: lstr: {lstr_time:.6f}s, str: {str_time:.6f}s")
+
     print("Running performance tests...")
     test_concatenation()
     test_slicing()
     test_splitting()
     test_joining()
+    test_methods()
 
     import cProfile
     import pstats
@@ -7,14 +7,13 @@ import base64
 from io import BytesIO
 from PIL import Image as PILImage
 
-from pydantic import BaseModel, ConfigDict, Field, model_validator, field_validator, field_serializer
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, model_validator, field_validator, field_serializer
 from sqlmodel import Field
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from typing import Any, Callable, Dict, List, Literal, Optional, Type, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Type, Union
 
-from ell.util.serialization import serialize_image
+from ell.util.serialization import encode_image, serialize_image
 _lstr_generic = Union[_lstr, str]
 InvocableTool = Callable[..., Union["ToolResult", _lstr_generic, List["ContentBlock"]]]
 
@@ -26,6 +25,9 @@ class ToolCall(BaseModel):
     tool: InvocableTool
     tool_call_id: Optional[_lstr_generic] = Field(default=None)
     params: Union[Type[BaseModel], BaseModel]
+    # The execution of the call, when it was started as soon as the model produced it.
+    _started: Optional[Any] = PrivateAttr(default=None)
+
     def __call__(self, **kwargs):
         assert not kwargs, "Unexpected arguments provided. Calling a tool uses the params provided in the ToolCall."
 
@@ -40,6 +42,21 @@ class ToolCall(BaseModel):
         return Message(role="user", content=[self.call_and_collect_as_message_block()])
 
 
+CONTENT_BLOCK_FIELDS = ("text", "image", "audio", "tool_call", "parsed", "tool_result")
+
+
+def _check_single_non_null(block: "ContentBlock") -> "ContentBlock":
+    values = block.__dict__
+    non_null_fields = [field for field in CONTENT_BLOCK_FIELDS if values.get(field) is not None]
+    if len(non_null_fields) > 1:  
+        raise ValueError(f"Only one field can be non-null. Found: {', '.join(non_null_fields)}")
+    return block
+
+
+def _image_params_key(image_params: Optional[Dict[str, Any]]) -> Tuple:
+    return tuple(sorted(image_params.items())) if image_params else ()
+
+
 class ContentBlock(BaseModel):
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
@@ -49,13 +66,28 @@ class ContentBlock(BaseModel):
     tool_call: Optional[ToolCall] = Field(default=None)
     parsed: Optional[Union[Type[BaseModel], BaseModel]] = Field(default=None)
     tool_result: Optional[ToolResult] = Field(default=None)
+    # The provider format of the block, as (image params key, converted block). Cleared when the block is mutated.
+    _openai_content_block: Optional[Tuple[Tuple, Any]] = PrivateAttr(default=None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in CONTENT_BLOCK_FIELDS:
+            self._openai_content_block = None
 
     @model_validator(mode='after')
     def check_single_non_null(self):
-        non_null_fields = [field for field, value in self.__dict__.items() if value is not None]
-        if len(non_null_fields) > 1:  
-            raise ValueError(f"Only one field can be non-null. Found: {', '.join(non_null_fields)}")
-        return self
+        return _check_single_non_null(self)
+
+    @classmethod
+    def _construct(cls, **fields) -> "ContentBlock":
+        """
+        Builds a block from a value ell produced or that was already validated, skipping pydantic validation.
+        The single non-null field invariant is still checked in debug mode.
+        """
+        block = cls.model_construct(**fields)
+        if __debug__:
+            _check_single_non_null(block)
+        return block
 
     @property
     def type(self):
@@ -77,14 +109,15 @@ class ContentBlock(BaseModel):
     def coerce(cls, content: Union[str, ToolCall, ToolResult, BaseModel, "ContentBlock", PILImage.Image, np.ndarray]) -> "ContentBlock":
         if isinstance(content, ContentBlock):  
             return content
+        # Strings are wrapped as the validator would, and models need no validation; images are decoded by the validator.
         if isinstance(content, str):  
-            return cls(text=content)
+            return cls._construct(text=content if isinstance(content, _lstr) else _lstr(content))
         if isinstance(content, ToolCall):  
-            return cls(tool_call=content)
+            return cls._construct(tool_call=content)
         if isinstance(content, ToolResult):  
-            return cls(tool_result=content)
+            return cls._construct(tool_result=content)
         if isinstance(content, BaseModel):  
-            return cls(parsed=content)
+            return cls._construct(parsed=content)
         if isinstance(content, (PILImage.Image, np.ndarray)):  
             return cls(image=content)
         raise ValueError(f"Invalid content type: {type(content)}")
@@ -119,9 +152,19 @@ class ContentBlock(BaseModel):
             return None
         return serialize_image(image)
 
-    def to_openai_content_block(self):
+    def to_openai_content_block(self, image_params: Optional[Dict[str, Any]] = None):
+        return self._cached_openai_content_block(image_params)[1]
+
+    def _cached_openai_content_block(self, image_params: Optional[Dict[str, Any]] = None) -> Tuple[Tuple, Any]:
+        key = _image_params_key(image_params)
+        cached = self._openai_content_block
+        if cached is None or cached[0] != key:
+            cached = self._openai_content_block = (key, self._convert_to_openai_content_block(image_params))
+        return cached
+
+    def _convert_to_openai_content_block(self, image_params: Optional[Dict[str, Any]] = None):
         if self.image:  
-            base64_image = self.serialize_image(self.image, None)  
+            base64_image = encode_image(self.image, **(image_params or {}))
             return {
                 "type": "image_url",
                 "image_url": {
@@ -149,17 +192,30 @@ def coerce_content_list(content: Union[str, List[ContentBlock], List[Union[str,
     if not isinstance(content, list):  
         content = [content]
 
-    return [ContentBlock.model_validate(ContentBlock.coerce(c)) for c in content]
+    return [ContentBlock.coerce(c) for c in content]
 
 class Message(BaseModel):
     role: str
     content: List[ContentBlock]
+    # The provider format of the message, as (image params key, cached blocks it was built from, converted message).
+    # Chat histories are resent every turn, so only new or mutated messages are converted again.
+    _openai_message: Optional[Tuple[Tuple, Tuple, Dict[str, Any]]] = PrivateAttr(default=None)
 
     def __init__(self, role, content: Union[str, List[ContentBlock], List[Union[str, ContentBlock, ToolCall, ToolResult, BaseModel]]] = None, **content_block_kwargs):
         content = coerce_content_list(content, **content_block_kwargs)
 
         super().__init__(content=content, role=role)
 
+    @classmethod
+    def _construct(cls, role: str, content: List[ContentBlock]) -> "Message":
+        """Builds a message from content blocks ell produced itself, without coercing or validating them again."""
+        return cls.model_construct(role=role, content=content)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if not name.startswith("_"):
+            self._openai_message = None
+
     @cached_property
     def text(self) -> str:
         return "\n".join(c.text or f"<{c.type}>" for c in self.content)
@@ -180,24 +236,38 @@ class Message(BaseModel):
     def parsed_content(self) -> List[BaseModel]:
         return [c.parsed for c in self.content if c.parsed is not None]
 
-    def call_tools_and_collect_as_message(self, parallel=False, max_workers=None):
-        if parallel:  
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:  
-                futures = [executor.submit(c.tool_call.call_and_collect_as_message_block) for c in self.content if c.tool_call]  
-                content = [future.result() for future in as_completed(futures)]
-        else:  
-            content = [c.tool_call.call_and_collect_as_message_block() for c in self.content if c.tool_call]
-        return Message(role="user", content=content)
-
-    def to_openai_message(self) -> Dict[str, Any]:
+    def call_tools_and_collect_as_message(self, parallel=False, max_workers=None, timeout: Optional[float] = None):
+        """
+        Calls the tools of this message's tool calls and collects their results, in the order of the tool calls, in a
+        user message. A tool call that raises or times out produces a result describing the error.
+
+        Args:
+            parallel (bool): Run the tool calls concurrently on ell's shared tool pool.
+            max_workers (int, optional): The most tool calls to run at once.
+            timeout (float, optional): Seconds each tool call may take, for tools that do not set their own timeout.
+        """
+        from ell.util.tool_execution import execute_tool_calls
+        tool_calls = [c.tool_call for c in self.content if c.tool_call]
+        content = execute_tool_calls(tool_calls, parallel=parallel, max_workers=max_workers, timeout=timeout)
+        return Message._construct(role="user", content=content)
+
+    def to_openai_message(self, image_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        key = _image_params_key(image_params)
+        # Blocks replace their cached conversion when mutated, so comparing them by identity catches mutated,
+        # added and removed blocks alike.
+        blocks = tuple(c._cached_openai_content_block(image_params) for c in self.content)
+        cached = self._openai_message
+        if cached is not None and cached[0] == key and len(cached[1]) == len(blocks) and all(a is b for a, b in zip(cached[1], blocks)):
+            return _copy_openai_message(cached[2])
+
+        # Computed here rather than through the cached properties, which do not see mutations.
+        tool_calls = [c.tool_call for c in self.content if c.tool_call is not None]
+        tool_results = [c.tool_result for c in self.content if c.tool_result is not None]
         message = {
-            "role": "tool" if self.tool_results else self.role,
-            "content": list(filter(None, [
-                c.to_openai_content_block() for c in self.content
-            ]))
+            "role": "tool" if tool_results else self.role,
+            "content": list(filter(None, [block for _, block in blocks]))
         }
-        print(message, self.content)
-        if self.tool_calls:  
+        if tool_calls:  
             message["tool_calls"] = [
                 {
                     "id": tool_call.tool_call_id,
@@ -206,19 +276,27 @@ class Message(BaseModel):
                         "name": tool_call.tool.__name__,
                         "arguments": json.dumps(tool_call.params.model_dump())
                     }
-                } for tool_call in self.tool_calls
+                } for tool_call in tool_calls
             ]
             message["content"] = None  # Set content to null when there are tool calls
 
-        if self.tool_results:  
-            message["tool_call_id"] = self.tool_results[0].tool_call_id  
-            message["content"] = self.tool_results[0].result[0].text  
-            assert len(self.tool_results[0].result) == 1, "Tool result should only have one content block"  
-            assert self.tool_results[0].result[0].type == "text", "Tool result should only have one text content block"  
-        return message
+        if tool_results:  
+            message["tool_call_id"] = tool_results[0].tool_call_id  
+            message["content"] = tool_results[0].result[0].text  
+            assert len(tool_results[0].result) == 1, "Tool result should only have one content block"  
+            assert tool_results[0].result[0].type == "text", "Tool result should only have one text content block"  
+        self._openai_message = (key, blocks, message)
+        return _copy_openai_message(message)
 
 # HELPERS
 
+def _copy_openai_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    # Callers get their own copy of the message and its content blocks, so modifying it leaves the cache intact.
+    message = dict(message)
+    if isinstance(message["content"], list):
+        message["content"] = [dict(block) for block in message["content"]]
+    return message
+
 def system(content: Union[str, List[ContentBlock]]) -> Message:
     """
     Create a system message with the given content.
@@ -76,6 +76,9 @@ class SerializedLMPBase(SQLModel):
 
 
 class SerializedLMP(SerializedLMPBase, table=True):
+    # Version numbers are unique per name; this index also makes looking up the latest version a single index probe.
+    __table_args__ = (Index("ix_serializedlmp_name_version_number", "name", "version_number", unique=True),)
+
     invocations: List["Invocation"] = Relationship(back_populates="lmp")
     used_by: Optional[List["SerializedLMP"]] = Relationship(
         back_populates="uses",
@@ -148,6 +151,31 @@ class InvocationContentsBase(SQLModel):
 class InvocationContents(InvocationContentsBase, table=True):
     invocation: "Invocation" = Relationship(back_populates="contents")
 
+class SharedContent(SQLModel, table=True):
+    """
+    A message or large text segment stored once and referenced by its content hash from invocation contents.
+    """
+    content_hash: str = Field(primary_key=True)
+    value: Optional[Any] = Field(default=None, sa_column=Column(JSON))
+
+class SerializedLMPDependency(SQLModel, table=True):
+    """
+    One block of an LMP's dependency closure. Large closures are stored as an ordered list of shared blocks
+    instead of inline in SerializedLMP.dependencies.
+    """
+    lmp_id: str = Field(foreign_key="serializedlmp.lmp_id", primary_key=True, index=True)
+    position: int = Field(primary_key=True)
+    content_hash: str = Field(foreign_key="sharedcontent.content_hash")
+
+class CachedToolResult(SQLModel, table=True):
+    """
+    The result of a tool call cached by a store-backed tool cache, keyed by a hash of the tool, its version and params.
+    """
+    cache_key: str = Field(primary_key=True)
+    tool_name: str = Field(index=True)
+    result: Optional[Any] = Field(default=None, sa_column=Column(JSON))
+    created_at: datetime = UTCTimestampField(index=True, nullable=False)
+
 class Invocation(InvocationBase, table=True):
     lmp: SerializedLMP = Relationship(back_populates="invocations")
     consumed_by: List["Invocation"] = Relationship(
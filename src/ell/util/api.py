@@ -1,17 +1,22 @@
+from array import array
 from functools import partial
 import json
 
 # import anthropic
 from ell.configurator import config
+import numpy as np
 import openai
 from collections import defaultdict
 from ell.types._lstr import _lstr
 from ell.types import Message, ContentBlock, ToolCall
 
 
-from typing import Any, Dict, Iterable, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
 from ell.types.message import LMP, LMPParams, MessageOrDict
 
+from ell.util.early_stop import EarlyStop, StopCondition
+from ell.util.partial_json import PartialModelParser
+from ell.util.tool_execution import start_tool_call
 from ell.util.verbosity import model_usage_logger_post_end, model_usage_logger_post_intermediate, model_usage_logger_post_start
 from ell.util._warnings import _no_api_key_warning
 
@@ -19,16 +24,159 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def process_messages_for_client(messages: list[Message], client: Any):
+def process_messages_for_client(messages: list[Message], client: Any, model: Optional[str] = None):
     if isinstance(client, openai.Client):
+        image_params = config.get_image_params_for(model)
         return [
-            message.to_openai_message()
+            message.to_openai_message(image_params)
          for message in messages]
     # elif isinstance(client, anthropic.Anthropic):
         # return messages
     # XXX: or some such.
 
 
+def tool_schema(tool: LMP) -> Dict[str, Any]:
+    """The function schema sent to the provider for a tool. Computed once per tool."""
+    schema = getattr(tool, "__ell_tool_schema__", None)
+    if schema is None:
+        schema = tool.__ell_tool_schema__ = {
+            "type": "function",
+            "function": {
+                "name": tool.__name__,
+                "description": tool.__doc__,
+                "parameters": tool.__ell_params_model__.model_json_schema()
+            }
+        }
+    return schema
+
+
+class RequestTemplate:
+    """
+    The static api params of an LMP, merged once over config.default_lm_params, so that a call only merges in its
+    own lm_params. The defaults are remerged whenever they change.
+    """
+    def __init__(self, api_params: Dict[str, Any]):
+        self.api_params = api_params
+        self._defaults: Optional[Dict[str, Any]] = None
+        self._merged: Dict[str, Any] = {}
+
+    def params(self, lm_params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """A new dict of the api params for a call, which the caller is free to mutate."""
+        defaults = config.default_lm_params
+        if self._defaults is None or self._defaults != defaults:
+            self._merged = {**defaults, **self.api_params}
+            self._defaults = dict(defaults)
+        return {**self._merged, **lm_params} if lm_params else dict(self._merged)
+
+
+class _TokenLogprobs:
+    """
+    Accumulates the logprobs of a choice's tokens, as they stream in, into compact arrays aligned with the character
+    offset at which each token starts.
+    """
+    def __init__(self):
+        self.logprobs = array("f")
+        self.offsets = array("i")
+        self.length = 0
+
+    def add(self, text: Optional[str], logprobs: Any) -> None:
+        end = self.length + len(text or "")
+        position = self.length
+        for token in getattr(logprobs, "content", None) or ():
+            # Tokens can split multi-byte characters, so offsets are clamped to the text they arrived with.
+            self.offsets.append(min(position, end))
+            self.logprobs.append(token.logprob)
+            position += len(token.token)
+        self.length = end
+
+    def to_lstr(self, text: str, _origin_trace: str) -> _lstr:
+        if not self.logprobs:
+            return _lstr(content=text, _origin_trace=_origin_trace)
+        # The arrays are views of the accumulated buffers.
+        return _lstr(
+            text,
+            np.frombuffer(self.logprobs, dtype=np.float32),
+            _origin_trace,
+            _token_offsets=np.frombuffer(self.offsets, dtype=np.intc),
+        )
+
+
+class _ToolCallAssembler:
+    """
+    Assembles the tool calls of a streamed choice from their deltas. Each call is built as soon as its arguments are
+    complete: when they parse as a JSON object, when the model moves on to the next call, or when the choice ends.
+    Built calls can start executing right away, while the model is still generating the rest.
+    """
+    def __init__(self, tools: list[LMP], _invocation_origin: str, execute: bool):
+        self.tools = {tool.__name__: tool for tool in tools}
+        self._invocation_origin = _invocation_origin
+        self.execute = execute
+        self.partial: Dict[int, list] = {}
+        self.tool_calls: Dict[int, Optional[ToolCall]] = {}
+
+    def add(self, deltas: Any) -> None:
+        for delta in deltas or ():
+            if delta.index in self.tool_calls:
+                continue
+            partial = self.partial.get(delta.index)
+            if partial is None:
+                # Calls are streamed one after another, so a new call means the previous ones are complete.
+                for index in [index for index in self.partial if index < delta.index]:
+                    self._build(index)
+                partial = self.partial[delta.index] = [None, None, []]
+            if delta.id:
+                partial[0] = delta.id
+            function = delta.function
+            if function is None:
+                continue
+            if function.name:
+                partial[1] = function.name
+            if function.arguments:
+                partial[2].append(function.arguments)
+                if function.arguments.rstrip().endswith("}"):
+                    try:
+                        arguments = json.loads("".join(partial[2]))
+                    except ValueError:
+                        continue
+                    self._build(delta.index, arguments)
+
+    def finish(self) -> None:
+        for index in list(self.partial):
+            self._build(index)
+
+    def _build(self, index: int, arguments: Optional[Dict[str, Any]] = None) -> None:
+        call_id, name, fragments = self.partial.pop(index)
+        tool = self.tools.get(name)
+        self.tool_calls[index] = None
+        if tool is None:
+            return
+        if arguments is None:
+            arguments = json.loads("".join(fragments) or "{}")
+        tool_call = ToolCall(tool=tool, tool_call_id=_lstr(call_id, _origin_trace=self._invocation_origin), params=tool.__ell_params_model__(**arguments))
+        if self.execute:
+            start_tool_call(tool_call)
+        self.tool_calls[index] = tool_call
+
+    def content_blocks(self) -> list[ContentBlock]:
+        self.finish()
+        return [ContentBlock._construct(tool_call=self.tool_calls[index]) for index in sorted(self.tool_calls) if self.tool_calls[index] is not None]
+
+
+def _stream_parsed(client: openai.Client, on_partial: Callable[[Any], None], **api_params) -> Any:
+    """Streams a structured output, reporting partial objects as its fields arrive, and returns the parsed completion."""
+    parser = PartialModelParser(api_params["response_format"])
+    with client.beta.chat.completions.stream(**api_params, stream_options={"include_usage": True}) as stream:
+        for event in stream:
+            if event.type != "chunk":
+                continue
+            for choice in event.chunk.choices:
+                if choice.index == 0 and choice.delta.content:
+                    partial_object = parser.feed(choice.delta.content)
+                    if partial_object is not None:
+                        on_partial(partial_object)
+        return stream.get_final_completion()
+
+
 def call(
     *, 
     model: str,
@@ -36,13 +184,32 @@ def call(
     api_params: Dict[str, Any],
     tools: Optional[list[LMP]] = None,
     client: Optional[openai.Client] = None,
-    _invocation_origin : str,
+    _invocation_origin : Union[str, list[str]],
     _exempt_from_tracking: bool,
     _logging_color=None,
     _name: str = None,
+    stream_tool_calls: bool = False,
+    speculative_tool_execution: bool = False,
+    on_partial: Optional[Callable[[Any], None]] = None,
+    stop_when: Optional[Union[StopCondition, list[StopCondition]]] = None,
 ) -> Tuple[Union[_lstr, Iterable[_lstr]], Optional[Dict[str, Any]]]:
     """
     Helper function to run the language model with the provided messages and parameters.
+
+    With stream_tool_calls, a response with tools is streamed and its tool calls are assembled as they arrive. With
+    speculative_tool_execution, which implies it, each tool call starts executing on the shared tool pool as soon as
+    its arguments are complete; Message.call_tools_and_collect_as_message then collects the results.
+
+    With on_partial and a response_format, the structured output is streamed, and on_partial is called with a
+    progressively validated partial object of the first choice each time one of its fields is complete.
+
+    _invocation_origin can be a list of invocation ids, one per choice, for choices that are recorded as invocations
+    of their own; each choice's strings then trace to its own invocation.
+
+    With stop_when, the text of each streamed choice is checked against the stop conditions as it arrives. Once every
+    choice has met one, the stream is closed, cancelling the request, and each text is truncated where its condition
+    was met. The metadata then records the stop reasons and an estimate of the usage, since the provider never reports
+    the usage of a cancelled request. Responses that are not streamed are not stopped early.
     """
     # Todo: Decide if the client specified via the context amanger default registry is the shit or if the cliennt specified via lmp invocation args are the hing.
     if not client:
@@ -59,32 +226,33 @@ def call(
         raise RuntimeError(_no_api_key_warning(model, _name, client, long=True, error=True))
 
     # todo: add suupport for streaming apis that dont give a final usage in the api
-    # print(api_params)
+    # The params may be shared with the LMP or the caller; they are copied rather than mutated.
+    api_params = dict(api_params)
     if api_params.get("response_format", False):
-        model_call = client.beta.chat.completions.parse
+        model_call = partial(_stream_parsed, client, on_partial) if on_partial else client.beta.chat.completions.parse
         api_params.pop("stream", None)
         api_params.pop("stream_options", None)
     elif tools:
         model_call = client.chat.completions.create
-        api_params["tools"] = [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool.__name__,
-                    "description": tool.__doc__,
-                    "parameters": tool.__ell_params_model__.model_json_schema()
-                }
-            } for tool in tools
-        ]
+        api_params["tools"] = [tool_schema(tool) for tool in tools]
         api_params["tool_choice"] = "auto"
-        api_params.pop("stream", None)
-        api_params.pop("stream_options", None)
+        if stream_tool_calls or speculative_tool_execution:
+            api_params["stream"] = True
+            api_params["stream_options"] = {"include_usage": True}
+        else:
+            api_params.pop("stream", None)
+            api_params.pop("stream_options", None)
     else:
         model_call = client.chat.completions.create
         api_params["stream"] = True
         api_params["stream_options"] = {"include_usage": True}
     
-    client_safe_messages_messages = process_messages_for_client(messages, client)
+    capture_logprobs = not api_params.get("response_format", False) and (config.capture_logprobs or api_params.get("logprobs", False))
+    if capture_logprobs:
+        api_params.setdefault("logprobs", True)
+        capture_logprobs = api_params["logprobs"]
+    
+    client_safe_messages_messages = process_messages_for_client(messages, client, model)
     # print(api_params)
     model_result = model_call(
         model=model, messages=client_safe_messages_messages, **api_params
@@ -94,7 +262,12 @@ def call(
         model_result = [model_result]
 
     choices_progress = defaultdict(list)
+    choices_logprobs = defaultdict(_TokenLogprobs)
+    choices_tool_calls: Dict[int, _ToolCallAssembler] = {}
+    choice_origin = (lambda index: _invocation_origin[index]) if isinstance(_invocation_origin, list) else (lambda index: _invocation_origin)
     n = api_params.get("n", 1)
+    early_stops = defaultdict(partial(EarlyStop, stop_when)) if stop_when and streaming else None
+    streamed_deltas = 0
 
     if config.verbose and not _exempt_from_tracking:
         model_usage_logger_post_start(_logging_color, n)
@@ -109,40 +282,60 @@ def call(
                     continue
             
             for choice in chunk.choices:
+                if early_stops is not None:
+                    if early_stops[choice.index].stopped:
+                        continue
+                    if choice.delta.content:
+                        streamed_deltas += 1
+                        early_stops[choice.index].feed(choice.delta.content)
                 choices_progress[choice.index].append(choice)
+                if capture_logprobs:
+                    choices_logprobs[choice.index].add(choice.delta.content if streaming else choice.message.content, choice.logprobs)
+                if streaming and tools and choice.delta.tool_calls:
+                    if choice.index not in choices_tool_calls:
+                        choices_tool_calls[choice.index] = _ToolCallAssembler(tools, choice_origin(choice.index), speculative_tool_execution)
+                    choices_tool_calls[choice.index].add(choice.delta.tool_calls)
                 if config.verbose and choice.index == 0 and not _exempt_from_tracking:
                     # print(choice, streaming)
                     _logger(choice.delta.content if streaming else 
                         choice.message.content or getattr(choice.message, "refusal", ""), is_refusal=getattr(choice.message, "refusal", False) if not streaming else False)
 
+            if early_stops is not None and len(early_stops) == n and all(early_stop.stopped for early_stop in early_stops.values()):
+                # Closing the stream cancels the request.
+                model_result.close()
+                break
+
     if config.verbose and not _exempt_from_tracking:
         model_usage_logger_post_end()
     n_choices = len(choices_progress)
 
     # coerce the streaming into a final message type
     tracked_results = []
-    for _, choice_deltas in sorted(choices_progress.items(), key=lambda x: x[0]):
+    for index, choice_deltas in sorted(choices_progress.items(), key=lambda x: x[0]):
         content = []
         
         # Handle text content
         if streaming:
             text_content = "".join((choice.delta.content or "" for choice in choice_deltas))
             if text_content:
-                content.append(ContentBlock(
-                    text=_lstr(content=text_content, _origin_trace=_invocation_origin)
-                ))
+                text = choices_logprobs[index].to_lstr(text_content, choice_origin(index))
+                if early_stops is not None and early_stops[index].stopped:
+                    text = text[:early_stops[index].stop_at]
+                content.append(ContentBlock._construct(text=text))
+            if index in choices_tool_calls:
+                content.extend(choices_tool_calls[index].content_blocks())
         else:
             choice = choice_deltas[0].message
             if choice.refusal:
                 raise ValueError(choice.refusal)
                 # XXX: is this the best practice? try catch a parser?
             if api_params.get("response_format", False):
-                content.append(ContentBlock(
+                content.append(ContentBlock._construct(
                     parsed=choice.parsed
                 ))
             elif choice.content:
-                content.append(ContentBlock(
-                    text=_lstr(content=choice.content, _origin_trace=_invocation_origin)
+                content.append(ContentBlock._construct(
+                    text=choices_logprobs[index].to_lstr(choice.content, choice_origin(index))
                 ))
         
         # Handle tool calls
@@ -156,15 +349,24 @@ def call(
                 
                 if matching_tool:
                     params = matching_tool.__ell_params_model__(**json.loads(tool_call.function.arguments))
-                    content.append(ContentBlock(
-                        tool_call=ToolCall(tool=matching_tool, tool_call_id=_lstr(tool_call.id, _origin_trace=_invocation_origin), params=params)
-                    ))
+                    tracked_tool_call = ToolCall(tool=matching_tool, tool_call_id=_lstr(tool_call.id, _origin_trace=choice_origin(index)), params=params)
+                    if speculative_tool_execution:
+                        start_tool_call(tracked_tool_call)
+                    content.append(ContentBlock._construct(tool_call=tracked_tool_call))
         
-        tracked_results.append(Message(
+        tracked_results.append(Message._construct(
             role=choice.role if not streaming else choice_deltas[0].delta.role,
             content=content
         ))
     
+    if early_stops is not None and any(early_stop.stopped for early_stop in early_stops.values()):
+        stop_reasons = [early_stops[index].reason for index in sorted(choices_progress)]
+        metadata["stop_reason"] = stop_reasons[0] if len(stop_reasons) == 1 else stop_reasons
+        if not metadata.get("usage"):
+            # Streamed chunks carry about one token each, and text averages about four characters per token.
+            prompt_tokens = sum(len(message.text_only) for message in messages) // 4
+            metadata["usage"] = dict(prompt_tokens=prompt_tokens, completion_tokens=streamed_deltas, total_tokens=prompt_tokens + streamed_deltas, estimated=True)
+
     api_params = dict(model=model, messages=client_safe_messages_messages, api_params=api_params)
     
     return tracked_results[0] if n_choices == 1 else tracked_results, api_params, metadata
\ No newline at end of file
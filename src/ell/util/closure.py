@@ -30,10 +30,18 @@ def xD():
 """
 import collections
 import ast
+import contextvars
+import functools
 import hashlib
 import itertools
+import json
+import logging
+import marshal
 import os
-from typing import Any, Dict, Iterable, Optional, Set, Tuple, Callable
+import sys
+import threading
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Callable
 import dill
 import inspect
 import types
@@ -41,10 +49,11 @@ from dill.source import getsource
 import importlib.util
 import re
 from collections import deque
-import black
 
 from ell.util.serialization import is_immutable_variable
 
+logger = logging.getLogger(__name__)
+
 DELIM = "$$$$$$$$$$$$$$$$$$$$$$$$$"
 FORBIDDEN_NAMES = ["ell", "lstr"]
 
@@ -84,11 +93,13 @@ def lexical_closure(
     while hasattr(func, "__ell_func__"):
         func = func.__ell_func__
 
-    source = getsource(func, lstrip=True)
+    source = _node_source(func)
     already_closed.add(hash(func))
+    _record_source_file(func)
 
-    globals_and_frees = _get_globals_and_frees(func)
-    dependencies, imports, modules = _process_dependencies(func, globals_and_frees, already_closed, recursion_stack, uses)
+    analysis = _node_analysis(func)
+    globals_and_frees = analysis['globals_and_frees']
+    dependencies, imports, modules = _process_dependencies(func, analysis, already_closed, recursion_stack, uses)
     for k,v in forced_dependencies.items():
         # Todo: dictionary not necessary
         _process_signature_dependency(v, dependencies, already_closed, recursion_stack, uses, k)
@@ -100,55 +111,96 @@ def lexical_closure(
     dirty_src = _build_final_source(imports, module_src, dependencies, source)
     dirty_src_without_func = _build_final_source(imports, module_src, dependencies, "")
 
-    CLOSURE_SOURCE[hash(func)] = dirty_src 
-
     dsrc = _clean_src(dirty_src_without_func)
 
-    # Format the sorce and dsrc soruce using Black
-    source = _format_source(source)
-    dsrc = _format_source(dsrc)
-
-    fn_hash = _generate_function_hash(source, dsrc, func.__qualname__)
+    if _source_hash_mode() == "ast":
+        # Sources are kept as written and only formatted for display; the hash ignores formatting.
+        fn_hash = _generate_function_hash(_canonicalize_source(source), _canonicalize_source(dsrc), func.__qualname__)
+    else:
+        # Format the sorce and dsrc soruce using Black
+        source = _format_source(source)
+        dsrc = _format_source(dsrc)
+        fn_hash = _generate_function_hash(source, dsrc, func.__qualname__)
     
     _update_ell_func(outer_ell_func, source, dsrc, globals_and_frees['globals'], globals_and_frees['frees'], fn_hash, uses)
     
     return (dirty_src, (source, dsrc), ({outer_ell_func} if not initial_call and hasattr(outer_ell_func, "__ell_func__") else uses))
 
 
+@functools.lru_cache(maxsize=1024)
 def _format_source(source: str) -> str:
-    """Format the source code using Black."""
+    """Format the source code using Black. Helpers shared by many LMPs are only formatted once."""
     try:
+        import black
         return black.format_str(source, mode=black.Mode())
     except:
         # If Black formatting fails, return the original source
         return source
 
+def format_source_for_display(source: str) -> str:
+    """Format closure source for display. Closures versioned with source_hash_mode="ast" are stored unformatted."""
+    return _format_source(source)
+
+def _source_hash_mode() -> str:
+    from ell.configurator import config
+    return config.source_hash_mode
+
+# Mutable variables are rendered as `name = <type object>`, which is not valid Python.
+_MUTABLE_VARIABLE_PATTERN = re.compile(r"^(\s*\w+) = (<\w+ object>)$", re.MULTILINE)
+
+@functools.lru_cache(maxsize=1024)
+def _canonicalize_source(source: str) -> str:
+    """A formatting-independent rendering of source: the code is parsed and unparsed, dropping comments and layout."""
+    try:
+        return ast.unparse(ast.parse(_MUTABLE_VARIABLE_PATTERN.sub(r'\1 = "\2"', source)))
+    except SyntaxError:
+        return "\n".join(" ".join(line.split()) for line in source.splitlines() if line.strip())
+
 def _get_globals_and_frees(func: Callable) -> Dict[str, Dict]:
     """Get global and free variables for a function."""
     globals_dict = collections.OrderedDict(globalvars(func))
-    frees_dict = collections.OrderedDict(dill.detect.freevars(func))
     
     if isinstance(func, type):
-        for name, method in collections.OrderedDict(func.__dict__).items():
-            if isinstance(method, (types.FunctionType, types.MethodType)):
-                globals_dict.update(collections.OrderedDict(dill.detect.globalvars(method)))
-                frees_dict.update(collections.OrderedDict(dill.detect.freevars(method)))
+        for name, method in _class_methods(func):
+            globals_dict.update(collections.OrderedDict(dill.detect.globalvars(method)))
     
-    return {'globals': globals_dict, 'frees': frees_dict}
+    return {'globals': globals_dict, 'frees': _get_frees(func)}
 
-def _process_dependencies(func, globals_and_frees, already_closed, recursion_stack, uses):
-    """Process function dependencies."""
-    dependencies = []
+def _get_frees(func: Callable) -> Dict[str, Any]:
+    """Get the free variables of a function, or of the methods of a class."""
+    frees_dict = collections.OrderedDict(dill.detect.freevars(func))
+    if isinstance(func, type):
+        for name, method in _class_methods(func):
+            frees_dict.update(collections.OrderedDict(dill.detect.freevars(method)))
+    return frees_dict
+
+def _class_methods(cls: type) -> List[Tuple[str, Any]]:
+    return [(name, method) for name, method in collections.OrderedDict(cls.__dict__).items() if isinstance(method, (types.FunctionType, types.MethodType))]
+
+def _analyze_variables(globals_and_frees):
+    """Sort the variables of a function into imports, modules, and other variables along with their source. Callables
+    to close over are kept with a source of None."""
+    variables = []
     modules = deque()
     imports = []
+    for var_name, var_value in itertools.chain(globals_and_frees['globals'].items(), globals_and_frees['frees'].items()):
+        _process_variable(var_name, var_value, variables, modules, imports)
+    return variables, imports, modules
+
+def _process_dependencies(func, analysis, already_closed, recursion_stack, uses):
+    """Process function dependencies."""
+    dependencies = []
 
     if isinstance(func, (types.FunctionType, types.MethodType)):
         _process_default_kwargs(func, dependencies, already_closed, recursion_stack, uses)
 
-    for var_name, var_value in itertools.chain(globals_and_frees['globals'].items(), globals_and_frees['frees'].items()):
-        _process_variable(var_name, var_value, dependencies, modules, imports, already_closed, recursion_stack, uses)
+    for var_name, var_value, dependency in analysis['variables']:
+        if dependency is None:
+            _process_callable(var_name, var_value, dependencies, already_closed, recursion_stack, uses)
+        else:
+            dependencies.append(dependency)
 
-    return dependencies, imports, modules
+    return dependencies, list(analysis['imports']), deque(analysis['modules'])
 
 def _process_default_kwargs(func, dependencies, already_closed, recursion_stack, uses):
     """Process default keyword arguments of a function."""
@@ -191,7 +243,7 @@ def _process_signature_dependency(val, dependencies, already_closed, recursion_s
             _raise_error(f"Failed to capture the lexical closure of default parameter {name}", e, recursion_stack)
 
 
-def _process_variable(var_name, var_value, dependencies, modules, imports, already_closed, recursion_stack , uses):
+def _process_variable(var_name, var_value, variables, modules, imports):
     """Process a single variable."""
     try:
         name = inspect.getmodule(var_value).__name__
@@ -202,44 +254,46 @@ def _process_variable(var_name, var_value, dependencies, modules, imports, alrea
         pass
     
     if isinstance(var_value, (types.FunctionType, type, types.MethodType)):
-        _process_callable(var_name, var_value, dependencies, already_closed, recursion_stack, uses)
+        if _should_close_over(var_name, var_value):
+            variables.append((var_name, var_value, None))
     elif isinstance(var_value, types.ModuleType):
-        _process_module(var_name, var_value, modules, imports, uses)
+        _process_module(var_name, var_value, modules, imports)
     elif isinstance(var_value, types.BuiltinFunctionType):
         imports.append(dill.source.getimport(var_value, alias=var_name))
     else:
-        _process_other_variable(var_name, var_value, dependencies, uses)
+        variables.append((var_name, var_value, _process_other_variable(var_name, var_value)))
 
-def _process_callable(var_name, var_value, dependencies, already_closed, recursion_stack, uses):
-    """Process a callable (function, method, or class)."""
+def _should_close_over(var_name, var_value) -> bool:
     try: 
         module_is_ell = 'ell' in inspect.getmodule(var_value).__name__
     except:
         module_is_ell = False
+    return var_name not in FORBIDDEN_NAMES and not module_is_ell
 
-    if var_name not in FORBIDDEN_NAMES and not module_is_ell:
-        try:
-            dep, _, _uses = lexical_closure(var_value, already_closed=already_closed, recursion_stack=recursion_stack.copy())
-            dependencies.append(dep)
-            uses.update(_uses)
-        except Exception as e:
-            _raise_error(f"Failed to capture the lexical closure of global or free variable {var_name}", e, recursion_stack)
+def _process_callable(var_name, var_value, dependencies, already_closed, recursion_stack, uses):
+    """Process a callable (function, method, or class)."""
+    try:
+        dep, _, _uses = lexical_closure(var_value, already_closed=already_closed, recursion_stack=recursion_stack.copy())
+        dependencies.append(dep)
+        uses.update(_uses)
+    except Exception as e:
+        _raise_error(f"Failed to capture the lexical closure of global or free variable {var_name}", e, recursion_stack)
 
-def _process_module(var_name, var_value, modules, imports, uses):
+def _process_module(var_name, var_value, modules, imports):
     """Process a module."""
     if should_import(var_value.__name__):
         imports.append(dill.source.getimport(var_value, alias=var_name))
     else:
         modules.append((var_name, var_value))
 
-def _process_other_variable(var_name, var_value, dependencies, uses):
-    """Process variables that are not callables or modules."""
+def _process_other_variable(var_name, var_value) -> str:
+    """The source of a variable that is not a callable or module."""
     if isinstance(var_value, str) and '\n' in var_value:
-        dependencies.append(f"{var_name} = '''{var_value}'''")
+        return f"{var_name} = '''{var_value}'''"
     elif is_immutable_variable(var_value):
-        dependencies.append(f"#<BV>\n{var_name} = {repr(var_value)}\n#</BV>")
+        return f"#<BV>\n{var_name} = {repr(var_value)}\n#</BV>"
     else:
-        dependencies.append(f"#<BmV>\n{var_name} = <{type(var_value).__name__} object>\n#</BmV>")
+        return f"#<BmV>\n{var_name} = <{type(var_value).__name__} object>\n#</BmV>"
 
 def _build_initial_source(imports, dependencies, source):
     """Build the initial source code."""
@@ -250,6 +304,7 @@ def _process_modules(modules, cur_src, already_closed, recursion_stack, uses):
     reverse_module_src = deque()
     while modules:
         mname, mval = modules.popleft()
+        _record_source_file(mval)
         mdeps = []
         attrs_to_extract = get_referenced_names(cur_src.replace(DELIM, ""), mname)
         for attr in attrs_to_extract:
@@ -294,13 +349,10 @@ def _generate_function_hash(source, dsrc, qualname):
     return "lmp-" + hashlib.md5("\n".join((source, dsrc, qualname)).encode()).hexdigest()
 
 def _update_ell_func(outer_ell_func, source, dsrc, globals_dict, frees_dict, fn_hash, uses):
-    """Update the ell function attributes."""
-    formatted_source = _format_source(source)
-    formatted_dsrc = _format_source(dsrc)
-    
+    """Update the ell function attributes. source and dsrc are expected to already be formatted."""
     if hasattr(outer_ell_func, "__ell_func__"):
         
-        outer_ell_func.__ell_closure__ = (formatted_source, formatted_dsrc, globals_dict, frees_dict)
+        outer_ell_func.__ell_closure__ = (source, dsrc, globals_dict, frees_dict)
         outer_ell_func.__ell_hash__ = fn_hash
         outer_ell_func.__ell_uses__ = uses
 
@@ -348,17 +400,136 @@ def get_referenced_names(code: str, module_name: str):
     Returns:
     list: A list of all attributes of the module that are referenced in the code.
     """
-    tree = ast.parse(code)
-    referenced_names = []
-
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Attribute):
-            if isinstance(node.value, ast.Name) and node.value.id == module_name:
-                referenced_names.append(node.attr)
-
-    return referenced_names
+    return list(_referenced_attributes(code).get(module_name, ()))
+
+@functools.lru_cache(maxsize=1024)
+def _referenced_attributes(code: str) -> Dict[str, Tuple[str, ...]]:
+    """Parse code once and map every name to the attributes referenced on it, in order of appearance."""
+    referenced = collections.defaultdict(list)
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name):
+            referenced[node.value.id].append(node.attr)
+    return {name: tuple(attrs) for name, attrs in referenced.items()}
+
+########################
+## Closure node cache ##
+########################
+# The same helper functions, classes and module attributes are reached from the closures of many LMPs. Their
+# analysis is shared process-wide so that versioning cost scales with the number of unique functions: their source
+# (dill's getsource), their global and free variables and how each is captured (imports, variable sources and the
+# callables to close over), as well as AST parses and Black formatting. Only the assembly of each LMP's closure from
+# these is repeated, as what a helper contributes depends on what its LMP already closed over. Entries are keyed
+# weakly on the function object and bounded in size. Analyses are checked against the code objects and the global
+# and free variable bindings they were computed from, so a rebound name or replaced code is analysed again.
+
+CLOSURE_NODE_CACHE_SIZE = 4096
+
+_node_sources: "collections.OrderedDict[int, Tuple[weakref.ref, str]]" = collections.OrderedDict()
+_node_analyses: "collections.OrderedDict[int, Tuple[weakref.ref, Dict[str, Any]]]" = collections.OrderedDict()
+_node_cache_lock = threading.RLock()
+_UNBOUND = object()
+
+def _node_source(func) -> str:
+    return _cached_node(_node_sources, func, lambda: (getsource(func, lstrip=True), True))
+
+def _node_analysis(func) -> Dict[str, Any]:
+    return _cached_node(_node_analyses, func, lambda: _analyze_node(func), _node_analysis_is_current)
+
+def _cached_node(cache, func, compute: Callable[[], Tuple[Any, bool]], is_current: Optional[Callable[[Any, Any], bool]] = None):
+    key = id(func)
+    with _node_cache_lock:
+        entry = cache.get(key)
+        if entry is not None and entry[0]() is func:
+            cache.move_to_end(key)
+            value = entry[1]
+        else:
+            value = None
+    if value is not None and (is_current is None or is_current(func, value)):
+        return value
 
-CLOSURE_SOURCE: Dict[str, str] = {}
+    value, cacheable = compute()
+    if not cacheable:
+        return value
+    try:
+        ref = weakref.ref(func, functools.partial(_evict_node, cache, key))
+    except TypeError:
+        return value
+
+    with _node_cache_lock:
+        cache[key] = (ref, value)
+        cache.move_to_end(key)
+        while len(cache) > CLOSURE_NODE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return value
+
+def _evict_node(cache, key: int, ref: weakref.ref) -> None:
+    with _node_cache_lock:
+        entry = cache.get(key)
+        # The id may already have been reused by a newer object.
+        if entry is not None and entry[0] is ref:
+            del cache[key]
+
+def _analyze_node(func) -> Tuple[Dict[str, Any], bool]:
+    globals_and_frees = _get_globals_and_frees(func)
+    variables, imports, modules = _analyze_variables(globals_and_frees)
+    bindings = _node_bindings(func, globals_and_frees['globals'])
+    analysis = {
+        'globals_and_frees': globals_and_frees,
+        'variables': tuple(variables),
+        'imports': tuple(imports),
+        'modules': tuple(modules),
+        'codes': _node_codes(func, globals_and_frees),
+        'bindings': bindings,
+    }
+    return analysis, bindings is not None
+
+def _node_codes(func, globals_and_frees: Dict[str, Dict]) -> Tuple[Any, ...]:
+    # The code objects of the function, or the methods of the class, and of the functions and methods it refers to.
+    # Patching code in place replaces them.
+    functions = [method for _, method in _class_methods(func)] if isinstance(func, type) else [func]
+    codes = [getattr(function, "__code__", None) for function in functions]
+    for value in itertools.chain(globals_and_frees["globals"].values(), globals_and_frees["frees"].values()):
+        members = vars(value).values() if isinstance(value, type) else (value,)
+        codes.extend(getattr(member, "__code__", None) for member in members)
+    return tuple(codes)
+
+def _node_bindings(func, globals_dict: Dict[str, Any]) -> Optional[Tuple[Tuple[Dict[str, Any], str, Any], ...]]:
+    # The module globals the function, or the methods of the class, look up by name, and what each was bound to,
+    # including names that were not bound yet. None when some global variables were not found there, i.e. came from
+    # the closures of functions of other modules, which are not cached.
+    functions = [method for _, method in _class_methods(func)] if isinstance(func, type) else [func]
+    namespaces = [getattr(function, "__globals__", None) for function in functions]
+    namespaces = [namespace for namespace in namespaces if namespace is not None]
+    bindings = []
+    for function in functions:
+        code, namespace = getattr(function, "__code__", None), getattr(function, "__globals__", None)
+        if code is not None and namespace is not None:
+            bindings.extend((namespace, name, namespace.get(name, _UNBOUND)) for name in dill.detect.nestedglobals(code))
+    for name, value in globals_dict.items():
+        namespace = next((namespace for namespace in namespaces if namespace.get(name, _UNBOUND) is value), None)
+        if namespace is None:
+            return None
+        bindings.append((namespace, name, value))
+    return tuple(bindings)
+
+def _node_analysis_is_current(func, analysis: Dict[str, Any]) -> bool:
+    if not all(namespace.get(name, _UNBOUND) is value for namespace, name, value in analysis['bindings']):
+        return False
+    frees = _get_frees(func)
+    cached_frees = analysis['globals_and_frees']['frees']
+    if frees.keys() != cached_frees.keys() or any(frees[name] is not value for name, value in cached_frees.items()):
+        return False
+    codes = _node_codes(func, analysis['globals_and_frees'])
+    return len(codes) == len(analysis['codes']) and all(a is b for a, b in zip(codes, analysis['codes']))
+
+def invalidate_closure_cache() -> None:
+    """Forget all cached closure analysis, e.g. after source files changed on disk."""
+    with _node_cache_lock:
+        _node_sources.clear()
+        _node_analyses.clear()
+    _format_source.cache_clear()
+    _canonicalize_source.cache_clear()
+    _referenced_attributes.cache_clear()
 
 def lexically_closured_source(func, forced_dependencies: Optional[Dict[str, Any]] = None):
     """
@@ -402,9 +573,163 @@ def lexically_closured_source(func, forced_dependencies: Optional[Dict[str, Any]
     """
     if not callable(func):
         raise ValueError("Input must be a callable object (function, method, or class).")
-    _, fnclosure, uses = lexical_closure(func, initial_call=True, recursion_stack=[], forced_dependencies=forced_dependencies)
+
+    cache_key = _closure_cache_key(func, forced_dependencies)
+    if cache_key is not None and _load_cached_closure(func, cache_key):
+        return func.__ell_closure__, func.__ell_uses__
+
+    source_files = set()
+    token = _source_files_recorder.set(source_files)
+    try:
+        _, fnclosure, uses = lexical_closure(func, initial_call=True, recursion_stack=[], forced_dependencies=forced_dependencies)
+    finally:
+        _source_files_recorder.reset(token)
+    func.__ell_source_files__ = frozenset(source_files)
+    func.__ell_code__ = _code_snapshot(func)
+
+    if cache_key is not None:
+        _store_cached_closure(func, cache_key, source_files)
     return func.__ell_closure__, uses
 
+###############################
+## Persistent closure cache ##
+###############################
+# Computing a closure (getsource, AST walks, find_spec, Black) is repeated by every process that imports an LMP.
+# When config.closure_cache_dir is set, the result is persisted keyed on the function's code, its source file and
+# mtime and a fingerprint of the variables it closes over, and restored without recomputation in later processes.
+# Every other source file the closure was built from is recorded and revalidated by mtime when loading. The recorded
+# files are also kept on the function as __ell_source_files__ for ell.util.watcher, along with the code objects the
+# closure was built from as __ell_code__.
+
+_source_files_recorder: contextvars.ContextVar[Optional[Set[str]]] = contextvars.ContextVar("_source_files_recorder", default=None)
+
+def _record_source_file(obj):
+    recorder = _source_files_recorder.get()
+    if recorder is None:
+        return
+    try:
+        path = inspect.getsourcefile(obj)
+    except TypeError:
+        path = None
+    if path:
+        recorder.add(os.path.abspath(path))
+
+def _code_snapshot(func, globals_and_frees: Optional[Dict[str, Dict]] = None) -> Tuple[Any, ...]:
+    # The code objects of the LMP and of the functions and methods it refers to. Patching code in place replaces them.
+    inner = func
+    while hasattr(inner, "__ell_func__"):
+        inner = inner.__ell_func__
+    return _node_codes(inner, globals_and_frees or _node_analysis(inner)['globals_and_frees'])
+
+def _file_fingerprint(path: str) -> Optional[List[Any]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+def _variable_fingerprint(value) -> str:
+    # Mirrors what _process_other_variable bakes into the closure source: values of immutable variables
+    # and only the type of everything else. Functions, classes and modules are covered by source files.
+    if isinstance(value, (types.FunctionType, types.MethodType, types.ModuleType, type, types.BuiltinFunctionType)):
+        return ""
+    if is_immutable_variable(value):
+        return repr(value)
+    return f"<{type(value).__name__} object>"
+
+def _closure_cache_key(func, forced_dependencies: Optional[Dict[str, Any]]) -> Optional[str]:
+    from ell.configurator import config
+    if not config.closure_cache_dir or not hasattr(func, "__ell_func__"):
+        return None
+
+    inner = func
+    while hasattr(inner, "__ell_func__"):
+        inner = inner.__ell_func__
+    code = getattr(inner, "__code__", None)
+    source_file = inspect.getsourcefile(inner) if code is not None else None
+    file_fingerprint = _file_fingerprint(os.path.abspath(source_file)) if source_file else None
+    if code is None or file_fingerprint is None or "<locals>" in inner.__qualname__:
+        return None
+
+    from ell.__version__ import __version__
+    globals_and_frees = _get_globals_and_frees(inner)
+    hasher = hashlib.sha256()
+    hasher.update(marshal.dumps(code))
+    for part in (__version__, config.source_hash_mode, inner.__module__, inner.__qualname__, json.dumps(file_fingerprint)):
+        hasher.update(part.encode("utf-8"))
+    for scope in ("globals", "frees"):
+        for name, value in globals_and_frees[scope].items():
+            hasher.update(f"{scope}:{name}={_variable_fingerprint(value)}".encode("utf-8"))
+    for name, value in (forced_dependencies or {}).items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        hasher.update(f"forced:{name}={[_qualified_name(v) for v in values]}".encode("utf-8"))
+    return hasher.hexdigest()
+
+def _qualified_name(obj) -> Optional[Tuple[str, str]]:
+    module, qualname = getattr(obj, "__module__", None), getattr(obj, "__qualname__", None)
+    if not module or not qualname or "<locals>" in qualname:
+        return None
+    return (module, qualname)
+
+def _resolve_qualified_name(module: str, qualname: str) -> Optional[Any]:
+    obj = sys.modules.get(module)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr, None)
+    return obj
+
+def _cache_path(cache_key: str) -> str:
+    from ell.configurator import config
+    return os.path.join(config.closure_cache_dir, cache_key[:2], f"{cache_key}.json")
+
+def _load_cached_closure(func, cache_key: str) -> bool:
+    try:
+        with open(_cache_path(cache_key), "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if any(_file_fingerprint(path) != [path, mtime_ns, size] for path, mtime_ns, size in entry["files"]):
+        return False
+    uses = set()
+    for module, qualname in entry["uses"]:
+        used = _resolve_qualified_name(module, qualname)
+        if used is None or not hasattr(used, "__ell_func__"):
+            return False
+        uses.add(used)
+    for used in uses:
+        if not hasattr(used, "__ell_hash__"):
+            lexically_closured_source(used)
+
+    inner = func
+    while hasattr(inner, "__ell_func__"):
+        inner = inner.__ell_func__
+    globals_and_frees = _get_globals_and_frees(inner)
+    _update_ell_func(func, entry["source"], entry["dsrc"], globals_and_frees["globals"], globals_and_frees["frees"], entry["hash"], uses)
+    func.__ell_source_files__ = frozenset(path for path, _, _ in entry["files"])
+    func.__ell_code__ = _code_snapshot(func, globals_and_frees)
+    return True
+
+def _store_cached_closure(func, cache_key: str, source_files: Set[str]) -> None:
+    uses = [_qualified_name(used) for used in func.__ell_uses__]
+    if None in uses:
+        # Closures using LMPs we couldn't look up again can't be restored.
+        return
+    files = [_file_fingerprint(path) for path in sorted(source_files)]
+    if None in files:
+        return
+    entry = dict(source=func.__ell_closure__[0], dsrc=func.__ell_closure__[1], hash=func.__ell_hash__, uses=uses, files=files)
+
+    path = _cache_path(cache_key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrently starting workers never read a partial entry.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.debug(f"Failed to write closure cache entry for {func.__qualname__}: {e}")
+
 import ast
 
 def _clean_src(dirty_src):
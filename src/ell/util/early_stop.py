@@ -0,0 +1,83 @@
+"""
+Client-side early stopping of streamed responses.
+
+Stop conditions are evaluated on the accumulating text of each streamed choice. Once every choice has met one, the
+stream is closed, which cancels the request, and the text is truncated where the condition was met. This saves the
+tokens and latency of generating text after the useful answer, for example once an extraction has produced its JSON.
+"""
+import json
+import re
+from typing import Callable, List, Optional, Pattern, Sequence, Union
+
+from ell.util.partial_json import PartialObjectParser
+
+# A regex, "json" for the first complete and valid JSON object, a maximum length in characters, or a callable
+# taking the accumulated text and returning whether to stop.
+StopCondition = Union[str, Pattern, int, Callable[[str], bool]]
+
+
+class EarlyStop:
+    """
+    Evaluates stop conditions on the text of a streamed choice as it accumulates.
+
+    Args:
+        conditions (Union[StopCondition, Sequence[StopCondition]]): The conditions. The choice stops at the first
+            condition met.
+    """
+
+    def __init__(self, conditions: Union[StopCondition, Sequence[StopCondition]]):
+        if isinstance(conditions, (str, re.Pattern, int)) or callable(conditions):
+            conditions = [conditions]
+        self._checks: List[Callable[[], bool]] = []
+        for condition in conditions:
+            if isinstance(condition, bool) or not isinstance(condition, (str, re.Pattern, int)) and not callable(condition):
+                raise ValueError(f"Invalid stop condition: {condition!r}. Use a regex, 'json', a maximum length or a callable.")
+            if condition == "json":
+                self._json = PartialObjectParser(parse_members=False)
+                self._checks.append(self._check_json)
+            elif isinstance(condition, int):
+                self._checks.append(lambda max_length=condition: self._check_max_length(max_length))
+            elif isinstance(condition, (str, re.Pattern)):
+                self._checks.append(lambda pattern=re.compile(condition): self._check_regex(pattern))
+            else:
+                self._checks.append(lambda predicate=condition: self._check_callable(predicate))
+        self.text = ""
+        # Why the choice stopped, and the length of its text up to where it stopped.
+        self.reason: Optional[str] = None
+        self.stop_at: Optional[int] = None
+
+    @property
+    def stopped(self) -> bool:
+        return self.reason is not None
+
+    def feed(self, delta: str) -> bool:
+        """Adds the next piece of text and returns whether the choice should stop."""
+        if self.stopped:
+            return True
+        self.text += delta
+        return any(check() for check in self._checks)
+
+    def _stop(self, reason: str, stop_at: int) -> bool:
+        self.reason, self.stop_at = reason, stop_at
+        return True
+
+    def _check_max_length(self, max_length: int) -> bool:
+        return len(self.text) >= max_length and self._stop(f"max_length:{max_length}", max_length)
+
+    def _check_regex(self, pattern: Pattern) -> bool:
+        match = pattern.search(self.text)
+        return match is not None and self._stop(f"regex:{pattern.pattern}", match.end())
+
+    def _check_callable(self, predicate: Callable[[str], bool]) -> bool:
+        return bool(predicate(self.text)) and self._stop(f"callable:{getattr(predicate, '__name__', repr(predicate))}", len(self.text))
+
+    def _check_json(self) -> bool:
+        checked = len(self._json.objects)
+        self._json.feed(self.text[len(self._json.text):])
+        for start, end in self._json.objects[checked:]:
+            try:
+                json.loads(self.text[start:end])
+            except ValueError:
+                continue
+            return self._stop("json", end)
+        return False
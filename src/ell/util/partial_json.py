@@ -0,0 +1,119 @@
+"""
+Incremental parsing of JSON objects streamed by structured outputs.
+
+The scanner only looks at the new text of each delta, tracking string and nesting state, and notes where each
+top-level member of the object ends. Complete members are parsed and validated against the response model on their
+own, so a partial object is available as soon as each field arrives without reparsing the document on every delta.
+"""
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+_JSON_STRUCTURE = re.compile(r'[\\"{}\[\],]')
+
+
+class PartialObjectParser:
+    """
+    Finds the complete top-level members of a JSON object as its text streams in.
+
+    Args:
+        parse_members (bool): Parse the members of the object. Without it, the parser only tracks where top-level
+            objects start and end.
+    """
+
+    def __init__(self, parse_members: bool = True):
+        self.parse_members = parse_members
+        # The (start, end) spans of the complete top-level objects in the text.
+        self.objects: List[Tuple[int, int]] = []
+        self.text = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._skip_until = 0
+        self._member_start: Optional[int] = None
+        self._object_start: Optional[int] = None
+
+    def feed(self, delta: str) -> List[Tuple[str, Any]]:
+        """
+        Scans the next piece of the object.
+
+        Returns:
+            List[Tuple[str, Any]]: The members completed by this delta, as parsed keys and values.
+        """
+        self.text += delta
+        completed = []
+        for match in _JSON_STRUCTURE.finditer(self.text, self._position):
+            i, char = match.start(), match.group()
+            if i < self._skip_until:
+                continue
+            if self._depth == 0 and char != "{":
+                # Text around the object, such as prose before it, is not JSON.
+                continue
+            if self._in_string:
+                if char == "\\":
+                    # The escaped character may arrive in a later delta.
+                    self._skip_until = i + 2
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1 and char == "{":
+                    self._member_start = i + 1
+                    self._object_start = i
+            elif char in "}]":
+                if self._depth == 1 and self._member_start is not None:
+                    completed += self._parse_member(i)
+                    self.objects.append((self._object_start, i + 1))
+                    self._member_start = self._object_start = None
+                self._depth -= 1
+            elif self._depth == 1 and self._member_start is not None:
+                completed += self._parse_member(i)
+                self._member_start = i + 1
+        self._position = len(self.text)
+        return completed
+
+    def _parse_member(self, end: int) -> List[Tuple[str, Any]]:
+        member = self.text[self._member_start:end]
+        if not self.parse_members or not member.strip():
+            return []
+        return list(json.loads("{" + member + "}").items())
+
+
+class PartialModelParser:
+    """
+    Builds progressively validated partial instances of a structured output from its streamed JSON.
+
+    Each complete field is validated on its own and set on the partial instance; fields that have not arrived yet are
+    unset. Response formats that are not pydantic models produce partial dicts.
+    """
+
+    def __init__(self, response_format: Union[Type[BaseModel], Any]):
+        self.model = response_format if isinstance(response_format, type) and issubclass(response_format, BaseModel) else None
+        self.partial: Union[BaseModel, Dict[str, Any]] = self.model.model_construct() if self.model else {}
+        self._parser = PartialObjectParser()
+
+    def feed(self, delta: str) -> Optional[Union[BaseModel, Dict[str, Any]]]:
+        """Returns a snapshot of the partial object if the delta completed any of its fields, and None otherwise."""
+        updated = False
+        for name, value in self._parser.feed(delta):
+            if self.model is None:
+                self.partial[name] = value
+            else:
+                try:
+                    self.model.__pydantic_validator__.validate_assignment(self.partial, name, value)
+                except ValidationError as e:
+                    logger.debug(f"Partial value of {self.model.__name__}.{name} did not validate: {e}")
+                    continue
+            updated = True
+        if not updated:
+            return None
+        # Callers get a snapshot, which later fields do not change.
+        return self.partial.model_copy() if self.model else dict(self.partial)
@@ -1,14 +1,21 @@
 
 # Global converter
 import base64
+from collections import OrderedDict
+import dataclasses
+import enum
+from functools import lru_cache
 import hashlib
 from io import BytesIO
 import json
+import re
+import threading
+from typing import Any, List, Optional, Set, Tuple
 import cattrs
 import numpy as np
 from pydantic import BaseModel
 import PIL
-from ell.types._lstr import _lstr
+from ell.types._lstr import _LOGITS_ATTRS, LOGITS_KEY, _encode_logits, _lstr
 
 
 pydantic_ltype_aware_cattr = cattrs.Converter()
@@ -33,6 +40,110 @@ def serialize_image(img):
     img.save(buffer, format="PNG")
     return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
 
+
+ENCODED_IMAGE_CACHE_SIZE = 128
+_encoded_image_cache: "OrderedDict[Tuple, str]" = OrderedDict()
+_encoded_image_cache_lock = threading.Lock()
+
+
+def preprocess_image(img, max_resolution: Optional[Tuple[int, int]] = None):
+    """
+    Downscales an image so that its long side is at most max_resolution[0] and its short side at most
+    max_resolution[1]. Providers resize larger images server side anyway, so anything above this is wasted upload.
+    """
+    if not max_resolution:
+        return img
+    max_long, max_short = max_resolution
+    width, height = img.size
+    scale = min(1.0, max_long / max(width, height), max_short / min(width, height))
+    if scale >= 1.0:
+        return img
+    return img.resize((max(1, round(width * scale)), max(1, round(height * scale))), PIL.Image.LANCZOS)
+
+
+def encode_image(img, format: str = "PNG", quality: Optional[int] = None, max_resolution: Optional[Tuple[int, int]] = None) -> str:
+    """
+    Encodes an image as a data url for an outgoing request, downscaling it to max_resolution and encoding it
+    with the given format and quality. Encoded images are memoized by pixel content, so resending the same
+    image (e.g. in every turn of a chat) skips the encoding entirely.
+    """
+    format = format.upper()
+    key = (compute_image_hash(img), format, quality, tuple(max_resolution) if max_resolution else None)
+    with _encoded_image_cache_lock:
+        if key in _encoded_image_cache:
+            _encoded_image_cache.move_to_end(key)
+            return _encoded_image_cache[key]
+
+    img = preprocess_image(img, max_resolution)
+    if format == "PNG" and quality is None:
+        data_url = serialize_image(img)
+    else:
+        if format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        save_kwargs = {"quality": quality} if quality is not None else {}
+        buffer = BytesIO()
+        img.save(buffer, format=format, **save_kwargs)
+        data_url = f"data:image/{format.lower()};base64," + base64.b64encode(buffer.getvalue()).decode()
+
+    with _encoded_image_cache_lock:
+        _encoded_image_cache[key] = data_url
+        if len(_encoded_image_cache) > ENCODED_IMAGE_CACHE_SIZE:
+            _encoded_image_cache.popitem(last=False)
+    return data_url
+
+
+def compute_image_hash(img) -> str:
+    """
+    Computes a content hash of an image from its pixels, so the same image hashes identically
+    no matter how (or how many times) it was encoded.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode('utf-8'))
+    hasher.update(img.tobytes())
+    return hasher.hexdigest()
+
+
+IMAGE_DATA_URL_PREFIX = "data:image/"
+IMAGE_BLOB_PREFIX = "image-"
+
+
+@lru_cache(maxsize=256)
+def _image_id_for_data_url(data_url: str) -> str:
+    # Decoding the pixels is the expensive part, and the same data url is typically
+    # serialized several times per invocation (params, results, api params).
+    _, encoded = data_url.split(",", 1)
+    img = PIL.Image.open(BytesIO(base64.b64decode(encoded)))
+    return IMAGE_BLOB_PREFIX + compute_image_hash(img)
+
+
+def _externalize_data_url(data_url: str, blob_store):
+    try:
+        image_id = _image_id_for_data_url(data_url)
+    except Exception:
+        # Not actually an image we can decode; leave it inline.
+        return None
+    if not blob_store.has_blob(image_id):
+        _, encoded = data_url.split(",", 1)
+        blob_store.store_blob(base64.b64decode(encoded), metadata={'type': 'image'}, blob_id=image_id)
+    return {"__image_id__": image_id, "__limage": True}
+
+
+def externalize_images(obj, blob_store):
+    """
+    Replaces inline base64 images in an unstructured (JSON ready) object with references to
+    content-addressed blobs in the blob store. Images are keyed by a hash of their pixels, so an image
+    used across many invocations is stored exactly once.
+    """
+    if isinstance(obj, dict):
+        if obj.get("__limage") and isinstance(obj.get("content"), str) and obj["content"].startswith(IMAGE_DATA_URL_PREFIX):
+            return _externalize_data_url(obj["content"], blob_store) or obj
+        return {k: externalize_images(v, blob_store) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [externalize_images(item, blob_store) for item in obj]
+    elif isinstance(obj, str) and obj.startswith(IMAGE_DATA_URL_PREFIX):
+        return _externalize_data_url(obj, blob_store) or obj
+    return obj
+
 pydantic_ltype_aware_cattr.register_unstructure_hook(
     PIL.Image.Image,
     lambda obj: {
@@ -41,8 +152,22 @@ pydantic_ltype_aware_cattr.register_unstructure_hook(
     }
 )
 
+ORIGIN_TRACE_KEY = "__origin_trace__"
+
+
+def serialize_origin_trace(origin_trace) -> str:
+    """The canonical serialized form of an origin trace: its invocation ids, sorted and joined by commas."""
+    return ",".join(sorted(origin_trace))
+
+
+def _lstr_logits_fields(obj) -> dict:
+    # Logits are stored in their binary form rather than as lists of floats.
+    return {LOGITS_KEY: _encode_logits(obj)} if obj._logits is not None else {}
+
+
 def unstructure_lstr(obj):
-    return dict(content=str(obj), **obj.__dict__, __lstr=True)
+    fields = {k: v for k, v in obj.__dict__.items() if k not in _LOGITS_ATTRS}
+    return dict(content=str(obj), **{**fields, ORIGIN_TRACE_KEY: serialize_origin_trace(obj.__origin_trace__)}, **_lstr_logits_fields(obj), __lstr=True)
 
 pydantic_ltype_aware_cattr.register_unstructure_hook(
     _lstr,
@@ -56,59 +181,216 @@ pydantic_ltype_aware_cattr.register_unstructure_hook(
 # Register hooks for complex types (deserialization)
 
 
+def _immutable_value(obj):
+    if isinstance(obj, (int, float, str, bool, type(None))):
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return [_immutable_value(item) if not isinstance(item, (int, float, str, bool, type(None))) else item for item in obj]
+    elif isinstance(obj, dict):
+        return {k: _immutable_value(v) if not isinstance(v, (int, float, str, bool, type(None))) else v for k, v in obj.items()}
+    elif isinstance(obj, (set, frozenset)):
+        return list(sorted(_immutable_value(item) if not isinstance(item, (int, float, str, bool, type(None))) else item for item in obj))
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    else:
+        return f"<Object of type {type(obj).__name__}>"
+
+
 def get_immutable_vars(vars_dict):
-    converter = cattrs.Converter()
+    return _immutable_value(vars_dict)
 
-    def handle_complex_types(obj):
-        if isinstance(obj, (int, float, str, bool, type(None))):
-            return obj
-        elif isinstance(obj, (list, tuple)):
-            return [handle_complex_types(item) if not isinstance(item, (int, float, str, bool, type(None))) else item for item in obj]
-        elif isinstance(obj, dict):
-            return {k: handle_complex_types(v) if not isinstance(v, (int, float, str, bool, type(None))) else v for k, v in obj.items()}
-        elif isinstance(obj, (set, frozenset)):
-            return list(sorted(handle_complex_types(item) if not isinstance(item, (int, float, str, bool, type(None))) else item for item in obj))
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
+
+def _may_change(value) -> bool:
+    """Whether the rendering of a closure variable can change after the closure was computed, i.e. it is a mutable container."""
+    if isinstance(value, (tuple, frozenset)):
+        return any(_may_change(item) for item in value)
+    return isinstance(value, (list, dict, set, np.ndarray))
+
+
+def _vars_json_parts(vars_dict) -> List:
+    """
+    Splits json.dumps(get_immutable_vars(vars_dict), sort_keys=True, default=repr) into pre-rendered bytes for
+    variables that cannot change and the values of mutable containers, which have to be rendered on every use.
+    """
+    parts, static = [], "{"
+    for i, name in enumerate(sorted(vars_dict)):
+        static += ("" if i == 0 else ", ") + json.dumps(name) + ": "
+        value = vars_dict[name]
+        if _may_change(value):
+            parts += [static.encode('utf-8'), value]
+            static = ""
         else:
-            return f"<Object of type {type(obj).__name__}>"
+            static += json.dumps(_immutable_value(value), sort_keys=True, default=repr)
+    parts.append((static + "}").encode('utf-8'))
+    return parts
+
+
+STATE_CACHE_KEY_PARTS_CACHE_SIZE = 1024
+_state_cache_key_parts: "OrderedDict[int, Tuple[Tuple, List]]" = OrderedDict()
+_state_cache_key_parts_lock = threading.Lock()
+
 
-    converter.register_unstructure_hook(object, handle_complex_types)
-    x = converter.unstructure(vars_dict)
-    return x
+def _closure_state_parts(fn_closure) -> List:
+    # Closures are replaced (not mutated) when an LMP is re-versioned, so the parts are computed once per version.
+    key = id(fn_closure)
+    with _state_cache_key_parts_lock:
+        entry = _state_cache_key_parts.get(key)
+        if entry is not None and entry[0] is fn_closure:
+            _state_cache_key_parts.move_to_end(key)
+            return entry[1]
+
+    parts = _vars_json_parts(fn_closure[2]) + _vars_json_parts(fn_closure[3])
+    with _state_cache_key_parts_lock:
+        _state_cache_key_parts[key] = (fn_closure, parts)
+        if len(_state_cache_key_parts) > STATE_CACHE_KEY_PARTS_CACHE_SIZE:
+            _state_cache_key_parts.popitem(last=False)
+    return parts
 
 
 def compute_state_cache_key(ipstr, fn_closure):
-    _global_free_vars_str = f"{json.dumps(get_immutable_vars(fn_closure[2]), sort_keys=True, default=repr)}"
-    _free_vars_str = f"{json.dumps(get_immutable_vars(fn_closure[3]), sort_keys=True, default=repr)}"
-    state_cache_key = hashlib.sha256(f"{ipstr}{_global_free_vars_str}{_free_vars_str}".encode('utf-8')).hexdigest()
-    return state_cache_key
+    """
+    Hashes the invocation params together with the global and free variables of the closure. Only mutable
+    containers among the variables are serialized per call; everything else was rendered once per LMP version.
+    """
+    hasher = hashlib.sha256(ipstr.encode('utf-8'))
+    for part in _closure_state_parts(fn_closure):
+        if isinstance(part, bytes):
+            hasher.update(part)
+        else:
+            hasher.update(json.dumps(_immutable_value(part), sort_keys=True, default=repr).encode('utf-8'))
+    return hasher.hexdigest()
 
 
-def prepare_invocation_params(params):
-    invocation_params = params
+def _json_key(key) -> str:
+    # The key json.dumps would write for a dict key.
+    if isinstance(key, str):
+        return str(key)
+    if isinstance(key, (bool, int, float)) or key is None:
+        return json.dumps(key)
+    return repr(key)
+
+
+def _unstructure_params(obj, consumes: Set[str]) -> Any:
+    """
+    Converts invocation params into their JSON form in a single pass, as unstructuring them with
+    pydantic_ltype_aware_cattr and round tripping through json.dumps(default=repr) would, while collecting
+    the ids of the invocations that produced any _lstr within them.
+    """
+    if isinstance(obj, _lstr):
+        consumes.update(obj.__origin_trace__)
+        fields = {k: _unstructure_params(v, consumes) for k, v in obj.__dict__.items() if k != ORIGIN_TRACE_KEY and k not in _LOGITS_ATTRS}
+        return dict(content=str(obj), **fields, **{ORIGIN_TRACE_KEY: serialize_origin_trace(obj.__origin_trace__)}, **_lstr_logits_fields(obj), __lstr=True)
+    if isinstance(obj, enum.Enum):
+        return _unstructure_params(obj.value, consumes)
+    if isinstance(obj, str):
+        return str(obj)
+    if obj is None or isinstance(obj, (bool, int, float)):
+        return obj
+    if isinstance(obj, dict):
+        unstructured = {}
+        for k, v in obj.items():
+            if k == ORIGIN_TRACE_KEY and isinstance(v, (set, frozenset)):
+                # _lstrs dumped by pydantic models
+                consumes.update(v)
+                unstructured[k] = serialize_origin_trace(v)
+            else:
+                unstructured[_json_key(k)] = _unstructure_params(v, consumes)
+        return unstructured
+    if isinstance(obj, (list, tuple)):
+        return [_unstructure_params(item, consumes) for item in obj]
+    if isinstance(obj, (set, frozenset)):
+        return [_unstructure_params(item, consumes) for item in sorted(obj)]
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, PIL.Image.Image):
+        return {"content": serialize_image(obj), "__limage": True}
+    if isinstance(obj, BaseModel):
+        return _unstructure_params(obj.model_dump(exclude_none=True, exclude_unset=True), consumes)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return {field.name: _unstructure_params(getattr(obj, field.name), consumes) for field in dataclasses.fields(obj)}
+    return repr(obj)
 
-    cleaned_invocation_params = pydantic_ltype_aware_cattr.unstructure(invocation_params)
-    
-    # Thisis because we wneed the caching to work on the hash of a cleaned and serialized object.
-    jstr = json.dumps(cleaned_invocation_params, sort_keys=True, default=repr)
 
+def prepare_invocation_params(params):
     consumes = set()
-    import re
-    # XXX: Better than registering a hook in cattrs.
-    pattern = r'"__origin_trace__":\s*"frozenset\({(.+?)}\)"'
-    
-    # Find all matches in the jstr
-    matches = re.findall(pattern, jstr)
-    
-    # Process each match and add to consumes set
-    for match in matches:
-        # Remove quotes and spaces, then split by comma
-        items = [item.strip().strip("'") for item in match.split(',')]
-        consumes.update(items)
-    consumes = list(consumes)
-    # XXX: Only need to reload because of 'input' caching., we could skip this by making ultimate model caching rather than input hash caching; if prompt same use the same output.. irrespective of version.
-    return json.loads(jstr), jstr, consumes
+    cleaned_invocation_params = _unstructure_params(params, consumes)
+    # The invocation cache is keyed on the hash of the cleaned and serialized params.
+    jstr = json.dumps(cleaned_invocation_params, sort_keys=True, default=repr)
+    return cleaned_invocation_params, jstr, list(consumes)
+
+
+CONTENT_REF_KEY = "__content_ref__"
+# Strings shorter than this are cheaper to store inline than to reference.
+MIN_SHARED_TEXT_LENGTH = 512
+
+
+def _is_message_like(obj) -> bool:
+    return isinstance(obj, dict) and "role" in obj and "content" in obj
+
+
+def compute_content_hash(obj) -> str:
+    return "content-" + hashlib.sha256(json.dumps(obj, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+def extract_shared_content(obj, shared):
+    """
+    Replaces messages and long text segments in an unstructured (JSON ready) object with references to
+    their content hash, collecting the referenced values into `shared`. A system prompt or chat history
+    repeated across invocations then only needs to be stored once.
+
+    Values are processed bottom up, so a shared message may itself reference shared text. Images are left
+    alone; they are deduplicated separately by externalize_images.
+    """
+    if isinstance(obj, dict):
+        if obj.get("__limage"):
+            return obj
+        processed = {k: extract_shared_content(v, shared) for k, v in obj.items()}
+        if not _is_message_like(processed):
+            return processed
+    elif isinstance(obj, list):
+        return [extract_shared_content(item, shared) for item in obj]
+    elif isinstance(obj, str) and len(obj) >= MIN_SHARED_TEXT_LENGTH and not obj.startswith(IMAGE_DATA_URL_PREFIX):
+        processed = obj
+    else:
+        return obj
+
+    content_hash = compute_content_hash(processed)
+    shared[content_hash] = processed
+    return {CONTENT_REF_KEY: content_hash}
+
+
+def split_source_blocks(source: str) -> List[str]:
+    """
+    Splits source code into top level blocks (separated by blank lines) such that "".join(blocks) == source.
+    Blocks are the unit at which dependency closures are shared between LMPs.
+    """
+    return [block for block in re.split(r"(?<=\n\n)(?=\S)", source) if block]
+
+
+def collect_content_refs(obj, refs=None):
+    """Collects the content hashes referenced anywhere in obj."""
+    refs = set() if refs is None else refs
+    if isinstance(obj, dict):
+        if CONTENT_REF_KEY in obj and len(obj) == 1:
+            refs.add(obj[CONTENT_REF_KEY])
+        else:
+            for v in obj.values():
+                collect_content_refs(v, refs)
+    elif isinstance(obj, list):
+        for item in obj:
+            collect_content_refs(item, refs)
+    return refs
+
+
+def resolve_shared_content(obj, shared):
+    """Inverse of extract_shared_content: replaces references with their values from `shared`."""
+    if isinstance(obj, dict):
+        if CONTENT_REF_KEY in obj and len(obj) == 1 and obj[CONTENT_REF_KEY] in shared:
+            return resolve_shared_content(shared[obj[CONTENT_REF_KEY]], shared)
+        return {k: resolve_shared_content(v, shared) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [resolve_shared_content(item, shared) for item in obj]
+    return obj
 
 
 def is_immutable_variable(value):
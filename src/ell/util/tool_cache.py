@@ -0,0 +1,142 @@
+"""
+Result caches for deterministic tools.
+
+A tool defined with @ell.tool(cache=...) looks its results up by its version and the canonical JSON dump of its
+validated params, so a call the model repeats, within a conversation or across them, does not run the tool again,
+while editing the tool invalidates its results. Results are cached in memory, or in the store where they outlive the
+process and are shared between processes.
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import copy
+from datetime import timedelta
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Optional, Tuple, Union
+
+from ell.configurator import config
+from ell.store import Store
+from ell.types.studio import CachedToolResult, utc_now
+
+logger = logging.getLogger(__name__)
+
+
+class ToolCache(ABC):
+    """A cache of tool results, keyed by tool_cache_key."""
+
+    @abstractmethod
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Look up a result.
+
+        Returns:
+            Tuple[bool, Any]: Whether the result was cached, and the result.
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: str, tool_name: str, result: Any) -> None:
+        """Cache the result of a tool call."""
+        pass
+
+
+class MemoryToolCache(ToolCache):
+    """
+    An in-process LRU cache of tool results. Results are copied in and out, so callers mutating a result do not change
+    what later calls get.
+
+    Args:
+        max_size (int): The most results to keep. The least recently used are evicted first.
+        ttl (float, optional): Seconds a result stays valid. Defaults to forever.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._results: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return False, None
+            expires_at, result = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._results[key]
+                return False, None
+            self._results.move_to_end(key)
+        return True, copy.deepcopy(result)
+
+    def set(self, key: str, tool_name: str, result: Any) -> None:
+        try:
+            result = copy.deepcopy(result)
+        except Exception:
+            logger.debug(f"Not caching the result of {tool_name}: it cannot be copied.")
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._results[key] = (expires_at, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+
+class StoreToolCache(ToolCache):
+    """
+    A cache of tool results kept in an ell store. Only results that round trip through JSON unchanged are cached.
+
+    Args:
+        store (Store, optional): The store to cache results in. Defaults to the store set with ell.init.
+        max_size (int, optional): The most results to keep per tool. The oldest are deleted first.
+        ttl (float, optional): Seconds a result stays valid. Defaults to forever.
+    """
+
+    def __init__(self, store: Optional[Store] = None, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.store = store
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        store = self.store or config._store
+        if store is None:
+            return False, None
+        newer_than = utc_now() - timedelta(seconds=self.ttl) if self.ttl is not None else None
+        entry = store.get_cached_tool_result(key, newer_than=newer_than)
+        if entry is None:
+            return False, None
+        return True, entry.result
+
+    def set(self, key: str, tool_name: str, result: Any) -> None:
+        store = self.store or config._store
+        if store is None:
+            return
+        try:
+            cacheable = json.loads(json.dumps(result)) == result
+        except (TypeError, ValueError):
+            cacheable = False
+        if not cacheable:
+            logger.debug(f"Not caching the result of {tool_name} in the store: it is not plain JSON.")
+            return
+        entry = CachedToolResult(cache_key=key, tool_name=tool_name, result=result, created_at=utc_now())
+        store.write_cached_tool_result(entry, max_entries=self.max_size)
+
+
+def get_tool_cache(cache: Union[bool, str, ToolCache, None]) -> Optional[ToolCache]:
+    """Resolves the cache option of @ell.tool: True or "memory", "store", or a ToolCache."""
+    if cache is None or cache is False:
+        return None
+    if cache is True or cache == "memory":
+        return MemoryToolCache()
+    if cache == "store":
+        return StoreToolCache()
+    if isinstance(cache, ToolCache):
+        return cache
+    raise ValueError(f"Invalid tool cache: {cache!r}. Use True, 'memory', 'store' or a ToolCache.")
+
+
+def tool_cache_key(tool_name: str, params_json: str, version: Optional[str] = None) -> str:
+    return "toolcache-" + hashlib.sha256(f"{tool_name}\0{version or ''}\0{params_json}".encode("utf-8")).hexdigest()
@@ -0,0 +1,243 @@
+"""
+Execution of the tool calls a language model asks for.
+
+Tool calls run on a pool shared by every message, rather than one created per call. Coroutine tools run on a shared
+event loop. Each call can be given a timeout, and each tool a limit on how many of its calls run at once. Calls held
+back by a limit wait in a queue rather than on a pool thread, so a batch limited to a few calls at a time does not
+slow down others. Results come back in the order of the tool calls, and a call that fails or times out produces an
+error result instead of discarding the results of the others. Calls are tracked as used by the invocation that
+executes them, whichever thread they run on.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+import logging
+import threading
+import time
+from typing import Any, Callable, Coroutine, Deque, List, Optional, Sequence
+
+from ell.lmp._track import get_current_invocation, pop_invocation, push_invocation
+from ell.types._lstr import _lstr
+from ell.types.message import ContentBlock, ToolCall, ToolResult
+
+logger = logging.getLogger(__name__)
+
+TOOL_EXECUTION_WORKERS = 32
+
+_tool_executor: Optional[ThreadPoolExecutor] = None
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_event_loop_thread: Optional[threading.Thread] = None
+_init_lock = threading.Lock()
+
+
+def _get_tool_executor() -> ThreadPoolExecutor:
+    global _tool_executor
+    if _tool_executor is None:
+        with _init_lock:
+            if _tool_executor is None:
+                _tool_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTION_WORKERS, thread_name_prefix="ell-tool")
+    return _tool_executor
+
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    global _event_loop, _event_loop_thread
+    if _event_loop is None:
+        with _init_lock:
+            if _event_loop is None:
+                loop = asyncio.new_event_loop()
+                _event_loop_thread = threading.Thread(target=loop.run_forever, name="ell-tool-loop", daemon=True)
+                _event_loop_thread.start()
+                _event_loop = loop
+    return _event_loop
+
+
+def run_coroutine(coro: Coroutine, timeout: Optional[float] = None) -> Any:
+    """
+    Runs a coroutine on ell's shared event loop and blocks until it finishes. The coroutine is cancelled if it takes
+    longer than timeout seconds.
+    """
+    if threading.current_thread() is _event_loop_thread:
+        coro.close()
+        raise RuntimeError("Async tools cannot be called synchronously from another async tool; await them instead.")
+    future = asyncio.run_coroutine_threadsafe(coro, _get_event_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+class ConcurrencyLimit:
+    """
+    A limit on how many tool calls run at once. Calls over the limit wait in a queue, without holding a thread, and
+    are started as running calls release their slots.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._waiting: Deque[Callable[[], None]] = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, start: Callable[[], None]) -> None:
+        """Calls start once a slot is free, right away if one is."""
+        with self._lock:
+            if self._active >= self.limit:
+                self._waiting.append(start)
+                return
+            self._active += 1
+        start()
+
+    def acquire_blocking(self) -> None:
+        acquired = threading.Event()
+        self.acquire(acquired.set)
+        acquired.wait()
+
+    def release(self) -> None:
+        with self._lock:
+            if not self._waiting:
+                self._active -= 1
+                return
+            # The slot passes straight to the next waiting call.
+            start = self._waiting.popleft()
+        start()
+
+
+def _error_result(tool_call: ToolCall, message: str) -> ContentBlock:
+    return ContentBlock._construct(tool_result=ToolResult(
+        tool_call_id=tool_call.tool_call_id,
+        result=[ContentBlock._construct(text=_lstr(message))],
+    ))
+
+
+def _failed_result(tool_call: ToolCall, e: Exception) -> ContentBlock:
+    name = tool_call.tool.__name__
+    logger.warning(f"Tool {name} failed: {e!r}")
+    return _error_result(tool_call, f"Error: {name} raised {type(e).__name__}: {e}")
+
+
+def _tool_timeout(tool_call: ToolCall, timeout: Optional[float]) -> Optional[float]:
+    tool_timeout = getattr(tool_call.tool, "__ell_tool_timeout__", None)
+    return tool_timeout if tool_timeout is not None else timeout
+
+
+def _run_tool_call(tool_call: ToolCall, invocation_id: Optional[str]) -> ContentBlock:
+    if invocation_id is None:
+        return tool_call.call_and_collect_as_message_block()
+    push_invocation(invocation_id)
+    try:
+        return tool_call.call_and_collect_as_message_block()
+    finally:
+        pop_invocation()
+
+
+def _submit(tool_call: ToolCall, limits: Sequence[ConcurrencyLimit]) -> Future:
+    """
+    Queues a tool call behind its concurrency limits and then runs it on the shared pool. A call that times out is
+    given up on rather than waited for; if it is still queued it never starts.
+    """
+    invocation_id = get_current_invocation()
+    future = Future()
+
+    def run() -> None:
+        try:
+            future.set_result(_run_tool_call(tool_call, invocation_id))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            for limit in reversed(limits):
+                limit.release()
+
+    def acquire(index: int) -> None:
+        if index < len(limits):
+            limits[index].acquire(lambda: acquire(index + 1))
+        elif not future.set_running_or_notify_cancel():
+            # The call timed out while it was queued.
+            for limit in reversed(limits):
+                limit.release()
+        else:
+            _get_tool_executor().submit(run)
+
+    acquire(0)
+    return future
+
+
+def _tool_limits(tool_call: ToolCall) -> List[ConcurrencyLimit]:
+    limit = getattr(tool_call.tool, "__ell_tool_limit__", None)
+    return [limit] if limit is not None else []
+
+
+def start_tool_call(tool_call: ToolCall) -> Future:
+    """
+    Starts executing a tool call ahead of execute_tool_calls, which then collects its result instead of calling the
+    tool again.
+    """
+    future = _submit(tool_call, _tool_limits(tool_call))
+    tool_call._started = future
+    return future
+
+
+def execute_tool_calls(
+    tool_calls: List[ToolCall],
+    parallel: bool = True,
+    max_workers: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> List[ContentBlock]:
+    """
+    Calls the tools of the given tool calls and collects their results as tool result blocks, in the order of the
+    tool calls.
+
+    Args:
+        tool_calls (List[ToolCall]): The tool calls to execute.
+        parallel (bool): Run the calls concurrently. Otherwise they run one after another, on the calling thread
+            unless they have a timeout.
+        max_workers (int, optional): The most calls of this batch to run at once. Defaults to all of them.
+        timeout (float, optional): Seconds each call may take, counted from when it is queued, unless its tool sets
+            its own timeout. A call that times out is reported as failed; a synchronous tool cannot be interrupted
+            and runs to completion in the background on the shared pool.
+
+    Returns:
+        List[ContentBlock]: One tool result per tool call. Calls that raised or timed out produce a result
+        describing the error.
+    """
+    window = [ConcurrencyLimit(max_workers)] if parallel and max_workers else []
+
+    def submit(tool_call: ToolCall):
+        call_timeout = _tool_timeout(tool_call, timeout)
+        deadline = time.monotonic() + call_timeout if call_timeout is not None else None
+        started, tool_call._started = tool_call._started, None
+        if started is None:
+            started = _submit(tool_call, window + _tool_limits(tool_call))
+        return started, deadline
+
+    def collect(tool_call: ToolCall, future: Future, deadline: Optional[float]) -> ContentBlock:
+        name = tool_call.tool.__name__
+        try:
+            return future.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            future.cancel()
+            logger.warning(f"Tool {name} timed out")
+            return _error_result(tool_call, f"Error: {name} timed out.")
+        except Exception as e:
+            return _failed_result(tool_call, e)
+
+    def call_inline(tool_call: ToolCall) -> ContentBlock:
+        limits = _tool_limits(tool_call)
+        for limit in limits:
+            limit.acquire_blocking()
+        try:
+            return tool_call.call_and_collect_as_message_block()
+        except Exception as e:
+            return _failed_result(tool_call, e)
+        finally:
+            for limit in reversed(limits):
+                limit.release()
+
+    if not parallel:
+        return [
+            call_inline(tool_call) if tool_call._started is None and _tool_timeout(tool_call, timeout) is None
+            else collect(tool_call, *submit(tool_call))
+            for tool_call in tool_calls
+        ]
+    submitted = [submit(tool_call) for tool_call in tool_calls]
+    return [collect(tool_call, *future) for tool_call, future in zip(tool_calls, submitted)]
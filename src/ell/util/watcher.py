@@ -0,0 +1,136 @@
+"""
+Incremental re-versioning of LMPs in long-running processes.
+
+An LMP's hash is computed once per process. When its source is edited while the process keeps running (for example
+under a hot reloader that patches code in place), the watcher maps the changed files to the LMPs whose closures were
+built from them and recomputes only those closures, writing the new versions to the store. Unless modules are
+reloaded, only LMPs whose code was actually replaced are re-versioned: an edit that has not been loaded into the process
+does not change the code that runs, and versioning it from disk would record source that is not executing.
+"""
+import importlib
+import inspect
+import linecache
+import logging
+import os
+import sys
+import threading
+from typing import Callable, Iterable, List, Optional, Set
+
+import ell.util.closure
+from ell.configurator import config
+from ell.lmp._track import _serialize_lmp, get_tracked_lmps
+
+logger = logging.getLogger(__name__)
+
+_reversion_lock = threading.Lock()
+
+
+def _closure_files(func) -> Set[str]:
+    files = getattr(func, "__ell_source_files__", None)
+    if files is not None:
+        return set(files)
+    # LMPs versioned as a dependency of another LMP only know the file they are defined in.
+    inner = func
+    while hasattr(inner, "__ell_func__"):
+        inner = inner.__ell_func__
+    try:
+        return {os.path.abspath(inspect.getsourcefile(inner))}
+    except TypeError:
+        return set()
+
+
+def _code_changed(func) -> bool:
+    previous = getattr(func, "__ell_code__", None)
+    current = ell.util.closure._code_snapshot(func)
+    return previous is None or len(previous) != len(current) or any(a is not b for a, b in zip(previous, current))
+
+
+def _reload_modules(changed: Set[str]) -> Set[str]:
+    reloaded = set()
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.abspath(path) in changed and name != "__main__":
+            try:
+                importlib.reload(module)
+                reloaded.add(name)
+            except Exception as e:
+                logger.warning(f"Failed to reload {name}: {e}")
+    return reloaded
+
+
+def reversion_lmps(changed_files: Iterable[str], reload: bool = False) -> List[Callable]:
+    """
+    Recompute the closures of LMPs built from any of the changed files and write the new versions to the store.
+
+    Args:
+        changed_files (Iterable[str]): Paths of the source files that changed.
+        reload (bool): Reload the modules defined in the changed files first. LMPs defined in reloaded modules are
+            replaced by new objects, which are versioned as usual, and are not re-versioned here. Without it, only LMPs
+            whose code, or the code of a function they refer to, was patched in place are re-versioned.
+
+    Returns:
+        List[Callable]: The LMPs whose hash changed.
+    """
+    changed = {os.path.abspath(path) for path in changed_files}
+    with _reversion_lock:
+        for path in changed:
+            linecache.checkcache(path)
+        reloaded = _reload_modules(changed) if reload else set()
+        ell.util.closure.invalidate_closure_cache()
+
+        updated = []
+        for func, forced_dependencies in get_tracked_lmps().items():
+            # LMPs that were never versioned will be versioned from the current source on their first call.
+            if not hasattr(func, "__ell_hash__") or func.__module__ in reloaded or not (_closure_files(func) & changed):
+                continue
+            if not reload and not _code_changed(func):
+                continue
+            previous_hash = func.__ell_hash__
+            ell.util.closure.lexically_closured_source(func, forced_dependencies)
+            if func.__ell_hash__ == previous_hash:
+                continue
+
+            func._has_serialized_lmp = False
+            wrapper = getattr(func, "__wrapper__", None)
+            if wrapper is not None:
+                # Other LMPs refer to this one through its tracked wrapper, which holds its own copy of the version.
+                wrapper.__ell_closure__, wrapper.__ell_hash__, wrapper.__ell_uses__ = func.__ell_closure__, func.__ell_hash__, func.__ell_uses__
+                wrapper._has_serialized_lmp = False
+            updated.append(func)
+            logger.info(f"Re-versioned {func.__qualname__}: {previous_hash} -> {func.__ell_hash__}")
+
+        if config._store:
+            for func in updated:
+                _serialize_lmp(func)
+        return updated
+
+
+def watch_lmps(directory: Optional[str] = None, reload: bool = False) -> threading.Event:
+    """
+    Watch Python source files on a background thread and re-version the LMPs built from them when they change.
+
+    Args:
+        directory (str, optional): Directory to watch. Defaults to DIRECTORY_TO_WATCH or the current directory,
+            which is also where ell looks for source to include in closures.
+        reload (bool): Reload changed modules before re-versioning. See reversion_lmps.
+
+    Returns:
+        threading.Event: Set it to stop watching.
+    """
+    try:
+        from watchfiles import PythonFilter, watch
+    except ImportError:
+        raise ImportError("Watching LMP sources requires watchfiles. Install it with `pip install watchfiles`.")
+
+    directory = directory or os.environ.get("DIRECTORY_TO_WATCH", os.getcwd())
+    stop_event = threading.Event()
+
+    def run():
+        for changes in watch(directory, watch_filter=PythonFilter(), stop_event=stop_event):
+            try:
+                reversion_lmps({path for _, path in changes}, reload=reload)
+            except Exception as e:
+                logger.warning(f"Failed to re-version LMPs after source changes: {e}")
+
+    threading.Thread(target=run, name="ell-watcher", daemon=True).start()
+    return stop_event
@@ -0,0 +1,116 @@
+from types import SimpleNamespace
+
+import pytest
+from pydantic import BaseModel
+
+import ell
+from ell.util.api import RequestTemplate, _ToolCallAssembler, tool_schema
+
+
+def test_request_template_merges_params_without_mutation(monkeypatch):
+    monkeypatch.setattr(ell.config, "default_lm_params", {"temperature": 0.5, "max_tokens": 10})
+    decorator_params = {"max_tokens": 5}
+    template = RequestTemplate(decorator_params)
+
+    params = template.params({"temperature": 0.1})
+    assert params == {"temperature": 0.1, "max_tokens": 5}
+    params["stream"] = True
+    assert template.params() == {"temperature": 0.5, "max_tokens": 5}
+    assert decorator_params == {"max_tokens": 5}
+
+    ell.config.default_lm_params["top_p"] = 0.9
+    assert template.params() == {"temperature": 0.5, "max_tokens": 5, "top_p": 0.9}
+
+
+def test_tool_schema_is_computed_once():
+    class Params(BaseModel):
+        city: str
+
+    def get_weather(city: str):
+        """Get the weather in a city."""
+    get_weather.__ell_params_model__ = Params
+
+    schema = tool_schema(get_weather)
+    assert schema["function"]["name"] == "get_weather"
+    assert schema["function"]["parameters"] == Params.model_json_schema()
+    assert tool_schema(get_weather) is schema
+
+
+@ell.tool()
+def lookup(key: str):
+    """Look up a key."""
+    return f"value of {key}"
+
+
+def _tool_call_delta(index, id=None, name=None, arguments=None):
+    return SimpleNamespace(index=index, id=id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def test_tool_calls_are_assembled_and_started_as_they_complete():
+    assembler = _ToolCallAssembler([lookup], "invocation-1", execute=True)
+    assembler.add([_tool_call_delta(0, id="call_0", name="lookup", arguments='{"key": ')])
+    assert assembler.tool_calls == {}
+    assembler.add([_tool_call_delta(0, arguments='"a"}')])
+    first = assembler.tool_calls[0]
+    assert first.params.key == "a" and first.tool_call_id == "call_0"
+    assert first._started.result(timeout=10).tool_result.result[0].text == "value of a"
+
+    # Calls of unknown tools are dropped, as in non-streamed responses.
+    assembler.add([_tool_call_delta(1, id="call_1", name="lookup", arguments='{"key": "b"} ')])
+    assembler.add([_tool_call_delta(2, id="call_2", name="unknown", arguments='{}')])
+    assert assembler.tool_calls[1].params.key == "b"
+    blocks = assembler.content_blocks()
+    assert [block.tool_call.tool_call_id for block in blocks] == ["call_0", "call_1"]
+
+
+class _FakeStream:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        for content in self.deltas:
+            if self.closed:
+                return
+            self.sent += 1
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(index=0, logprobs=None, delta=SimpleNamespace(content=content, role="assistant", tool_calls=None))])
+
+    def close(self):
+        self.closed = True
+
+
+def test_streams_stop_early_when_a_condition_is_met():
+    stream = _FakeStream(['Sure: {"name": ', '"Ada"', '} and', ' then', ' more'])
+    client = SimpleNamespace(api_key="key", chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: stream)))
+    message, _, metadata = ell.util.api.call(
+        model="gpt-4o", messages=[], api_params={}, client=client, _invocation_origin="invocation-1",
+        _exempt_from_tracking=True, stop_when=["json", r"never"],
+    )
+    assert message.text == 'Sure: {"name": "Ada"}'
+    assert stream.closed and stream.sent == 3
+    assert metadata["stop_reason"] == "json"
+    assert metadata["usage"]["completion_tokens"] == 3 and metadata["usage"]["estimated"]
+
+
+def test_early_stopped_invocations_are_tracked(tmp_path, monkeypatch):
+    from sqlmodel import Session, select
+    from ell.stores.sql import SQLiteStore
+    from ell.types import Invocation
+
+    store = SQLiteStore(str(tmp_path))
+    monkeypatch.setattr(ell.config, "_store", store)
+    stream = _FakeStream(['{"answer": 42}', ' and more'])
+    client = SimpleNamespace(api_key="key", chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kwargs: stream)))
+
+    @ell.simple(model="gpt-4o", client=client, stop_when="json")
+    def extract(text: str):
+        """Extract the answer as JSON."""
+        return text
+
+    assert extract("The answer is 42.") == '{"answer": 42}'
+    with Session(store.engine) as session:
+        invocation = session.exec(select(Invocation)).one()
+        assert invocation.prompt_tokens > 0 and invocation.completion_tokens == 1
+        assert invocation.contents.invocation_api_params["stop_reason"] == "json"
+        assert store.get_invocations_aggregate(session)["total_tokens"] == invocation.prompt_tokens + 1
@@ -8,8 +8,10 @@ from ell.util.closure import (
     should_import,
     get_referenced_names,
     is_function_called,
+    lexically_closured_source,
 )
 import ell
+import ell.util.closure
 from ell.util.serialization import is_immutable_variable
 
 
@@ -134,5 +136,167 @@ def test_lexical_closure_uses():
     assert len(dependency_func.__ell_uses__) == 0
     
 
+def test_lexical_closure_shares_node_analysis(monkeypatch):
+    def shared_helper():
+        return 42
+
+    def first():
+        return shared_helper()
+
+    def second():
+        return shared_helper() + 1
+
+    calls = []
+    getsource = ell.util.closure.getsource
+    def counting_getsource(obj, *args, **kwargs):
+        calls.append(obj)
+        return getsource(obj, *args, **kwargs)
+    monkeypatch.setattr(ell.util.closure, "getsource", counting_getsource)
+
+    first_src, _, _ = lexical_closure(first)
+    second_src, _, _ = lexical_closure(second)
+    assert "def shared_helper():" in first_src and "def shared_helper():" in second_src
+    assert calls.count(shared_helper) == 1
+
+
+def test_node_analysis_follows_rebound_globals(tmp_path, monkeypatch):
+    (tmp_path / "rebound_helpers.py").write_text("LIMIT = 1\n\ndef helper():\n    return LIMIT\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import rebound_helpers
+
+    analyses = []
+    get_globals_and_frees = ell.util.closure._get_globals_and_frees
+    def counting_get_globals_and_frees(func):
+        analyses.append(func)
+        return get_globals_and_frees(func)
+    monkeypatch.setattr(ell.util.closure, "_get_globals_and_frees", counting_get_globals_and_frees)
+
+    assert "LIMIT = 1" in lexical_closure(rebound_helpers.helper)[0]
+    assert "LIMIT = 1" in lexical_closure(rebound_helpers.helper)[0]
+    assert analyses == [rebound_helpers.helper]
+
+    monkeypatch.setattr(rebound_helpers, "LIMIT", 2)
+    assert "LIMIT = 2" in lexical_closure(rebound_helpers.helper)[0]
+    assert analyses == [rebound_helpers.helper] * 2
+
+
+def test_ast_source_hash_mode_ignores_formatting(monkeypatch):
+    monkeypatch.setattr(ell.config, "source_hash_mode", "ast")
+    def spaced( x ):
+        # comments do not affect the version
+        return   x*2
+
+    _, (source, _), _ = lexical_closure(spaced)
+    assert "return   x*2" in source
+    canonicalize = ell.util.closure._canonicalize_source
+    assert canonicalize(source) == canonicalize("def spaced(x):\n    return x * 2\n")
+    assert canonicalize("#<BmV>\ncache = <dict object>\n#</BmV>") == "cache = '<dict object>'"
+
+
+def test_background_versioning(monkeypatch):
+    monkeypatch.setattr(ell.config, "background_versioning", True)
+
+    @ell.simple(model="gpt-4")
+    def background_versioned_lmp():
+        return "hello"
+
+    assert ell.wait_for_versioning(timeout=30)
+    assert background_versioned_lmp.__ell_func__.__ell_hash__.startswith("lmp-")
+
+
+def test_wait_for_versioning_while_importing(tmp_path, monkeypatch):
+    monkeypatch.setattr(ell.config, "background_versioning", True)
+    (tmp_path / "importing_prompts.py").write_text(
+        "import ell\n\n"
+        "@ell.simple(model='gpt-4')\n"
+        "def importing_lmp():\n"
+        "    return 'hello'\n\n"
+        "versioned = ell.wait_for_versioning(timeout=10)\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import importing_prompts
+
+    assert importing_prompts.versioned
+    assert importing_prompts.importing_lmp.__ell_func__.__ell_hash__.startswith("lmp-")
+
+
+def test_background_versioning_is_not_held_up_by_an_importing_module(monkeypatch):
+    from ell.lmp import _track
+    monkeypatch.setattr(ell.config, "background_versioning", True)
+    importing = True
+    module_initializing = _track._module_initializing
+    monkeypatch.setattr(_track, "_module_initializing", lambda func: (importing and func.__name__ == "still_importing_lmp") or module_initializing(func))
+
+    @ell.simple(model="gpt-4")
+    def still_importing_lmp():
+        return "hello"
+
+    @ell.simple(model="gpt-4")
+    def imported_lmp():
+        return "hello"
+
+    imported_lmp.__ell_func__.__ell_versioning__.result(timeout=10)
+    assert not still_importing_lmp.__ell_func__.__ell_versioning__.done()
+    importing = False
+    still_importing_lmp.__ell_func__.__ell_versioning__.result(timeout=10)
+    assert still_importing_lmp.__ell_func__.__ell_hash__.startswith("lmp-")
+
+
+def test_reversion_lmps_on_source_change(tmp_path, monkeypatch):
+    from ell.util.watcher import reversion_lmps
+    module_path = tmp_path / "watched_prompts.py"
+    module_path.write_text(
+        "import ell\n\n"
+        "@ell.simple(model='gpt-4')\n"
+        "def watched_lmp():\n"
+        "    return 'hello'\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import watched_prompts
+
+    func = watched_prompts.watched_lmp.__ell_func__
+    lexically_closured_source(func)
+    previous_hash = func.__ell_hash__
+    assert reversion_lmps([str(tmp_path / "unrelated.py")]) == []
+
+    module_path.write_text(module_path.read_text().replace("'hello'", "'hello, world'"))
+    # The edit is not running yet, so the LMP keeps the version of the code that is.
+    assert reversion_lmps([str(module_path)]) == []
+    assert func.__ell_hash__ == previous_hash
+
+    # A hot reloader patches the running function in place.
+    namespace = {}
+    exec(compile(module_path.read_text(), str(module_path), "exec"), namespace)
+    func.__ell_func__.__code__ = namespace["watched_lmp"].__ell_func__.__ell_func__.__code__
+    assert reversion_lmps([str(module_path)]) == [func]
+    assert func.__ell_hash__ != previous_hash
+    assert "hello, world" in func.__ell_closure__[0]
+
+
+@ell.simple(model="gpt-4")
+def persistently_cached_lmp(topic: str):
+    """You are a poet."""
+    return f"Write a poem about {topic}"
+
+
+def test_lexically_closured_source_persistent_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ell.config, "closure_cache_dir", str(tmp_path))
+    func = persistently_cached_lmp.__ell_func__
+    closure, _ = lexically_closured_source(func)
+    expected_hash = func.__ell_hash__
+
+    # Simulate a fresh process: the closure must be restored from disk without being recomputed.
+    for attr in ("__ell_closure__", "__ell_hash__", "__ell_uses__"):
+        delattr(func, attr)
+    def fail(*args, **kwargs):
+        raise AssertionError("closure was recomputed")
+    monkeypatch.setattr(ell.util.closure, "lexical_closure", fail)
+
+    restored, uses = lexically_closured_source(func)
+    assert func.__ell_hash__ == expected_hash
+    assert restored[:2] == closure[:2]
+    assert uses == set()
+
+
 if __name__ == "__main__":
     test_lexical_closure_uses()
\ No newline at end of file
@@ -95,6 +95,47 @@ class TestLstr:
         # assert filled.logits is None
         assert filled._origin_trace == frozenset({"model9"})
 
+    def test_str_methods(self):
+        s = _lstr("  hello  ", _origin_trace="model12")
+        replaced = s.strip().replace("hello", _lstr("world", _origin_trace="model13"))
+        assert type(replaced) is _lstr
+        assert str(replaced) == "world"
+        assert replaced._origin_trace == frozenset({"model12", "model13"})
+
+        # Methods that do not return strings are plain str methods.
+        assert s.find("hello") == 2
+        assert _lstr.find is str.find
+        assert s.__class__ is _lstr
+
+    def test_origin_traces_are_shared(self):
+        document = _lstr("a b c", _origin_trace="model14") + _lstr(" d", _origin_trace="model15")
+        parts = document.split()
+        assert all(part._origin_trace is document._origin_trace for part in parts)
+        assert (parts[0] + parts[1])._origin_trace is document._origin_trace
+        assert _lstr("x", _origin_trace="model14")._origin_trace is _lstr("y", _origin_trace=["model14"])._origin_trace
+
+    def test_logits_follow_fragments(self):
+        # Tokens: "Hello" " world" "," " bye"
+        logits = np.array([-0.1, -0.2, -0.3, -0.4])
+        s = _lstr("Hello world, bye", logits, "model16", _token_offsets=np.array([0, 5, 11, 12], dtype=np.intc))
+
+        hello, rest = s.split(" ", 1)
+        assert np.array_equal(hello.logits, [-0.1])
+        assert np.array_equal(rest.logits, [-0.3, -0.4])  # " world" is not entirely within "world, bye"
+        assert np.shares_memory(rest.logits, logits)
+
+        world = s[5:11]
+        assert np.array_equal(world.logits, [-0.2])
+        assert np.array_equal(world.token_offsets, [0])
+        assert np.array_equal(world[1:].logits, [])
+        assert s[::2].logits is None and s[0].logits is None
+        assert (s + "!").logits is None
+
+        head, sep, tail = s.partition(",")
+        assert np.array_equal(head.logits, [-0.1, -0.2])
+        assert np.array_equal(sep.logits, [-0.3])
+        assert np.array_equal(tail.token_offsets, [0])
+
     def test_repr(self):
         s = _lstr("test", _origin_trace="model10")  # Removed logits parameter
         assert "test" in repr(s)
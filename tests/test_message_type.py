@@ -2,6 +2,7 @@ import pytest
 from pydantic import BaseModel
 import ell
 from src.ell.types.message import ContentBlock, ToolCall, ToolResult, Message
+from src.ell.types._lstr import _lstr
 import numpy as np
 from PIL import Image
 
@@ -71,6 +72,47 @@ def test_message_coercion():
     assert isinstance(message.content[3], ContentBlock) and isinstance(message.content[3].parsed, DummyFormattedResponse)
     assert isinstance(message.content[4], ContentBlock) and message.content[4].text == "Existing content block"
 
+def test_trusted_construction():
+    blocks = [ContentBlock.coerce("Hello"), ContentBlock._construct(text=_lstr("world"))]
+    message = Message._construct(role="assistant", content=blocks)
+    assert message.model_dump() == Message(role="assistant", content=["Hello", "world"]).model_dump()
+    assert message.content[0] is blocks[0] and message.text == "Hello\nworld"
+
+    # Strings become _lstrs, as they would through validation.
+    for text in (ContentBlock.coerce("Hello").text, Message(role="user", content="hi").content[0].text, ell.user("hi").content[0].text):
+        assert type(text).__name__ == "_lstr" and text._origin_trace == frozenset()
+
+    from ell.lmp.complex import _get_messages
+    def prompt():
+        """You are a poet."""
+    for message in _get_messages("Write a poem", prompt):
+        assert type(message.content[0].text).__name__ == "_lstr"
+
+    # The single non-null field invariant is checked in debug mode.
+    with pytest.raises(ValueError):
+        ContentBlock._construct(text="Hello", parsed=DummyFormattedResponse(field1="test", field2=42))
+
+def test_openai_message_conversion_is_cached(capsys):
+    message = Message(role="user", content=["Hello"])
+    converted = message.to_openai_message()
+    cached = message._openai_message
+    assert converted == {"role": "user", "content": [{"type": "text", "text": "Hello"}]}
+    assert capsys.readouterr().out == ""
+
+    # Callers get copies of the cached conversion.
+    converted["content"][0]["text"] = "changed"
+    converted["content"].append({"type": "text", "text": "more"})
+    assert message.to_openai_message() == {"role": "user", "content": [{"type": "text", "text": "Hello"}]}
+    assert message._openai_message is cached
+
+    # Mutating the message or any of its blocks invalidates the conversion.
+    message.content[0].text = "Goodbye"
+    assert message.to_openai_message()["content"][0]["text"] == "Goodbye"
+    message.content.append(ContentBlock(text="again"))
+    assert len(message.to_openai_message()["content"]) == 2
+    message.role = "assistant"
+    assert message.to_openai_message()["role"] == "assistant"
+
 def test_content_block_single_non_null():
     # Valid cases
     ContentBlock.model_validate(ContentBlock(text="Hello"))
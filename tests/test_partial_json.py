@@ -0,0 +1,51 @@
+import json
+
+from pydantic import BaseModel, Field
+import pytest
+
+import ell
+
+from ell.util.partial_json import PartialModelParser, PartialObjectParser
+
+
+class Person(BaseModel):
+    name: str
+    age: int = Field(ge=0)
+    hobbies: list[str] = Field(default_factory=list)
+
+
+def test_members_are_parsed_as_they_complete():
+    document = json.dumps({"text": 'a, "quoted" } value\\', "nested": {"list": [1, "]"]}, "n": None})
+    for chunk_size in range(1, 8):
+        parser = PartialObjectParser()
+        members = []
+        for i in range(0, len(document), chunk_size):
+            members += parser.feed(document[i:i + chunk_size])
+        assert members == list(json.loads(document).items())
+
+
+def test_partial_models_are_validated_field_by_field():
+    parser = PartialModelParser(Person)
+    assert parser.feed('{"name": "Ada", "ag') is not None
+    partial = parser.feed('e": "36", "hobbies": ["ma')
+    assert partial.name == "Ada" and partial.age == 36
+    assert partial.model_fields_set == {"name", "age"}
+
+    # Fields that fail validation are left unset rather than aborting the stream.
+    parser = PartialModelParser(Person)
+    partial = parser.feed('{"age": -1, "name": "Bob",')
+    assert partial.name == "Bob" and "age" not in partial.model_fields_set
+
+
+def test_on_partial_requires_a_response_format():
+    with pytest.raises(ValueError):
+        ell.complex(model="gpt-4o", on_partial=print)
+
+
+def test_text_around_objects_is_ignored():
+    for text in ['A 12" screen: {"a": 1}', 'smile :-} then {"a": 1}', '[see below] {"a": 1} done']:
+        parser = PartialObjectParser(parse_members=False)
+        for char in text:
+            parser.feed(char)
+        start, end = parser.objects[0]
+        assert json.loads(text[start:end]) == {"a": 1}
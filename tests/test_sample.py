@@ -0,0 +1,82 @@
+from collections import Counter
+import threading
+from types import SimpleNamespace
+
+import ell
+
+
+class _SamplingClient:
+    """Streams n choices per request, each saying which request and choice produced it."""
+
+    api_key = "key"
+
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, n=1, **kwargs):
+        with self._lock:
+            request = len(self.requests)
+            self.requests.append(n)
+        return [
+            SimpleNamespace(usage=None, choices=[SimpleNamespace(index=i, logprobs=None, delta=SimpleNamespace(content=f"{request}:{i}", role="assistant", tool_calls=None))])
+            for i in range(n)
+        ]
+
+
+def test_samples_are_batched_with_n():
+    client = _SamplingClient()
+
+    @ell.simple(model="gpt-4o", client=client, exempt_from_tracking=True)
+    def answer(question: str):
+        return question
+
+    samples = answer.sample(7, "What is 6 * 7?", max_n=3)
+    assert Counter(client.requests) == Counter([3, 3, 1])
+    assert len(samples) == 7 and len(set(samples)) == 7
+
+
+def test_models_without_n_get_one_request_per_sample(monkeypatch):
+    monkeypatch.setattr(ell.config, "max_n", {"gpt-4o": 128})
+    assert ell.config.get_max_n_for("gpt-4o") == 128
+    assert ell.config.get_max_n_for("llama3") == 1
+
+    client = _SamplingClient()
+
+    @ell.simple(model="llama3", client=client, exempt_from_tracking=True)
+    def answer(question: str):
+        return question
+
+    assert len(answer.sample(3, "What is 6 * 7?")) == 3
+    assert client.requests == [1, 1, 1]
+
+
+def test_tracked_samples_are_their_own_invocations(tmp_path, monkeypatch):
+    from sqlmodel import Session, select
+    from ell.stores.sql import SQLiteStore
+    from ell.types import Invocation, InvocationTrace
+
+    store = SQLiteStore(str(tmp_path))
+    monkeypatch.setattr(ell.config, "_store", store)
+    client = _SamplingClient()
+
+    @ell.simple(model="gpt-4o", client=client)
+    def answer(question: str):
+        return question
+
+    @ell.simple(model="gpt-4o", client=client)
+    def judge(candidate: str):
+        return candidate
+
+    samples = answer.sample(3, "What is 6 * 7?", max_n=3)
+    origins = [next(iter(sample._origin_trace)) for sample in samples]
+    assert len(set(origins)) == 3
+    judge(samples[1])
+
+    with Session(store.engine) as session:
+        invocations = {i.id: i for i in session.exec(select(Invocation)).all()}
+        assert set(origins) <= set(invocations)
+        params = [invocations[origin].contents.invocation_api_params["sample"] for origin in origins]
+        assert len({p["group"] for p in params}) == 1 and [p["index"] for p in params] == [0, 1, 2]
+        assert [t.invocation_consuming_id for t in session.exec(select(InvocationTrace)).all()] == [origins[1]]
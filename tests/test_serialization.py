@@ -0,0 +1,116 @@
+import base64
+import dataclasses
+import enum
+import hashlib
+import json
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from ell.store import BlobStore
+from ell.types._lstr import _lstr
+from ell.util.serialization import compute_image_hash, compute_state_cache_key, encode_image, externalize_images, get_immutable_vars, prepare_invocation_params, serialize_image
+
+
+class InMemoryBlobStore(BlobStore):
+    def __init__(self):
+        self.blobs = {}
+        self.writes = 0
+
+    def store_blob(self, blob, metadata=None, blob_id=None):
+        self.writes += 1
+        self.blobs[blob_id] = blob
+        return blob_id
+
+    def retrieve_blob(self, blob_id):
+        if blob_id not in self.blobs:
+            raise FileNotFoundError(blob_id)
+        return self.blobs[blob_id]
+
+
+@pytest.fixture
+def image():
+    return Image.fromarray(np.arange(48, dtype=np.uint8).reshape(4, 4, 3), mode="RGB")
+
+
+def test_compute_image_hash_is_pixel_based(image):
+    assert compute_image_hash(image) == compute_image_hash(image.copy())
+    assert compute_image_hash(image) != compute_image_hash(image.convert("RGBA"))
+
+
+def test_externalize_images_dedupes_across_documents(image):
+    blob_store = InMemoryBlobStore()
+    data_url = serialize_image(image)
+
+    params = {"image": {"content": data_url, "__limage": True}, "text": "hello"}
+    results = [{"role": "user", "content": [{"image": data_url}]}]
+
+    externalized_params = externalize_images(params, blob_store)
+    externalized_results = externalize_images(results, blob_store)
+
+    image_id = "image-" + compute_image_hash(image)
+    assert externalized_params["image"] == {"__image_id__": image_id, "__limage": True}
+    assert externalized_results[0]["content"][0]["image"] == {"__image_id__": image_id, "__limage": True}
+    assert externalized_params["text"] == "hello"
+    assert blob_store.writes == 1
+    assert Image.open(BytesIO(blob_store.retrieve_blob(image_id))).size == image.size
+
+
+def test_externalize_images_leaves_invalid_data_urls_inline():
+    blob_store = InMemoryBlobStore()
+    assert externalize_images("data:image/png;base64,notanimage", blob_store) == "data:image/png;base64,notanimage"
+    assert blob_store.writes == 0
+
+
+def test_encode_image_downscales_and_memoizes(image):
+    large = image.resize((400, 200))
+    data_url = encode_image(large, format="JPEG", quality=70, max_resolution=(100, 100))
+    assert data_url.startswith("data:image/jpeg;base64,")
+    decoded = Image.open(BytesIO(base64.b64decode(data_url.split(",", 1)[1])))
+    assert decoded.size == (100, 50)
+
+    # A different object with the same pixels hits the cache.
+    assert encode_image(large.copy(), format="JPEG", quality=70, max_resolution=(100, 100)) is data_url
+    assert encode_image(large) == serialize_image(large)
+
+
+def test_compute_state_cache_key_tracks_mutable_state():
+    config = {"temperature": 0.5, "stops": ["\n"]}
+    fn_closure = ("source", "dependencies", {"PROMPT": "Be concise", "CONFIG": config, "SIZES": (1, 2)}, {"helper": object()})
+
+    def reference_key(ipstr):
+        globals_str = json.dumps(get_immutable_vars(fn_closure[2]), sort_keys=True, default=repr)
+        frees_str = json.dumps(get_immutable_vars(fn_closure[3]), sort_keys=True, default=repr)
+        return hashlib.sha256(f"{ipstr}{globals_str}{frees_str}".encode("utf-8")).hexdigest()
+
+    key = compute_state_cache_key('{"x": 1}', fn_closure)
+    assert key == reference_key('{"x": 1}')
+    assert compute_state_cache_key('{"x": 1}', fn_closure) == key
+
+    config["stops"].append("END")
+    assert compute_state_cache_key('{"x": 1}', fn_closure) == reference_key('{"x": 1}') != key
+
+
+class Tone(enum.Enum):
+    FORMAL = "formal"
+
+
+@dataclasses.dataclass
+class Settings:
+    tone: Tone
+    tags: set
+
+
+def test_prepare_invocation_params_collects_origin_traces():
+    joke = _lstr("a joke", _origin_trace=frozenset({"invocation-b", "invocation-a"}))
+    params = {"topic": joke, "history": [("user", _lstr("hi", _origin_trace="invocation-c"))], "settings": Settings(Tone.FORMAL, {"b", "a"}), 1: None}
+
+    cleaned, jstr, consumes = prepare_invocation_params(params)
+
+    assert sorted(consumes) == ["invocation-a", "invocation-b", "invocation-c"]
+    assert cleaned["topic"] == {"content": "a joke", "__origin_trace__": "invocation-a,invocation-b", "__lstr": True}
+    assert cleaned["history"][0][1]["__origin_trace__"] == "invocation-c"
+    assert cleaned["settings"] == {"tone": "formal", "tags": ["a", "b"]}
+    assert cleaned == json.loads(jstr)
@@ -2,6 +2,7 @@ import pytest
 from datetime import datetime, timezone
 from sqlmodel import Session, select
 from ell.stores.sql import SQLStore, SerializedLMP
+from ell.types import Invocation, InvocationContents, SharedContent
 from sqlalchemy import Engine, create_engine, func
 
 from ell.types.studio import LMPType
@@ -76,4 +77,118 @@ def test_write_lmp(sql_store: SQLStore):
     sql_store.write_lmp(SerializedLMP(lmp_id=lmp_id, name=name, source=source, dependencies=dependencies, lmp_type=LMPType.LM, api_params=api_params, version_number=version_number, initial_global_vars=global_vars, initial_free_vars=free_vars, commit_message=commit_message, created_at=created_at), uses)
     with Session(sql_store.engine) as session:
         count = session.exec(select(func.count()).where(SerializedLMP.lmp_id == lmp_id)).one()
-        assert count == 1
\ No newline at end of file
+        assert count == 1
+
+def test_write_invocation_shares_repeated_messages(sql_store: SQLStore):
+    sql_store.write_lmp(SerializedLMP(lmp_id="chat_lmp", name="chat", source="def chat(): pass", dependencies="", lmp_type=LMPType.LM, created_at=utc_now()), {})
+
+    system_prompt = "You are a helpful assistant. " * 40
+    history = [{"role": "system", "content": system_prompt}, {"role": "user", "content": "hi"}]
+    for i, turn in enumerate([history, history + [{"role": "assistant", "content": "hello"}]]):
+        invocation_id = f"invocation-{i}"
+        sql_store.write_invocation(Invocation(
+            id=invocation_id,
+            lmp_id="chat_lmp",
+            latency_ms=1.0,
+            created_at=utc_now(),
+            contents=InvocationContents(invocation_id=invocation_id, params={"history": turn}, results="ok"),
+        ), set())
+
+    with Session(sql_store.engine) as session:
+        shared = session.exec(select(SharedContent)).all()
+        # system prompt text, system message, user message and assistant message are each stored once.
+        assert len(shared) == 4
+
+        invocations = sql_store.get_invocations(session, lmp_filters={"lmp_id": "chat_lmp"})
+        by_id = {invocation.id: invocation for invocation in invocations}
+        assert by_id["invocation-0"].contents.params == {"history": history}
+        assert by_id["invocation-1"].contents.params["history"][0]["content"] == system_prompt
+        assert by_id["invocation-1"].contents.results == "ok"
+
+
+def test_get_invocations_loads_nested_invocations_in_batches(sql_store: SQLStore):
+    from sqlalchemy import event
+
+    sql_store.write_lmp(SerializedLMP(lmp_id="chat_lmp", name="chat", source="def chat(): pass", dependencies="", lmp_type=LMPType.LM, created_at=utc_now()), {})
+    system_prompt = "You are a helpful assistant. " * 40
+
+    def write(invocation_id, used_by_id=None, consumes=()):
+        sql_store.write_invocation(Invocation(
+            id=invocation_id, lmp_id="chat_lmp", latency_ms=1.0, created_at=utc_now(), used_by_id=used_by_id,
+            contents=InvocationContents(invocation_id=invocation_id, params={"prompt": system_prompt}, results=invocation_id),
+        ), set(consumes))
+
+    for i in range(10):
+        write(f"source-{i}")
+        write(f"root-{i}", consumes={f"source-{i}"})
+        write(f"tool-{i}", used_by_id=f"root-{i}")
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(sql_store.engine, "before_cursor_execute", listener)
+    try:
+        with Session(sql_store.engine) as session:
+            invocations = sql_store.get_invocations(session, lmp_filters={"lmp_id": "chat_lmp"}, limit=30)
+            roots = [invocation for invocation in invocations if invocation.id.startswith("root")]
+            assert len(roots) == 10
+            for root in roots:
+                i = root.id.split("-")[1]
+                assert [used.contents.results for used in root.uses] == [f"tool-{i}"]
+                assert [used.contents.params["prompt"] for used in root.uses] == [system_prompt]
+                assert [consumed.id for consumed in root.consumed_by] == [f"source-{i}"]
+                assert root.consumed_by[0].contents.params["prompt"] == system_prompt
+    finally:
+        event.remove(sql_store.engine, "before_cursor_execute", listener)
+    # A fixed number of queries, however many invocations there are.
+    assert len(statements) < 15
+
+
+def test_write_lmp_shares_dependency_blocks(sql_store: SQLStore):
+    shared_helper = "def helper():\n" + "".join(f"    x{i} = {i}\n" for i in range(100)) + "\n\n"
+    for version in range(3):
+        dependencies = f"import os\n\n{shared_helper}VERSION = {version}\n"
+        sql_store.write_lmp(SerializedLMP(lmp_id=f"lmp_v{version}", name="versioned", source="def versioned(): pass", dependencies=dependencies, lmp_type=LMPType.LM, version_number=version, created_at=utc_now()), {})
+
+    with Session(sql_store.engine) as session:
+        blocks = session.exec(select(SharedContent)).all()
+        # The import and helper blocks are shared, only the VERSION block differs.
+        assert len(blocks) == 5
+
+        lmps = sql_store.get_lmps(session, name="versioned")
+        assert {lmp.lmp_id: lmp.dependencies for lmp in lmps} == {
+            f"lmp_v{version}": f"import os\n\n{shared_helper}VERSION = {version}\n" for version in range(3)
+        }
+
+
+def test_update_commit_message(sql_store: SQLStore):
+    sql_store.write_lmp(SerializedLMP(lmp_id="lmp_pending", name="pending", source="def pending(): pass", dependencies="", lmp_type=LMPType.LM, version_number=1, created_at=utc_now()), {})
+    sql_store.update_commit_message("lmp_pending", "Changed the system prompt")
+
+    with Session(sql_store.engine) as session:
+        assert session.get(SerializedLMP, "lmp_pending").commit_message == "Changed the system prompt"
+
+
+def test_write_lmp_assigns_next_version_on_conflict(sql_store: SQLStore):
+    assert sql_store.get_latest_version_number("raced") is None
+    for lmp_id in ("lmp_a", "lmp_b"):
+        # Both writers saw no previous version and try to write version 0.
+        sql_store.write_lmp(SerializedLMP(lmp_id=lmp_id, name="raced", source="def raced(): pass", dependencies="", lmp_type=LMPType.LM, version_number=0, created_at=utc_now()), {})
+
+    assert sql_store.lmp_exists("lmp_b")
+    assert not sql_store.lmp_exists("lmp_c")
+    assert sql_store.get_latest_version_number("raced") == 1
+    with Session(sql_store.engine) as session:
+        assert session.get(SerializedLMP, "lmp_b").version_number == 1
+
+
+def test_cached_tool_results(sql_store: SQLStore):
+    from datetime import timedelta
+    from ell.types.studio import CachedToolResult
+
+    start = utc_now()
+    for i in range(3):
+        sql_store.write_cached_tool_result(CachedToolResult(cache_key=f"key_{i}", tool_name="lookup", result={"value": i}, created_at=start + timedelta(seconds=i)), max_entries=2)
+
+    assert sql_store.get_cached_tool_result("key_0") is None
+    assert sql_store.get_cached_tool_result("key_2").result == {"value": 2}
+    assert sql_store.get_cached_tool_result("key_1", newer_than=start + timedelta(seconds=1)) is None
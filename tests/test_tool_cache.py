@@ -0,0 +1,59 @@
+import ell
+from ell.util import tool_cache
+from ell.util.tool_cache import MemoryToolCache
+
+calls = []
+
+
+@ell.tool(cache=MemoryToolCache(max_size=2))
+def fetch_price(symbol: str, exchange: str = "NYSE"):
+    """Fetch the price of a stock."""
+    calls.append(symbol)
+    return f"{symbol} on {exchange}: 42"
+
+
+def test_tool_results_are_cached_by_params():
+    calls.clear()
+    assert fetch_price(symbol="ACME") == "ACME on NYSE: 42"
+    assert fetch_price("ACME", exchange="NYSE") == "ACME on NYSE: 42"
+    assert calls == ["ACME"]
+
+    fetch_price(symbol="INIT")
+    fetch_price(symbol="OTHER")
+    # The cache holds two results, so the least recently used one was evicted.
+    fetch_price(symbol="ACME")
+    assert calls == ["ACME", "INIT", "OTHER", "ACME"]
+
+    result = fetch_price.__ell_func__(symbol="OTHER")
+    assert result[1]["tool_cache"]["hit"]
+
+
+def test_memory_tool_cache_expires_results(monkeypatch):
+    cache = MemoryToolCache(ttl=10)
+    cache.set("key", "tool", "result")
+    assert cache.get("key") == (True, "result")
+    now = tool_cache.time.monotonic()
+    monkeypatch.setattr(tool_cache.time, "monotonic", lambda: now + 11)
+    assert cache.get("key") == (False, None)
+
+
+@ell.tool(cache=True)
+def fetch_quotes(symbol: str):
+    """Fetch the recent quotes of a stock."""
+    calls.append(symbol)
+    return {"symbol": symbol, "quotes": [41, 42]}
+
+
+def test_cached_results_are_copies():
+    calls.clear()
+    fetch_quotes(symbol="ACME")["quotes"].append(43)
+    assert fetch_quotes(symbol="ACME") == {"symbol": "ACME", "quotes": [41, 42]}
+    assert calls == ["ACME"]
+
+
+def test_reversioning_a_tool_invalidates_its_results(monkeypatch):
+    calls.clear()
+    fetch_quotes(symbol="REV")
+    monkeypatch.setattr(fetch_quotes.__ell_func__, "__ell_hash__", "tool-edited")
+    fetch_quotes(symbol="REV")
+    assert calls == ["REV", "REV"]
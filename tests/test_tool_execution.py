@@ -0,0 +1,105 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import ell
+from ell.types.message import Message, ToolCall
+
+
+@ell.tool()
+def slow_echo(text: str, delay: float):
+    """Echo text after a delay."""
+    time.sleep(delay)
+    return text
+
+
+@ell.tool()
+async def async_echo(text: str):
+    """Echo text asynchronously."""
+    await asyncio.sleep(0.01)
+    return text
+
+
+@ell.tool()
+def failing_tool(text: str):
+    """Always fails."""
+    raise ValueError(f"cannot handle {text}")
+
+
+@ell.tool(timeout=0.05)
+def hanging_tool(text: str):
+    """Takes too long."""
+    time.sleep(1)
+    return text
+
+
+def _tool_call(tool, call_id, **params):
+    return ToolCall(tool=tool, tool_call_id=call_id, params=tool.__ell_params_model__(**params))
+
+
+def test_tool_results_keep_tool_call_order():
+    message = Message(role="assistant", content=[
+        _tool_call(slow_echo, "first", text="slow", delay=0.2),
+        _tool_call(async_echo, "second", text="async"),
+        _tool_call(failing_tool, "third", text="input"),
+        _tool_call(hanging_tool, "fourth", text="late"),
+        _tool_call(slow_echo, "fifth", text="fast", delay=0),
+    ])
+    start = time.monotonic()
+    results = message.call_tools_and_collect_as_message(parallel=True).tool_results
+    assert time.monotonic() - start < 1
+
+    assert [r.tool_call_id for r in results] == ["first", "second", "third", "fourth", "fifth"]
+    assert [r.result[0].text for r in results[:2]] == ["slow", "async"]
+    assert "ValueError: cannot handle input" in results[2].result[0].text
+    assert "timed out" in results[3].result[0].text
+    assert results[4].result[0].text == "fast"
+
+
+def test_tool_calls_are_used_by_the_executing_invocation(tmp_path, monkeypatch):
+    from sqlmodel import Session, select
+    from ell.lmp._track import pop_invocation, push_invocation
+    from ell.stores.sql import SQLiteStore
+    from ell.types import Invocation
+
+    store = SQLiteStore(str(tmp_path))
+    monkeypatch.setattr(ell.config, "_store", store)
+    push_invocation("invocation-parent")
+    try:
+        for parallel in (True, False):
+            Message(role="assistant", content=[_tool_call(slow_echo, "call", text="hi", delay=0)]).call_tools_and_collect_as_message(parallel=parallel)
+    finally:
+        pop_invocation()
+
+    with Session(store.engine) as session:
+        assert [i.used_by_id for i in session.exec(select(Invocation)).all()] == ["invocation-parent"] * 2
+
+
+def test_limited_calls_wait_without_holding_pool_threads(monkeypatch):
+    from ell.util import tool_execution
+
+    monkeypatch.setattr(tool_execution, "_tool_executor", None)
+    monkeypatch.setattr(tool_execution, "TOOL_EXECUTION_WORKERS", 2)
+    # Three slow calls limited to one at a time leave a pool worker free for other batches.
+    batch = Message(role="assistant", content=[_tool_call(slow_echo, f"slow{i}", text="slow", delay=0.2) for i in range(3)])
+    limited = ThreadPoolExecutor(1).submit(batch.call_tools_and_collect_as_message, parallel=True, max_workers=1)
+    time.sleep(0.05)
+
+    start = time.monotonic()
+    other = Message(role="assistant", content=[_tool_call(slow_echo, "other", text="fast", delay=0)])
+    assert other.call_tools_and_collect_as_message(parallel=True).tool_results[0].result[0].text == "fast"
+    assert time.monotonic() - start < 0.15
+    assert [r.result[0].text for r in limited.result(timeout=5).tool_results] == ["slow"] * 3
+
+
+def test_timed_calls_run_on_the_shared_pool():
+    import threading
+
+    @ell.tool(timeout=0.05)
+    def thread_name(text: str):
+        """Returns the name of the thread it runs on."""
+        return threading.current_thread().name
+
+    results = Message(role="assistant", content=[_tool_call(thread_name, "call", text="hi")]).call_tools_and_collect_as_message(parallel=False).tool_results
+    assert results[0].result[0].text.startswith("ell-tool")
+    assert not results[0].result[0].text.startswith("ell-tool-timeout")